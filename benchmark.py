@@ -0,0 +1,397 @@
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from modules import MarkovFlow, \
+    DMVFlow, \
+    Corpus, \
+    NICETrans, \
+    batch_index_iter, \
+    sents_to_vec, \
+    to_input_tensor, \
+    diag_gaussian_log_density, \
+    gaussian_log_density_c, \
+    unique_types
+
+
+def init_config():
+    parser = argparse.ArgumentParser(description='benchmark model kernels')
+    parser.add_argument('--repeat', default=10, type=int, help='number of timed runs')
+    parser.add_argument('--seed', default=5783287, type=int, help='random seed')
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    # emission kernel
+    emission = subparsers.add_parser('emission', help='Gaussian emission kernel against the broadcast path')
+    emission.add_argument('--seq_length', default=40, type=int, help='sentence length')
+    emission.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    emission.add_argument('--num_state', default=45, type=int, help='number of hidden states')
+    emission.add_argument('--num_dims', default=100, type=int, help='word vector dimensions')
+
+    # forward algorithm of MarkovFlow
+    forward = subparsers.add_parser('forward', help='MarkovFlow forward algorithms against the log space one')
+    forward.add_argument('--seq_length', default=40, type=int, help='max sentence length')
+    forward.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    forward.add_argument('--num_state', default=45, type=int, help='number of hidden states')
+    forward.add_argument('--num_dims', default=100, type=int, help='word vector dimensions')
+    forward.add_argument('--engines', default='scaled', type=str,
+                         help='comma separated forward algorithms compared with log')
+
+    # charts of DMVFlow
+    dmv = subparsers.add_parser('dmv', help='DMVFlow split-head chart against the span chart')
+    dmv.add_argument('--seq_length', default=15, type=int,
+                     help='max sentence length, the span chart is O(n^4)')
+    dmv.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    dmv.add_argument('--num_state', default=45, type=int, help='number of hidden states')
+    dmv.add_argument('--num_dims', default=100, type=int, help='word vector dimensions')
+    dmv.add_argument('--threshold', default=1e-3, type=float,
+                     help='pruning threshold of a pruned split-head parse, 0 to skip it')
+
+    # word type cache of MarkovFlow
+    types = subparsers.add_parser('types', help='MarkovFlow projection and emission per word type '
+                                                'against per token')
+    types.add_argument('--seq_length', default=40, type=int, help='max sentence length')
+    types.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    types.add_argument('--num_state', default=45, type=int, help='number of hidden states')
+    types.add_argument('--num_dims', default=100, type=int, help='word vector dimensions')
+    types.add_argument('--couple_layers', default=4, type=int, help='number of coupling layers')
+    types.add_argument('--vocab_size', default=10000, type=int,
+                       help='words are drawn from a Zipf distribution over this vocabulary')
+
+    # batch construction
+    batching = subparsers.add_parser('batching', help='Corpus gather against nested vector lists')
+    batching.add_argument('--num_sents', default=4000, type=int, help='number of sentences')
+    batching.add_argument('--seq_length', default=40, type=int, help='max sentence length')
+    batching.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    batching.add_argument('--num_dims', default=100, type=int, help='word vector dimensions')
+    batching.add_argument('--vocab_size', default=10000, type=int, help='vocabulary size')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+    args.device = torch.device("cuda" if args.cuda else "cpu")
+
+    print(args)
+
+    return args
+
+
+def saved_memory(fn):
+    """bytes of the distinct storages autograd keeps alive for backward"""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+
+    return sum(storages.values())
+
+
+def measure(fn, args):
+    """run fn once for warmup and args.repeat times for timing
+
+    Returns: (time per run in ms, memory in MB)
+        memory is the peak allocated memory on GPU, and the memory
+        saved for backward on CPU
+
+    """
+    fn()
+
+    if args.cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        memory = torch.cuda.max_memory_allocated() - base
+    else:
+        memory = saved_memory(fn)
+
+    begin_time = time.time()
+    for _ in range(args.repeat):
+        fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.time() - begin_time) / args.repeat
+
+    return 1000 * elapsed, memory / 2.0 ** 20
+
+
+def report(name, result, baseline=None):
+    elapsed, memory = result
+    line = '%-12s time %9.3f ms, memory %9.2f MB' % (name, elapsed, memory)
+    if baseline is not None:
+        line += ', speedup %.2fx, memory ratio %.2fx' % (baseline[0] / elapsed,
+                                                         baseline[1] / max(memory, 1e-8))
+    print(line)
+
+
+def broadcast_log_density(inputs, means, var, log_density_c):
+    """the (..., num_state, num_dims) broadcast the models used before
+    diag_gaussian_log_density, kept as the reference
+    """
+    ep_size = inputs.size()[:-1] + means.size()
+    words = inputs.unsqueeze(dim=-2).expand(ep_size)
+    return log_density_c - 0.5 * torch.sum((means.expand(ep_size) - words) ** 2 /
+                                           var.expand(ep_size), dim=-1)
+
+
+def bench_emission(args):
+    inputs = torch.randn(args.seq_length, args.batch_size, args.num_dims,
+                         device=args.device, requires_grad=True)
+    means = torch.randn(args.num_state, args.num_dims,
+                        device=args.device, requires_grad=True)
+    var = torch.rand(args.num_dims, device=args.device) + 0.5
+    log_density_c = gaussian_log_density_c(args.num_dims, var)
+
+    ref = broadcast_log_density(inputs, means, var, log_density_c)
+    out = diag_gaussian_log_density(inputs, means, var, log_density_c)
+    print('max abs difference %.3e (max abs value %.3e)' %
+          ((ref - out).abs().max().item(), ref.abs().max().item()))
+
+    def run(kernel):
+        def fn():
+            density = kernel(inputs, means, var, log_density_c)
+            density.sum().backward()
+
+        return fn
+
+    baseline = measure(run(broadcast_log_density), args)
+    report('broadcast', baseline)
+    report('gemm', measure(run(diag_gaussian_log_density), args), baseline)
+
+
+def build_markov(args):
+    """a Gaussian MarkovFlow with random parameters and a random
+    batch whose sentence lengths are uniform in [1, seq_length]
+    """
+    model_args = argparse.Namespace(device=args.device, num_state=args.num_state,
+                                    couple_layers=0, cell_layers=0, model='gaussian',
+                                    forward='log', type_cache=False)
+    model = MarkovFlow(model_args, args.num_dims).to(args.device)
+    with torch.no_grad():
+        model.tparams.uniform_()
+        model.means.normal_()
+        model.var.uniform_().add_(0.5)
+
+    lengths = np.random.randint(1, args.seq_length + 1, size=args.batch_size)
+    lengths[0] = args.seq_length
+    masks = torch.tensor([[1.0 if t < length else 0.0 for length in lengths]
+                          for t in range(args.seq_length)], device=args.device)
+    sents = torch.randn(args.seq_length, args.batch_size, args.num_dims, device=args.device)
+
+    return model, sents, masks
+
+
+def bench_forward(args):
+    model, sents, masks = build_markov(args)
+
+    def run(engine):
+        def fn():
+            model.args.forward = engine
+            model.zero_grad()
+            likelihood, _ = model(sents, masks)
+            likelihood.backward()
+            return likelihood
+
+        return fn
+
+    def viterbi(engine):
+        model.args.forward = engine
+        with torch.no_grad():
+            return model._viterbi(sents, masks)
+
+    ref = run('log')().item()
+    ref_grad = [p.grad.clone() for p in model.parameters()]
+    ref_tags = viterbi('log')
+    baseline = measure(run('log'), args)
+    report('log', baseline)
+    for engine in args.engines.split(','):
+        likelihood = run(engine)().item()
+        grad_diff = max((p.grad - g).abs().max().item() / max(g.abs().max().item(), 1e-8)
+                        for p, g in zip(model.parameters(), ref_grad))
+        tag_agree = (viterbi(engine) == ref_tags).float()[masks.t() > 0].mean().item()
+        print('%s: log likelihood %.4f (log %.4f), max relative grad difference %.3e, '
+              'viterbi agreement %.4f' % (engine, likelihood, ref, grad_diff, tag_agree))
+        report(engine, measure(run(engine), args), baseline)
+
+
+def build_dmv(args):
+    """a Gaussian DMVFlow with random parameters and a random batch
+    as in build_markov
+    """
+    model_args = argparse.Namespace(device=args.device, model='gaussian', chart='span',
+                                    type_cache=False, batch_size=args.batch_size,
+                                    memory_budget=0)
+    ids = {i: 'tag%d' % i for i in range(args.num_state)}
+    model = DMVFlow(model_args, ids, args.num_dims).to(args.device)
+    with torch.no_grad():
+        for param in [model.attach_left, model.attach_right, model.stop_right,
+                      model.stop_left, model.root_attach_left]:
+            param.uniform_()
+        model.means.normal_()
+        model.var.uniform_().add_(0.5)
+
+    _, sents, masks = build_markov(args)
+
+    return model, sents, masks
+
+
+def bench_dmv(args):
+    model, sents, masks = build_dmv(args)
+
+    def run(chart):
+        def fn():
+            model.zero_grad()
+            density, _ = model.log_density(sents)
+            likelihood = model.p_inside(density, masks, chart=chart)
+            likelihood.backward()
+            return likelihood
+
+        return fn
+
+    def parse(chart, threshold=0.):
+        def fn():
+            with torch.no_grad():
+                density, _ = model.log_density(sents)
+                return model.dep_parse(density, masks, chart=chart, threshold=threshold)
+
+        return fn
+
+    def agreement(heads):
+        valid = ref_heads >= 0
+        return (heads == ref_heads)[valid].mean(), (heads == ref_heads).all(axis=1).mean()
+
+    ref = run('span')().item()
+    ref_grad = [p.grad.clone() for p in model.parameters()]
+    ref_heads = parse('span')()
+
+    likelihood = run('split_head')().item()
+    grad_diff = max((p.grad - g).abs().max().item() / max(g.abs().max().item(), 1e-8)
+                    for p, g in zip(model.parameters(), ref_grad))
+    print('split_head: log likelihood %.4f (span %.4f), max relative grad difference %.3e, '
+          'viterbi head agreement %.4f, identical trees %.4f' %
+          ((likelihood, ref, grad_diff) + agreement(parse('split_head')())))
+    if args.threshold > 0:
+        print('pruned split_head at %g: viterbi head agreement %.4f, identical trees %.4f' %
+              ((args.threshold,) + agreement(parse('split_head', args.threshold)())))
+
+    baseline = measure(run('span'), args)
+    report('span', baseline)
+    report('split_head', measure(run('split_head'), args), baseline)
+
+    baseline = measure(parse('span'), args)
+    report('span parse', baseline)
+    report('split parse', measure(parse('split_head'), args), baseline)
+    if args.threshold > 0:
+        report('pruned parse', measure(parse('split_head', args.threshold), args), baseline)
+
+
+def bench_types(args):
+    model, _, masks = build_markov(args)
+    if args.couple_layers > 0:
+        model.args.model = 'nice'
+        model.nice_layer = NICETrans(args.couple_layers, 1, args.num_dims // 2,
+                                     args.num_dims, args.device).to(args.device)
+        for param in model.nice_layer.parameters():
+            torch.nn.init.normal_(param, std=0.1)
+
+    # zipfian word ids, as in natural text
+    freq = 1.0 / np.arange(1, args.vocab_size + 1)
+    ids = np.random.choice(args.vocab_size, size=(args.seq_length, args.batch_size),
+                           p=freq / freq.sum())
+    vocab = torch.randn(args.vocab_size, args.num_dims, device=args.device)
+    ids = torch.tensor(ids, device=args.device)
+    sents = vocab[ids]
+    print('%d tokens, %d types' % (ids.numel(), len(torch.unique(ids))))
+
+    def run(type_cache):
+        def fn():
+            model.zero_grad()
+            if type_cache:
+                types, inverse = unique_types(ids, vocab)
+                likelihood, _ = model(types, masks, inverse)
+            else:
+                likelihood, _ = model(sents, masks)
+            likelihood.backward()
+            return likelihood
+
+        return fn
+
+    ref = run(False)().item()
+    print('log likelihood difference %.3e' % abs(run(True)().item() - ref))
+    baseline = measure(run(False), args)
+    report('tokens', baseline)
+    report('types', measure(run(True), args), baseline)
+
+    # evaluation, the table of the whole vocabulary against a batch
+    def table():
+        model.density_table(vocab)
+
+    def batch():
+        with torch.no_grad():
+            model._density(sents, model.freeze())
+
+    report('batch eval', measure(batch, args))
+    report('vocab table', measure(table, args))
+
+
+def bench_batching(args):
+    word_vec = {str(i): np.random.randn(args.num_dims) for i in range(args.vocab_size)}
+    freq = 1.0 / np.arange(1, args.vocab_size + 1)
+    sentences = [{"word": [str(i) for i in np.random.choice(args.vocab_size, size=length,
+                                                            p=freq / freq.sum())]}
+                 for length in np.random.randint(1, args.seq_length + 1, size=args.num_sents)]
+    data = sents_to_vec(word_vec, sentences)
+    pad = np.zeros(args.num_dims)
+
+    corpus = Corpus(word_vec, sentences, args.device)
+    resident = Corpus(word_vec, sentences, args.device, resident=True)
+    batches = list(batch_index_iter(corpus.lengths, args.batch_size, shuffle=False))
+
+    ref, _ = to_input_tensor([data[i] for i in batches[0]], pad, device=args.device)
+    print('max abs difference %.3e' % (ref - corpus.batch(batches[0])[0]).abs().max().item())
+
+    def lists():
+        for batch_ids in batches:
+            to_input_tensor([data[i] for i in batch_ids], pad, device=args.device)
+
+    def gather(data_corpus):
+        def fn():
+            for batch_ids in batches:
+                data_corpus.batch(batch_ids)
+
+        return fn
+
+    baseline = measure(lists, args)
+    report('lists', baseline)
+    report('gather', measure(gather(corpus), args), baseline)
+    report('resident', measure(gather(resident), args), baseline)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    if args.bench == 'emission':
+        bench_emission(args)
+    elif args.bench == 'forward':
+        bench_forward(args)
+    elif args.bench == 'dmv':
+        bench_dmv(args)
+    elif args.bench == 'types':
+        bench_types(args)
+    elif args.bench == 'batching':
+        bench_batching(args)
+
+
+if __name__ == '__main__':
+    parse_args = init_config()
+    main(parse_args)
@@ -0,0 +1,46 @@
+from __future__ import print_function
+
+import argparse
+import pickle
+import time
+
+from modules import build_vector_store, iter_conll
+
+
+def init_config():
+    parser = argparse.ArgumentParser(description='convert pickled word vectors '
+                                                 'to a memory-mapped store')
+
+    parser.add_argument('--word_vec', type=str,
+                        help='the word vector file (cPickle saved file)')
+    parser.add_argument('--output', type=str, help='the output store directory')
+    parser.add_argument('--vocab_from', nargs='*', default=[],
+                        help='only keep the words of these CoNLL files')
+
+    args = parser.parse_args()
+
+    print(args)
+
+    return args
+
+
+def main(args):
+    begin_time = time.time()
+    word_vec = pickle.load(open(args.word_vec, 'rb'))
+    print('loaded %d word vectors in %.2f sec' % (len(word_vec), time.time() - begin_time))
+
+    if args.vocab_from:
+        vocab = set()
+        for fname in args.vocab_from:
+            for sent, _ in iter_conll(fname):
+                vocab.update(sent["word"])
+        word_vec = {word: word_vec[word] for word in vocab if word in word_vec}
+        print('kept %d words of %s' % (len(word_vec), ' '.join(args.vocab_from)))
+
+    build_vector_store(word_vec, args.output)
+    print('wrote %s in %.2f sec' % (args.output, time.time() - begin_time))
+
+
+if __name__ == '__main__':
+    parse_args = init_config()
+    main(parse_args)
@@ -2,7 +2,6 @@ from __future__ import print_function
 
 import argparse
 import os
-import pickle
 import sys
 import time
 
@@ -10,11 +9,11 @@ import numpy as np
 import torch
 
 import modules.dmv_flow_model as dmv
-from modules import data_iter, \
-    read_conll, \
-    sents_to_vec, \
-    sents_to_tagid, \
-    to_input_tensor, \
+from modules import Corpus, \
+    BatchLoader, \
+    load_word_vec, \
+    batch_index_iter, \
+    load_conll, \
     generate_seed
 
 
@@ -23,9 +22,12 @@ def init_config():
 
     # train and test data
     parser.add_argument('--word_vec', type=str,
-                        help='the word vector file (cPickle saved file)')
+                        help='the word vector file (cPickle saved file), '
+                             'or a directory converted by convert_word_vec.py')
     parser.add_argument('--train_file', type=str, help='train data')
     parser.add_argument('--test_file', default='', type=str, help='test data')
+    parser.add_argument('--data_cache', default='data_cache', type=str,
+                        help='directory of the compiled CoNLL files')
     parser.add_argument('--load_viterbi_dmv', type=str,
                         help='load pretrained DMV')
 
@@ -34,6 +36,17 @@ def init_config():
     parser.add_argument('--batch_size', default=32, type=int, help='batch_size')
     parser.add_argument('--lr', default=0.01, type=float, help='learning rate')
     parser.add_argument('--clip_grad', default=5., type=float, help='clip gradients')
+    parser.add_argument('--memory_budget', default=0, type=int,
+                        help='if > 0, training and test batches are sentences of similar length '
+                             'planned to fit this many MB of chart memory instead of batch_size '
+                             'sentences. --eval_all uses 2048 MB if not set')
+    parser.add_argument('--resident', action='store_true', default=False,
+                        help='keep the padded word ids of the whole corpus on the device')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='number of batches built ahead on a background thread, '
+                             '0 builds them in the training loop')
+    parser.add_argument('--num_threads', default=1, type=int,
+                        help='number of batches parsed concurrently in evaluation')
 
     # model config
     parser.add_argument('--model', choices=['gaussian', 'nice'], default='gaussian')
@@ -42,6 +55,13 @@ def init_config():
     parser.add_argument('--cell_layers', default=1, type=int,
                         help='number of cell layers of ReLU net in each coupling layer')
     parser.add_argument('--hidden_units', default=50, type=int, help='hidden units in ReLU Net')
+    parser.add_argument('--chart', choices=['span', 'split_head'], default='span',
+                        help='inside chart of training and validation, spans with their head '
+                             'position (O(n^4 K)), or split-head left and right halves '
+                             '(O(n^3 K + n^2 K^2)). --eval_all always uses split_head')
+    parser.add_argument('--type_cache', action='store_true', default=False,
+                        help='project and score each word type once per batch, '
+                             'and once per evaluation')
 
     # others
     parser.add_argument('--train_from', type=str, default='',
@@ -53,6 +73,14 @@ def init_config():
                         help='valid every n epochs')
     parser.add_argument('--eval_all', action='store_true', default=False,
                         help='if true, the script would evaluate on all lengths after training')
+    parser.add_argument('--prune_threshold', default=0., type=float,
+                        help='if > 0, --eval_all parses each sentence over its own symbols, '
+                             'those whose posterior given the word alone reaches this threshold '
+                             'at some word of the sentence, plus the best symbol of each word')
+    parser.add_argument('--prune_sweep', nargs='*', type=float, default=[],
+                        help='after training, evaluate on all lengths with each of these pruning '
+                             'thresholds and report the time and accuracy, e.g. '
+                             '--train_from model.pt --epochs 0 --prune_sweep 0 1e-3 1e-2 1e-1')
 
     # these are for slurm purpose to save model
     # they can also be used to run multiple random restarts with various settings,
@@ -84,46 +112,44 @@ def init_config():
 
 
 def main(args):
-    word_vec = pickle.load(open(args.word_vec, 'rb'))
+    word_vec = load_word_vec(args.word_vec)
     print('complete loading word vectors')
 
-    train_sents, _ = read_conll(args.train_file, max_len=10)
-    test_sents, _ = read_conll(args.test_file, max_len=10)
-    test_deps = [sent["head"] for sent in test_sents]
+    train_sents = load_conll(args.train_file, max_len=10, cache_dir=args.data_cache)
+    test_sents = load_conll(args.test_file, max_len=10, cache_dir=args.data_cache)
+    test_deps = test_sents.head_sents()
 
-    train_emb = sents_to_vec(word_vec, train_sents)
-    test_emb = sents_to_vec(word_vec, test_sents)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
 
-    num_dims = len(train_emb[0][0])
+    train_data = Corpus(word_vec, train_sents, device, resident=args.resident)
+    test_data = Corpus(word_vec, test_sents, device, resident=args.resident)
 
-    train_tagid, tag2id = sents_to_tagid(train_sents)
-    print(f'{len(tag2id):d} types of tags')
-    id2tag = {v: k for k, v in tag2id.items()}
+    num_dims = train_data.num_dims
 
-    pad = np.zeros(num_dims)
-    device = torch.device("cuda" if args.cuda else "cpu")
-    args.device = device
+    train_tagid = train_sents.tag_id_sents()
+    print(f'{len(train_sents.tags):d} types of tags')
+    id2tag = dict(enumerate(train_sents.tags))
 
     dmv_flow = dmv.DMVFlow(args, id2tag, num_dims).to(device)
 
-    init_seed = to_input_tensor(generate_seed(train_emb, args.batch_size),
-                                pad, device=device)
+    init_seed = train_data.batch(generate_seed(np.arange(len(train_data)), args.batch_size))
 
     with torch.no_grad():
-        dmv_flow.reset_parameters(init_seed, train_tagid, train_emb)
+        dmv_flow.reset_parameters(init_seed, train_tagid, train_data)
     print('complete init')
 
     if args.train_from != '':
         dmv_flow.load_state_dict(torch.load(args.train_from))
         with torch.no_grad():
-            directed, undirected = dmv_flow.test(test_deps, test_emb)
+            directed, undirected = dmv_flow.test(test_deps, test_data, num_threads=args.num_threads)
         print(f'acc on length <= 10: #trees {len(test_deps):d}, '
               f'undir {100 * undirected:2.1f}, '
               f'dir {100 * directed:2.1f}')
 
     optimizer = torch.optim.Adam(dmv_flow.parameters(), lr=args.lr)
 
-    log_niter = (len(train_emb) // args.batch_size) // 5
+    log_niter = (len(train_data) // args.batch_size) // 5
     report_ll = report_num_words = report_num_sents = epoch = train_iter = 0
     stop_avg_ll = stop_num_words = 0
     stop_avg_ll_last = 1
@@ -133,7 +159,7 @@ def main(args):
     print('begin training')
 
     with torch.no_grad():
-        directed, undirected = dmv_flow.test(test_deps, test_emb)
+        directed, undirected = dmv_flow.test(test_deps, test_data, num_threads=args.num_threads)
     print(
         f'starting acc on length <= 10: #trees {len(test_deps):d}, '
         f'undir {100 * undirected:2.1f}, '
@@ -141,16 +167,24 @@ def main(args):
 
     for epoch in range(args.epochs):
         report_ll = report_num_sents = report_num_words = 0
-        for sents in data_iter(train_emb, batch_size=args.batch_size):
-            batch_size = len(sents)
-            num_words = sum(len(sent) for sent in sents)
+        if args.memory_budget > 0:
+            batches = dmv_flow.plan_batches(train_data.lengths, args.memory_budget * 2 ** 20,
+                                            train=True, shuffle=True)
+        else:
+            batches = list(batch_index_iter(train_data.lengths, batch_size=args.batch_size))
+        flops = sum(dmv_flow.chart_cost(len(batch_ids), train_data.lengths[batch_ids].max(),
+                                        train=True)[1] for batch_ids in batches)
+        print(f'epoch {epoch:d}, {len(batches):d} batches, estimated chart {flops / 1e9:.2f} GFLOPs')
+        loader = BatchLoader(train_data, batches, num_prefetch=args.prefetch,
+                             types=args.type_cache)
+        for batch_ids, sents_var, masks, inverse in loader:
+            batch_size = len(batch_ids)
+            num_words = train_data.lengths[batch_ids].sum()
             stop_num_words += num_words
             optimizer.zero_grad()
 
-            sents_var, masks = to_input_tensor(sents, pad, device)
-            sents_var, _ = dmv_flow.flow_transform(sents_var)
-            sents_var = sents_var.transpose(0, 1)
-            log_likelihood = dmv_flow.p_inside(sents_var, masks)
+            density, _ = dmv_flow.log_density(sents_var, inverse)
+            log_likelihood = dmv_flow.p_inside(density, masks)
 
             avg_ll_loss = -log_likelihood / batch_size
 
@@ -175,7 +209,7 @@ def main(args):
             train_iter += 1
         if epoch % args.valid_nepoch == 0:
             with torch.no_grad():
-                directed, undirected = dmv_flow.test(test_deps, test_emb)
+                directed, undirected = dmv_flow.test(test_deps, test_data, num_threads=args.num_threads)
             print(
                 f'\n\nacc on length <= 10: #trees {len(test_deps):d}, '
                 f'undir {100 * undirected:2.1f}, '
@@ -185,7 +219,8 @@ def main(args):
         rate = (stop_avg_ll - stop_avg_ll_last) / abs(stop_avg_ll_last)
 
         print(f'\n\nlikelihood: {stop_avg_ll:.4f}, '
-              f'likelihood last: {stop_avg_ll_last:.4f}, rate: {rate:f}\n')
+              f'likelihood last: {stop_avg_ll_last:.4f}, rate: {rate:f}, '
+              f'waited for data {loader.wait_time:.2f} sec\n')
 
         if rate < 0.001 and epoch >= 5:
             break
@@ -196,14 +231,26 @@ def main(args):
     torch.save(dmv_flow.state_dict(), args.save_path)
 
     # eval on all lengths
+    if args.eval_all or args.prune_sweep:
+        test_sents = load_conll(args.test_file, cache_dir=args.data_cache)
+        test_deps = test_sents.head_sents()
+        test_data = Corpus(word_vec, test_sents, device, resident=args.resident)
+
+    for threshold in args.prune_sweep:
+        start_time = time.time()
+        with torch.no_grad():
+            directed, undirected = dmv_flow.test(test_deps, test_data, eval_all=True,
+                                                 threshold=threshold, num_threads=args.num_threads)
+        print(f'pruning threshold {threshold:g}: {time.time() - start_time:.2f} sec, '
+              f'undir: {100 * undirected:2.1f}, dir: {100 * directed:2.1f}')
+
     if args.eval_all:
-        test_sents, _ = read_conll(args.test_file)
-        test_deps = [sent["head"] for sent in test_sents]
-        test_emb = sents_to_vec(word_vec, test_sents)
         print("start evaluating on all lengths")
         with torch.no_grad():
-            directed, undirected = dmv_flow.test(test_deps, test_emb, eval_all=True)
-        print(f'accuracy on all lengths: number of trees:{len(test_gold):d}, '
+            directed, undirected = dmv_flow.test(test_deps, test_data, eval_all=True,
+                                                 threshold=args.prune_threshold,
+                                                 num_threads=args.num_threads)
+        print(f'accuracy on all lengths: number of trees:{len(test_deps):d}, '
               f'undir: {100 * undirected:2.1f}, dir: {100 * directed:2.1f}')
 
 
@@ -8,7 +8,7 @@ import time
 from collections import namedtuple
 
 import modules.dmv_viterbi_model as dmv
-from modules import read_conll, get_tag_set
+from modules import load_conll, get_tag_set
 
 
 def init_config():
@@ -23,6 +23,8 @@ def init_config():
     # data input
     parser.add_argument('--train_file', type=str, help='train data path')
     parser.add_argument('--test_file', type=str, help='test data path')
+    parser.add_argument('--data_cache', default='data_cache', type=str,
+                        help='directory of the compiled CoNLL files')
 
     # others
     parser.add_argument('--train_from', type=str, default='',
@@ -51,12 +53,12 @@ def init_config():
 
 
 def main(args):
-    train_sents, _ = read_conll(args.train_file)
-    test_sents, _ = read_conll(args.test_file, max_len=10)
+    train_sents = load_conll(args.train_file, cache_dir=args.data_cache)
+    test_sents = load_conll(args.test_file, max_len=10, cache_dir=args.data_cache)
 
-    train_tags = [sent["tag"] for sent in train_sents]
-    test_tags = [sent["tag"] for sent in test_sents]
-    test_deps = [sent["head"] for sent in test_sents]
+    train_tags = train_sents.tag_sents()
+    test_tags = test_sents.tag_sents()
+    test_deps = test_sents.head_sents()
 
     tag_set = get_tag_set(train_tags)
     print('%d tags' % len(tag_set))
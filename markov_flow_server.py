@@ -0,0 +1,399 @@
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+from modules import MarkovFlow, Corpus, VectorStore, load_word_vec
+from modules import load_conll, \
+    is_number, \
+    to_id_tensor, \
+    generate_seed
+
+
+def init_config():
+    parser = argparse.ArgumentParser(description='POS tagging server')
+
+    parser.add_argument('--word_vec', type=str,
+                        help='the word vector file (cPickle saved file), '
+                             'or a directory converted by convert_word_vec.py')
+    parser.add_argument('--train_file', type=str,
+                        help='data used to initialize the Gaussian variance, '
+                             'the same file as in training')
+    parser.add_argument('--data_cache', default='data_cache', type=str,
+                        help='directory of the compiled CoNLL files')
+    parser.add_argument('--tag_from', type=str, help='the trained model')
+
+    # model config, must match the trained model
+    parser.add_argument('--model', choices=['gaussian', 'nice'], default='gaussian')
+    parser.add_argument('--num_state', default=45, type=int,
+                        help='number of hidden states of z')
+    parser.add_argument('--couple_layers', default=4, type=int,
+                        help='number of coupling layers in NICE')
+    parser.add_argument('--cell_layers', default=1, type=int,
+                        help='number of cell layers of ReLU net in each coupling layer')
+    parser.add_argument('--forward', choices=['log', 'scaled', 'lean', 'scan'], default='log',
+                        help='forward algorithm used for the log likelihood')
+    parser.add_argument('--type_cache', action='store_true', default=False,
+                        help='score the whole vocabulary once at startup and '
+                             'look the densities up by word')
+
+    # serving
+    parser.add_argument('--port', default=0, type=int,
+                        help='serve on this localhost port, read stdin and write '
+                             'stdout if 0')
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help='max number of sentences in one micro-batch')
+    parser.add_argument('--max_delay', default=5.0, type=float,
+                        help='max milliseconds a request waits for its batch to fill')
+    parser.add_argument('--seed', default=5783287, type=int, help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+    args.device = torch.device("cuda" if args.cuda else "cpu")
+
+    # load the trained model like markov_flow_train.py --tag_from
+    args.load_nice = args.load_gaussian = ''
+    if args.model == 'nice':
+        args.load_nice = args.tag_from
+    else:
+        args.load_gaussian = args.tag_from
+
+    print(args, file=sys.stderr)
+
+    return args
+
+
+class Request(object):
+    """a sentence waiting to be tagged, callback is called
+    with the response dict from the batching thread. inputs are
+    word vectors, or vocabulary ids with the density table
+    """
+    def __init__(self, request_id, words, inputs, callback):
+        self.request_id = request_id
+        self.words = words
+        self.inputs = inputs
+        self.callback = callback
+        self.arrival = time.time()
+
+
+class TaggingServer(object):
+    """collect requests into micro-batches and tag them with one
+    model call per batch, a batch is run when it has batch_size
+    sentences or its first request has waited max_delay seconds
+
+    Args:
+        model: trained MarkovFlow
+        word_vec: dict mapping words to vectors
+        batch_size: max number of sentences in one batch
+        max_delay: max waiting time of a request in seconds
+        type_cache: precompute the emission densities of the
+            whole vocabulary
+
+    """
+    def __init__(self, model, word_vec, batch_size, max_delay, type_cache=False,
+                 num_latency=10000):
+        self.model = model
+        self.word_vec = word_vec
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        # the model is not trained while serving, normalize once
+        self.params = model.freeze()
+
+        self.vocab = self.table = None
+        if type_cache:
+            if isinstance(word_vec, VectorStore):
+                # the rows of a store are its sorted words, no lookup per word
+                words = word_vec.keys()
+                vectors = word_vec.vectors
+            else:
+                words = list(word_vec.keys())
+                vectors = np.array([word_vec[word] for word in words], dtype=np.float32)
+            self.vocab = {word: i for i, word in enumerate(words)}
+            self.table = self._density_table(vectors)
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.begin_time = time.time()
+        self.counters = collections.Counter()
+        self.batch_time = 0.0
+
+        # latencies of the recent requests in seconds
+        self.latency = collections.deque(maxlen=num_latency)
+
+        self.worker = threading.Thread(target=self._loop)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _density_table(self, vectors, chunk_size=65536):
+        """emission densities of all rows of vectors, scored in chunks
+        of rows so a memory-mapped store is read once in file order
+        and never copied whole
+
+        Returns: (num_types, num_state)
+
+        """
+        return torch.cat([self.model.density_table(
+            torch.tensor(np.asarray(vectors[i:i + chunk_size], dtype=np.float32),
+                         device=self.model.device))
+            for i in range(0, len(vectors), chunk_size)])
+
+    def submit(self, line, callback):
+        """handle one request line, tagging requests are queued and
+        answered from the batching thread, others are answered now
+
+        Request lines are JSON objects, {"words": [...], "id": ...}
+        to tag a sentence, or {"stats": true} for the counters
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as e:
+            self._reject(None, 'invalid request: %s' % e, callback)
+            return
+
+        request_id = request.get('id')
+        if request.get('stats'):
+            response = self.stats()
+            response['id'] = request_id
+            self._respond(callback, response)
+            return
+
+        words = request.get('words')
+        if not isinstance(words, list) or len(words) == 0 or \
+                not all(isinstance(word, str) for word in words):
+            self._reject(request_id, '"words" must be a non-empty list of strings',
+                         callback)
+            return
+
+        # numbers are mapped to '0' as read_conll does for the training data
+        keys = ['0' if is_number(word) else word for word in words]
+        vocab = self.vocab if self.vocab is not None else self.word_vec
+        unknown = [word for word, key in zip(words, keys) if key not in vocab]
+        if unknown:
+            self._reject(request_id, 'unknown words: %s' % ' '.join(unknown), callback)
+            return
+
+        if self.vocab is not None:
+            inputs = [self.vocab[key] for key in keys]
+        else:
+            inputs = [self.word_vec[key] for key in keys]
+
+        self.queue.put(Request(request_id, words, inputs, callback))
+
+    def _reject(self, request_id, message, callback):
+        with self.lock:
+            self.counters['errors'] += 1
+        self._respond(callback, {'id': request_id, 'error': message})
+
+    def _respond(self, callback, response):
+        # a failing callback must not stop the batching thread
+        # or the responses of the other requests in its batch
+        try:
+            callback(response)
+        except Exception as e:
+            with self.lock:
+                self.counters['callback_errors'] += 1
+            print('response to %s failed: %s' % (response.get('id'), e), file=sys.stderr)
+
+    def _input_tensor(self, inputs):
+        """pad the word vectors of a batch into one array
+
+        Returns: (sents, masks)
+            sents: (max_len, batch_size, num_dims)
+            masks: (max_len, batch_size)
+
+        """
+        lengths = [len(sent) for sent in inputs]
+        max_len = max(lengths)
+        sents = np.zeros((max_len, len(inputs), self.model.num_dims), dtype=np.float32)
+        for b, sent in enumerate(inputs):
+            sents[:lengths[b], b] = np.array(sent, dtype=np.float32)
+        masks = np.arange(max_len)[:, None] < np.array(lengths)[None, :]
+
+        return torch.tensor(sents, device=self.model.device), \
+            torch.tensor(masks, dtype=torch.float32, device=self.model.device)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_delay
+        while len(batch) < self.batch_size:
+            # requests already queued join the batch even after the deadline
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            begin_time = time.time()
+            try:
+                inputs = [request.inputs for request in batch]
+                if self.table is not None:
+                    ids, masks = to_id_tensor(inputs, self.model.device)
+                    tags, log_likelihood = self.model.tag_density(self.table[ids], masks, self.params)
+                else:
+                    sents_var, masks = self._input_tensor(inputs)
+                    tags, log_likelihood = self.model.tag(sents_var, masks, self.params)
+            except Exception as e:
+                for request in batch:
+                    self._reject(request.request_id, 'tagging failed: %s' % e,
+                                 request.callback)
+                continue
+
+            end_time = time.time()
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['sentences'] += len(batch)
+                self.counters['tokens'] += sum(len(request.words) for request in batch)
+                self.batch_time += end_time - begin_time
+                self.latency.extend(end_time - request.arrival for request in batch)
+
+            for request, seq_tags, seq_ll in zip(batch, tags, log_likelihood):
+                self._respond(request.callback,
+                              {'id': request.request_id,
+                               'tags': seq_tags.tolist(),
+                               'log_likelihood': float(seq_ll)})
+
+    def stats(self):
+        """throughput and latency counters since the server started"""
+        with self.lock:
+            elapsed = time.time() - self.begin_time
+            latency = 1000 * np.array(self.latency)
+            stats = {'uptime_sec': elapsed,
+                     'sentences': self.counters['sentences'],
+                     'tokens': self.counters['tokens'],
+                     'batches': self.counters['batches'],
+                     'errors': self.counters['errors'],
+                     'callback_errors': self.counters['callback_errors'],
+                     'queued': self.queue.qsize(),
+                     'sentences_per_sec': self.counters['sentences'] / elapsed,
+                     'tokens_per_sec': self.counters['tokens'] / elapsed,
+                     'mean_batch_size': self.counters['sentences'] /
+                                        float(max(self.counters['batches'], 1)),
+                     'mean_batch_ms': 1000 * self.batch_time /
+                                      max(self.counters['batches'], 1)}
+            if len(latency) > 0:
+                stats.update({'latency_mean_ms': latency.mean(),
+                              'latency_p50_ms': np.percentile(latency, 50),
+                              'latency_p95_ms': np.percentile(latency, 95),
+                              'latency_max_ms': latency.max()})
+
+        return stats
+
+
+def serve_lines(server, lines, write):
+    """answer each request line with one JSON response line, requests
+    are pipelined so consecutive lines can share a batch. Responses
+    are written in completion order and carry the request id
+    """
+    lock = threading.Condition()
+    outstanding = [0]
+
+    def callback(response):
+        with lock:
+            try:
+                write(json.dumps(response) + '\n')
+            finally:
+                outstanding[0] -= 1
+                lock.notify_all()
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        with lock:
+            outstanding[0] += 1
+        try:
+            server.submit(line, callback)
+        except Exception:
+            with lock:
+                outstanding[0] -= 1
+            raise
+
+    # wait for the pending responses before the stream is closed
+    with lock:
+        while outstanding[0] > 0:
+            lock.wait()
+
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        def write(text):
+            # the client may be gone, its responses are dropped
+            try:
+                self.wfile.write(text.encode('utf-8'))
+                self.wfile.flush()
+            except OSError:
+                pass
+
+        serve_lines(self.server.tagger,
+                    (line.decode('utf-8') for line in self.rfile),
+                    write)
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    word_vec = load_word_vec(args.word_vec)
+    print('complete loading word vectors', file=sys.stderr)
+
+    train_text = load_conll(args.train_file, cache_dir=args.data_cache)
+    train_data = Corpus(word_vec, train_text, args.device)
+    init_seed = train_data.batch(generate_seed(np.arange(len(train_data)), args.batch_size))
+
+    model = MarkovFlow(args, train_data.num_dims).to(args.device)
+    model.init_params(init_seed)
+    model.eval()
+
+    server = TaggingServer(model, word_vec, args.batch_size, args.max_delay / 1000.0,
+                           type_cache=args.type_cache)
+
+    if args.port == 0:
+        print('reading requests from stdin', file=sys.stderr)
+
+        def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        serve_lines(server, sys.stdin, write)
+    else:
+        tcp_server = ThreadingTCPServer(('127.0.0.1', args.port), StreamHandler)
+        tcp_server.tagger = server
+        print('serving on 127.0.0.1:%d' % args.port, file=sys.stderr)
+        try:
+            tcp_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            tcp_server.server_close()
+
+    print(json.dumps(server.stats()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parse_args = init_config()
+    main(parse_args)
@@ -3,17 +3,15 @@ from __future__ import print_function
 import argparse
 import numpy as np
 import os
-import pickle
 import sys
 import time
 import torch
 
-from modules import MarkovFlow
-from modules import read_conll, \
-    to_input_tensor, \
-    data_iter, \
-    generate_seed, \
-    sents_to_vec
+from modules import MarkovFlow, Corpus, BatchLoader, load_word_vec
+from modules import load_conll, \
+    batch_index_iter, \
+    padding_stats, \
+    generate_seed
 
 
 def init_config():
@@ -21,14 +19,32 @@ def init_config():
 
     # train and test data
     parser.add_argument('--word_vec', type=str,
-                        help='the word vector file (cPickle saved file)')
+                        help='the word vector file (cPickle saved file), '
+                             'or a directory converted by convert_word_vec.py')
     parser.add_argument('--train_file', type=str, help='train data')
     parser.add_argument('--test_file', default='', type=str, help='test data')
+    parser.add_argument('--data_cache', default='data_cache', type=str,
+                        help='directory of the compiled CoNLL files')
 
     # optimization parameters
     parser.add_argument('--batch_size', default=32, type=int, help='batch_size')
+    parser.add_argument('--bucket', action='store_true', default=False,
+                        help='batch sentences of similar length together')
+    parser.add_argument('--max_tokens', default=0, type=int,
+                        help='if > 0, fill batches up to this many padded tokens '
+                             'instead of batch_size sentences (implies --bucket)')
+    parser.add_argument('--resident', action='store_true', default=False,
+                        help='keep the padded word ids of the whole corpus on the device')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='number of batches built ahead on a background thread, '
+                             '0 builds them in the training loop')
+    parser.add_argument('--num_threads', default=1, type=int,
+                        help='number of batches tagged concurrently in evaluation')
     parser.add_argument('--epochs', default=50, type=int, help='number of training epochs')
     parser.add_argument('--lr', default=0.001, type=float, help='learning rate')
+    parser.add_argument('--train_mode', choices=['adam', 'em'], default='adam',
+                        help='gradient training with Adam, or closed-form Baum-Welch EM '
+                             '(Gaussian HMM only)')
 
     # model config
     parser.add_argument('--model', choices=['gaussian', 'nice'], default='gaussian')
@@ -39,6 +55,13 @@ def init_config():
     parser.add_argument('--cell_layers', default=1, type=int,
                         help='number of cell layers of ReLU net in each coupling layer')
     parser.add_argument('--hidden_units', default=50, type=int, help='hidden units in ReLU Net')
+    parser.add_argument('--forward', choices=['log', 'scaled', 'lean', 'scan'], default='log',
+                        help='forward algorithm, log space, rescaled probability space, '
+                             'log space with forward-backward gradients that only keep alphas, '
+                             'or a parallel prefix scan over timesteps (also used by Viterbi)')
+    parser.add_argument('--type_cache', action='store_true', default=False,
+                        help='project and score each word type once per batch, '
+                             'and once per evaluation')
 
     # pretrained model options
     parser.add_argument('--load_nice', default='', type=str,
@@ -64,6 +87,9 @@ def init_config():
     args = parser.parse_args()
     args.cuda = torch.cuda.is_available()
 
+    if args.train_mode == 'em' and args.model != 'gaussian':
+        parser.error('--train_mode em requires --model gaussian')
+
     save_dir = "dump_models/markov"
 
     if not os.path.exists(save_dir):
@@ -86,7 +112,7 @@ def init_config():
         torch.manual_seed(args.seed)
         if args.cuda:
             torch.cuda.manual_seed(args.seed)
-        np.random.seed(args.seed * 13 / 7)
+        np.random.seed(args.seed * 13 // 7)
 
     print(args)
 
@@ -94,33 +120,47 @@ def init_config():
 
 
 def main(args):
-    word_vec = pickle.load(open(args.word_vec, 'rb'))
+    word_vec = load_word_vec(args.word_vec)
     print('complete loading word vectors')
 
-    train_text, null_index = read_conll(args.train_file)
+    train_text = load_conll(args.train_file, cache_dir=args.data_cache)
     if args.test_file != '':
-        test_text, null_index = read_conll(args.test_file)
+        test_text = load_conll(args.test_file, cache_dir=args.data_cache)
     else:
         test_text = train_text
 
-    train_data = sents_to_vec(word_vec, train_text)
-    test_data = sents_to_vec(word_vec, test_text)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    train_data = Corpus(word_vec, train_text, device, resident=args.resident)
+    if args.test_file != '':
+        test_data = Corpus(word_vec, test_text, device, resident=args.resident)
+    else:
+        test_data = train_data
 
-    test_tags = [sent["tag"] for sent in test_text]
+    test_tags = test_text.tag_sents()
 
-    num_dims = len(train_data[0][0])
+    num_dims = train_data.num_dims
     print('complete reading data')
 
     print('#training sentences: %d' % len(train_data))
     print('#testing sentences: %d' % len(test_data))
 
-    log_niter = (len(train_data) // args.batch_size) // 10
+    train_lengths = train_data.lengths
 
-    pad = np.zeros(num_dims)
-    device = torch.device("cuda" if args.cuda else "cpu")
-    args.device = device
-    init_seed = to_input_tensor(generate_seed(train_data, args.batch_size),
-                                pad, device=device)
+    # padding of uniform batches, with its own random state to
+    # leave the training shuffle untouched
+    uniform_order = np.random.RandomState(0).permutation(len(train_data))
+    uniform_words, uniform_tokens = padding_stats(
+        train_lengths, [uniform_order[i: i + args.batch_size]
+                        for i in range(0, len(train_data), args.batch_size)])
+    uniform_pad = 1.0 - uniform_words / float(uniform_tokens)
+
+    num_batches = len(list(batch_index_iter(train_lengths, args.batch_size, shuffle=False,
+                                            bucket=args.bucket, max_tokens=args.max_tokens)))
+    log_niter = max(num_batches // 10, 1)
+
+    init_seed = train_data.batch(generate_seed(np.arange(len(train_data)), args.batch_size))
 
     model = MarkovFlow(args, num_dims).to(device)
 
@@ -129,10 +169,13 @@ def main(args):
     if args.tag_from != '':
         model.eval()
         with torch.no_grad():
-            accuracy, vm = model.test(test_data, test_tags, sentences=test_text,
-                                      tagging=True, path=args.tag_path, null_index=null_index)
-        print('\n***** M1 %f, VM %f, max_var %.4f, min_var %.4f*****\n'
-              % (accuracy, vm, model.var.data.max(), model.var.data.min()))
+            accuracy, one2one, vm = model.test(test_data, test_tags,
+                                               sentences=test_text.sentences(),
+                                               tagging=True, path=args.tag_path,
+                                               null_index=test_text.null_index(),
+                                               num_threads=args.num_threads)
+        print('\n***** M1 %f, 1-1 %f, VM %f, max_var %.4f, min_var %.4f*****\n'
+              % (accuracy, one2one, vm, model.var.data.max(), model.var.data.min()))
         return
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
@@ -145,21 +188,28 @@ def main(args):
     # print the accuracy under init params
     model.eval()
     with torch.no_grad():
-        accuracy, vm = model.test(test_data, test_tags)
-    print('\n*****starting M1 %f, VM %f, max_var %.4f, min_var %.4f*****\n'
-          % (accuracy, vm, model.var.data.max(), model.var.data.min()))
+        accuracy, one2one, vm = model.test(test_data, test_tags, num_threads=args.num_threads)
+    print('\n*****starting M1 %f, 1-1 %f, VM %f, max_var %.4f, min_var %.4f*****\n'
+          % (accuracy, one2one, vm, model.var.data.max(), model.var.data.min()))
+
+    if args.train_mode == 'em':
+        train_em(args, model, train_data, test_data, test_tags, begin_time)
+        return
 
     model.train()
     for epoch in range(args.epochs):
         # model.print_params()
         report_obj = report_jc = report_ll = report_num_words = 0
-        for sents in data_iter(train_data, batch_size=args.batch_size, shuffle=True):
+        batches = list(batch_index_iter(train_lengths, args.batch_size, shuffle=True,
+                                        bucket=args.bucket, max_tokens=args.max_tokens))
+        loader = BatchLoader(train_data, batches, num_prefetch=args.prefetch,
+                             types=args.type_cache)
+        for batch_ids, sents_var, masks, inverse in loader:
             train_iter += 1
-            batch_size = len(sents)
-            num_words = sum(len(sent) for sent in sents)
-            sents_var, masks = to_input_tensor(sents, pad, device=args.device)
+            batch_size = len(batch_ids)
+            num_words = train_lengths[batch_ids].sum()
             optimizer.zero_grad()
-            likelihood, jacobian_loss = model(sents_var, masks)
+            likelihood, jacobian_loss = model(sents_var, masks, inverse)
             neg_likelihood_loss = -likelihood
 
             avg_ll_loss = (neg_likelihood_loss + jacobian_loss) / batch_size
@@ -184,24 +234,53 @@ def main(args):
                                                               report_obj / report_num_words, model.var.max(), \
                                                               model.var.min(), time.time() - begin_time))
 
-        print('\nepoch %d, log_likelihood %.2f, jacobian %.2f, obj %.2f\n' % \
+        print('\nepoch %d, log_likelihood %.2f, jacobian %.2f, obj %.2f, '
+              'waited for data %.2f sec\n' % \
               (epoch, report_ll / report_num_words, report_jc / report_num_words,
-               report_obj / report_num_words))
+               report_obj / report_num_words, loader.wait_time))
+
+        epoch_words, epoch_tokens = padding_stats(train_lengths, batches)
+        epoch_pad = 1.0 - epoch_words / float(epoch_tokens)
+        print('epoch %d, %d batches, padding %.4f (uniform batches %.4f), padding saved %.4f\n' %
+              (epoch, len(batches), epoch_pad, uniform_pad,
+               1.0 - (epoch_tokens - epoch_words) / float(max(uniform_tokens - uniform_words, 1))))
 
         if epoch % args.valid_nepoch == 0:
             model.eval()
             with torch.no_grad():
-                accuracy, vm = model.test(test_data, test_tags)
-            print('\n*****epoch %d, iter %d, M1 %f, VM %f*****\n' %
-                  (epoch, train_iter, accuracy, vm))
+                accuracy, one2one, vm = model.test(test_data, test_tags, num_threads=args.num_threads)
+            print('\n*****epoch %d, iter %d, M1 %f, 1-1 %f, VM %f*****\n' %
+                  (epoch, train_iter, accuracy, one2one, vm))
             model.train()
 
         torch.save(model.state_dict(), args.save_path)
 
     model.eval()
     with torch.no_grad():
-        accuracy, vm = model.test(test_data, test_tags)
-    print('\n complete training, accuracy %f, vm %f\n' % (accuracy, vm))
+        accuracy, one2one, vm = model.test(test_data, test_tags, num_threads=args.num_threads)
+    print('\n complete training, accuracy %f, 1-1 %f, vm %f\n' % (accuracy, one2one, vm))
+
+
+def train_em(args, model, train_data, test_data, test_tags, begin_time):
+    num_words = train_data.lengths.sum()
+    for epoch in range(args.epochs):
+        log_likelihood = model.em_step(train_data, args.batch_size)
+
+        print('\nepoch %d, log_likelihood %.2f, max_var %.4f, min_var %.4f, '
+              'time elapsed %.2f sec\n' % (epoch, log_likelihood / num_words,
+                                          model.var.max(), model.var.min(),
+                                          time.time() - begin_time))
+
+        if epoch % args.valid_nepoch == 0:
+            with torch.no_grad():
+                accuracy, one2one, vm = model.test(test_data, test_tags, num_threads=args.num_threads)
+            print('\n*****epoch %d, M1 %f, 1-1 %f, VM %f*****\n' % (epoch, accuracy, one2one, vm))
+
+        torch.save(model.state_dict(), args.save_path)
+
+    with torch.no_grad():
+        accuracy, one2one, vm = model.test(test_data, test_tags, num_threads=args.num_threads)
+    print('\n complete training, accuracy %f, 1-1 %f, vm %f\n' % (accuracy, one2one, vm))
 
 
 if __name__ == '__main__':
@@ -1,5 +1,13 @@
+from .chart import *
+from .conll_data import *
+from .corpus import *
 from .dmv_flow_model import *
 from .dmv_viterbi_model import *
+from .emission import *
+from .evaluation import *
+from .inference import *
 from .markov_flow_model import *
 from .projection import *
+from .semiring import *
 from .utils import *
+from .vector_store import *
@@ -0,0 +1,197 @@
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def span_offsets(seq_length):
+    """spans of a chart are stored by width, the spans [i, i + l)
+    of width l are at offsets[l] + i
+
+    Returns: a list of seq_length + 2 offsets, offsets[-1] is
+        the number of spans
+
+    """
+    offsets = [0, 0]
+    for l in range(1, seq_length + 1):
+        offsets.append(offsets[-1] + seq_length - l + 1)
+    return offsets
+
+
+def cell_offsets(seq_length):
+    """(span, head) cells of a chart stored by width, a span of width
+    l has l heads, the cells of the spans [i, i + l) are at
+    offsets[l] + i * l + h for the head index h from the start
+
+    Returns: a list of seq_length + 2 offsets, offsets[-1] is
+        the number of cells
+
+    """
+    offsets = [0, 0]
+    for l in range(1, seq_length + 1):
+        offsets.append(offsets[-1] + (seq_length - l + 1) * l)
+    return offsets
+
+
+def index_dtype(max_value):
+    """smallest integer type that holds the indices 0..max_value,
+    used for backpointers
+    """
+    for dtype in [torch.uint8, torch.int16, torch.int32]:
+        if max_value <= torch.iinfo(dtype).max:
+            return dtype
+    return torch.long
+
+
+# the copies of the largest split intermediate alive at once while a
+# width is built: the stacked operand, the broadcast sum with the
+# dependent side and the stop term, and the shifted copy inside the
+# semiring sum. The backward pass of that width builds their gradients
+# after the forward copies are freed, so the count holds in training too
+SPLIT_COPIES = 3
+
+
+def _itemsize(dtype):
+    return torch.empty(0, dtype=dtype).element_size()
+
+
+def chart_cost(chart, batch_size, seq_length, num_state, train=True):
+    """estimated peak memory and floating point operations of the
+    DMVFlow chart of one batch, all sentences padded to seq_length.
+    The memory counts the elements of the tensors the chart builds:
+    the values of every width, what autograd keeps of them, the
+    backpointers of a parse and the split intermediates of the
+    largest width, see SPLIT_COPIES. The FLOPs count the elements
+    of the split intermediates
+
+    Args:
+        chart: 'span' or 'split_head'
+        train: with the saved tensors of the backward pass, otherwise
+            a Viterbi parse
+
+    Returns: (bytes, flops)
+
+    """
+    n, K = seq_length, num_state
+    value_size = _itemsize(torch.float32)
+
+    # number of spans, of (span, head) cells, and of the split
+    # intermediates of each chart
+    spans = n * (n + 1) // 2
+    cells = sum((n - l + 1) * l for l in range(1, n + 1))
+
+    # the symbol of a complete span attached to each head symbol,
+    # (batch_size, num_span, num_state, num_state) per width and direction
+    attach = K * K * spans
+    if chart == 'split_head':
+        # right, left (w) and full (w + 1) of each span [i, i + w]
+        splits = sum((n - w) * (3 * w + 1) for w in range(n))
+        largest_split = max((n - w) * (w + 1) for w in range(n))
+        flops = K * splits + 2 * K * K * spans
+
+        # right_ext, left_ext, right, left, full, dep_right and dep_left
+        # of every width
+        values = 7 * K * spans
+        if train:
+            # the exponentials of the semiring sums over the splits and
+            # over the dependent symbols
+            memory = value_size * (values + K * splits + 2 * attach)
+        else:
+            backpointers = K * spans * (3 * _itemsize(index_dtype(n)) +
+                                        2 * _itemsize(index_dtype(K)))
+            memory = value_size * (values + K * K * n) + backpointers
+    else:
+        # splits of one direction, both are built
+        splits = sum((n - l + 1) * (l - 1) * l for l in range(2, n + 1))
+        largest_split = max((n - l + 1) * (l - 1) * l for l in range(2, n + 1)) if n > 1 else 0
+        flops = 2 * K * splits + 2 * K * K * spans
+
+        # chart[0..2] of every cell and dependent[0..1] of every span
+        values = 3 * K * cells + 2 * K * spans
+        if train:
+            # the exponentials of the semiring sums over the splits of both
+            # directions, over the right stop of chart[1] and over the head
+            # position, and of the sums over the dependent symbols
+            memory = value_size * (values + 2 * K * splits + 3 * K * cells + 2 * attach)
+        else:
+            # the values are pooled buffers, the backpointers are split[0..1]
+            # and stop of every cell and dependent_index[0..1] of every span
+            backpointers = K * cells * (2 * _itemsize(index_dtype(n)) + _itemsize(torch.bool)) + \
+                2 * K * spans * _itemsize(index_dtype(K * n))
+            memory = value_size * (values + K * K * n) + backpointers
+
+    memory += value_size * SPLIT_COPIES * K * largest_split
+
+    if train:
+        # the backward pass
+        flops *= 3
+
+    return batch_size * memory, batch_size * flops
+
+
+class ChartPool(object):
+    """chart buffers reused across batches of the same (batch_size,
+    seq_length), the buffers of the max_shapes most recently used
+    shapes are kept. Buffers are handed out detached and are
+    overwritten by the next batch of the same shape, so a chart must
+    be consumed (and backpropagated) before the next one is built.
+    Each thread has its own buffers, so charts built concurrently
+    on one model do not overwrite each other
+
+    Args:
+        max_shapes: number of batch shapes kept per thread
+
+    """
+    def __init__(self, max_shapes=4):
+        self.max_shapes = max_shapes
+        self.lock = threading.Lock()
+
+        # thread id -> OrderedDict of the entries of each batch shape
+        self.entries = {}
+
+        # number of buffers allocated and reused
+        self.num_alloc = 0
+        self.num_reuse = 0
+
+    def clear(self):
+        """release the buffers of all threads"""
+        with self.lock:
+            self.entries = {}
+
+    def _entry(self, shape):
+        with self.lock:
+            entries = self.entries.setdefault(threading.get_ident(), OrderedDict())
+        entry = entries.pop(shape, None)
+        if entry is None:
+            entry = {}
+        entries[shape] = entry
+        while len(entries) > self.max_shapes:
+            entries.popitem(last=False)
+        return entry
+
+    def buffer(self, shape, name, size, dtype, device):
+        """an uninitialized tensor of size, owned by name for the
+        batch shape
+        """
+        entry = self._entry(shape)
+        key = (name, tuple(size), dtype, device)
+        if key not in entry:
+            entry[key] = torch.empty(size, dtype=dtype, device=device)
+            with self.lock:
+                self.num_alloc += 1
+        else:
+            with self.lock:
+                self.num_reuse += 1
+
+        return entry[key].detach()
+
+    def constant(self, shape, name, build):
+        """a tensor that only depends on the batch shape, built once
+        by calling build()
+        """
+        entry = self._entry(shape)
+        if name not in entry:
+            entry[name] = build()
+        return entry[name]
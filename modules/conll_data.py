@@ -0,0 +1,221 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .utils import ConllSent, iter_conll
+
+
+_ARRAYS = ['word_ids', 'tag_ids', 'offsets', 'positions', 'heads',
+           'token_offsets', 'null_pos', 'null_offsets']
+
+
+class ConllData(object):
+    """a CoNLL file compiled by compile_conll into columnar arrays,
+    the arrays are memory-mapped so loading reads nothing but the
+    vocabularies. Words and tags are numbered in order of first
+    occurrence, as by Corpus and sents_to_tagid
+
+    Token arrays (heads, positions) include the null elements
+    removed from the word and tag arrays, sentence i owns
+    word_ids[offsets[i]:offsets[i+1]] and
+    heads[token_offsets[i]:token_offsets[i+1]]
+
+    Args:
+        path: the compiled directory
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fin:
+            meta = json.load(fin)
+
+        self.source = meta['source']
+        self.words = meta['words']
+        self.tags = meta['tags']
+
+        # non-integer heads are stored as -1 - index into head_strings
+        self.head_strings = meta['head_strings']
+
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _head(self, head):
+        return head if head >= 0 else self.head_strings[-1 - head]
+
+    def tag_id_sents(self):
+        """tag ids of each sentence, like sents_to_tagid"""
+        return [self.tag_ids[self.offsets[i]:self.offsets[i + 1]] for i in range(len(self))]
+
+    def tag_sents(self):
+        """nested list of gold tags"""
+        tag_ids = self.tag_ids.tolist()
+        return [[self.tags[t] for t in tag_ids[self.offsets[i]:self.offsets[i + 1]]]
+                for i in range(len(self))]
+
+    def head_sents(self):
+        """nested list of (position, head) pairs, like sent["head"]"""
+        positions, heads = self.positions.tolist(), self.heads.tolist()
+        return [[(positions[k], self._head(heads[k]))
+                 for k in range(self.token_offsets[i], self.token_offsets[i + 1])]
+                for i in range(len(self))]
+
+    def null_index(self):
+        """positions of the removed null elements in each sentence"""
+        null_pos = self.null_pos.tolist()
+        return [null_pos[self.null_offsets[i]:self.null_offsets[i + 1]]
+                for i in range(len(self))]
+
+    def sentences(self):
+        """rebuild the ConllSent objects returned by read_conll"""
+        word_ids = self.word_ids.tolist()
+        sentences = []
+        for i, (tags, heads) in enumerate(zip(self.tag_sents(), self.head_sents())):
+            sent = ConllSent()
+            sent["word"] = [self.words[w] for w in word_ids[self.offsets[i]:self.offsets[i + 1]]]
+            sent["tag"] = tags
+            sent["head"] = heads
+            sentences.append(sent)
+
+        return sentences
+
+
+def conll_key(fname, max_len=1e3, rm_null=True, prc_num=True):
+    """hash of the file content and the read_conll options"""
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            sha.update(chunk)
+    sha.update(repr((float(max_len), bool(rm_null), bool(prc_num))).encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+class _ColumnWriter(object):
+    """append integers to a raw file in chunks, finish() turns
+    it into a .npy file without loading the column in memory
+    """
+    def __init__(self, fname, dtype, chunk_size=1 << 20):
+        self.fname = fname
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.fout = open(fname + '.raw', 'wb')
+        self.buffer = []
+        self.size = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        self.fout.write(np.array(self.buffer, dtype=self.dtype).tobytes())
+        self.size += len(self.buffer)
+        self.buffer = []
+
+    def finish(self):
+        self._flush()
+        self.fout.close()
+        output = np.lib.format.open_memmap(self.fname, mode='w+', dtype=self.dtype,
+                                           shape=(self.size,))
+        if self.size > 0:
+            raw = np.memmap(self.fname + '.raw', dtype=self.dtype, mode='r')
+            for i in range(0, self.size, self.chunk_size):
+                output[i:i + self.chunk_size] = raw[i:i + self.chunk_size]
+            del raw
+        output.flush()
+        del output
+        os.remove(self.fname + '.raw')
+
+
+def compile_conll(fname, path, max_len=1e3, rm_null=True, prc_num=True):
+    """parse a CoNLL file with iter_conll and write it as a
+    ConllData directory, the file is read in one streaming pass
+    and only the vocabularies are kept in memory
+
+    Args:
+        fname: the CoNLL file
+        path: the output directory
+
+    """
+    # write to a temporary directory first so that an interrupted
+    # compile is never picked up as a cache entry
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    os.makedirs(tmp_path)
+    columns = {name: _ColumnWriter(os.path.join(tmp_path, name + '.npy'),
+                                   np.int64 if name.endswith('offsets') else np.int32)
+               for name in _ARRAYS}
+    for name in ['offsets', 'token_offsets', 'null_offsets']:
+        columns[name].append(0)
+
+    vocab, tag_vocab, head_vocab = {}, {}, {}
+    num_words = num_tokens = num_null = 0
+    for sent, null_sent in iter_conll(fname, max_len=max_len, rm_null=rm_null,
+                                      prc_num=prc_num):
+        columns['word_ids'].extend(vocab.setdefault(word, len(vocab)) for word in sent["word"])
+        columns['tag_ids'].extend(tag_vocab.setdefault(tag, len(tag_vocab)) for tag in sent["tag"])
+        columns['positions'].extend(pos for pos, _ in sent["head"])
+        columns['heads'].extend(
+            head if isinstance(head, int) else -1 - head_vocab.setdefault(head, len(head_vocab))
+            for _, head in sent["head"])
+        columns['null_pos'].extend(null_sent)
+
+        num_words += len(sent["word"])
+        num_tokens += len(sent["head"])
+        num_null += len(null_sent)
+        columns['offsets'].append(num_words)
+        columns['token_offsets'].append(num_tokens)
+        columns['null_offsets'].append(num_null)
+
+    for column in columns.values():
+        column.finish()
+
+    meta = {'source': os.path.abspath(fname),
+            'options': {'max_len': max_len, 'rm_null': rm_null, 'prc_num': prc_num},
+            'words': list(vocab),
+            'tags': list(tag_vocab),
+            'head_strings': list(head_vocab)}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fout:
+        json.dump(meta, fout)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # compiled concurrently by another run
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+        for name in os.listdir(tmp_path):
+            os.remove(os.path.join(tmp_path, name))
+        os.rmdir(tmp_path)
+
+
+def load_conll(fname, max_len=1e3, rm_null=True, prc_num=True, cache_dir='data_cache'):
+    """read a CoNLL file through the compiled cache, the file is
+    compiled on first use and loaded memory-mapped afterwards
+
+    Args:
+        cache_dir: directory of the compiled files
+
+    Returns: ConllData
+
+    """
+    key = conll_key(fname, max_len=max_len, rm_null=rm_null, prc_num=prc_num)
+    path = os.path.join(cache_dir, '%s.%s' % (os.path.basename(fname), key))
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        compile_conll(fname, path, max_len=max_len, rm_null=rm_null, prc_num=prc_num)
+
+    return ConllData(path)
@@ -0,0 +1,216 @@
+from __future__ import print_function
+
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from .conll_data import ConllData
+from .emission import unique_types
+from .vector_store import VectorStore
+
+
+class Corpus(object):
+    """sentences stored as word ids into one embedding matrix,
+    padded batches are built with a single gather instead of
+    nested lists of vectors
+
+    Args:
+        word_vec: a dict mapping words to vectors, or a VectorStore
+        sentences: a list of ConllSent objects, or a ConllData
+        device: device of the embedding matrix and the batches
+        resident: keep the padded ids of the whole corpus on the
+            device, batches are then sliced from it by index
+
+    """
+    def __init__(self, word_vec, sentences, device, resident=False):
+        if isinstance(sentences, ConllData):
+            self.words = sentences.words
+            ids = sentences.word_ids
+            lengths = sentences.lengths
+        else:
+            vocab = {}
+            ids = [vocab.setdefault(word, len(vocab))
+                   for sent in sentences for word in sent["word"]]
+            self.words = list(vocab)
+            lengths = [len(sent["word"]) for sent in sentences]
+
+        self.device = device
+
+        # the row after the vocabulary is the zero padding vector
+        self.pad_id = len(self.words)
+        if isinstance(word_vec, VectorStore):
+            embedding = word_vec.extract(self.words)
+        else:
+            embedding = np.array([word_vec[word] for word in self.words], dtype=np.float32)
+        self.num_dims = embedding.shape[1]
+        embedding = np.concatenate((embedding, np.zeros((1, self.num_dims), dtype=np.float32)))
+
+        # (vocab_size + 1, num_dims)
+        self.embedding = torch.tensor(embedding, device=device)
+
+        # word ids of all sentences back to back, sentence i is
+        # ids[offsets[i]: offsets[i + 1]]
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+
+        self.resident = None
+        if resident:
+            # (max_len, num_sents)
+            padded, _ = self._padded_ids(np.arange(len(self)))
+            self.resident = torch.tensor(padded, device=device)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def sentence(self, index):
+        """word ids of a sentence"""
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def _padded_ids(self, batch_ids):
+        lengths = self.lengths[batch_ids]
+        max_len = lengths.max()
+
+        # (max_len, batch_size)
+        pos = np.arange(max_len)[:, None]
+        valid = pos < lengths[None, :]
+        index = np.where(valid, self.offsets[batch_ids][None, :] + pos, 0)
+        padded = np.where(valid, self.ids[index], self.pad_id).astype(np.int32)
+
+        return padded, valid
+
+    def id_batch(self, batch_ids):
+        """
+        Args:
+            batch_ids: indices of the sentences in the batch
+
+        Returns: (ids, masks)
+            ids: long tensor (max_len, batch_size), padded with pad_id
+            masks: (max_len, batch_size)
+
+        """
+        batch_ids = np.asarray(batch_ids, dtype=np.int64)
+        if self.resident is not None:
+            max_len = self.lengths[batch_ids].max()
+            ids = self.resident[:max_len, torch.tensor(batch_ids, device=self.device)].long()
+            return ids, (ids != self.pad_id).float()
+
+        padded, valid = self._padded_ids(batch_ids)
+        return torch.tensor(padded, dtype=torch.long, device=self.device), \
+            torch.tensor(valid, dtype=torch.float32, device=self.device)
+
+    def batch(self, batch_ids):
+        """
+        Args:
+            batch_ids: indices of the sentences in the batch
+
+        Returns: (sents, masks)
+            sents: (max_len, batch_size, num_dims)
+            masks: (max_len, batch_size)
+
+        """
+        ids, masks = self.id_batch(batch_ids)
+        return self.embedding[ids], masks
+
+    def type_batch(self, batch_ids):
+        """a batch as its distinct word types, see unique_types
+
+        Args:
+            batch_ids: indices of the sentences in the batch
+
+        Returns: (types, inverse, masks)
+            types: (num_types, num_dims)
+            inverse: long tensor (max_len, batch_size), the type
+                     index of every position
+            masks: (max_len, batch_size)
+
+        """
+        ids, masks = self.id_batch(batch_ids)
+        types, inverse = unique_types(ids, self.embedding)
+        return types, inverse, masks
+
+
+class BatchLoader(object):
+    """build the batches of a fixed batch order on a background
+    thread, up to num_prefetch batches ahead of the trainer. The
+    order is drawn by the caller, so shuffling stays in the main
+    random state
+
+    Args:
+        corpus: Corpus
+        batches: a list of arrays of sentence indices
+        num_prefetch: size of the queue of ready batches,
+            batches are built in the calling thread if 0
+        types: build the batches with Corpus.type_batch
+
+    Yields: (batch_ids, sents, masks, inverse)
+        inverse is None, with types sents are the word types
+        (num_types, num_dims) and inverse their index at every
+        position, see Corpus.type_batch
+
+    """
+    def __init__(self, corpus, batches, num_prefetch=2, types=False):
+        self.corpus = corpus
+        self.batches = batches
+        self.num_prefetch = num_prefetch
+        self.types = types
+
+        # seconds the consumer spent waiting for batches
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.num_prefetch <= 0:
+            for batch_ids in self.batches:
+                begin_time = time.time()
+                item = self._build(batch_ids)
+                self.wait_time += time.time() - begin_time
+                yield item
+            return
+
+        ready = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(ready, stop))
+        worker.daemon = True
+        worker.start()
+
+        try:
+            for _ in range(len(self.batches)):
+                begin_time = time.time()
+                item = ready.get()
+                self.wait_time += time.time() - begin_time
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # the consumer may stop early, unblock the worker
+            stop.set()
+            worker.join()
+
+    def _build(self, batch_ids):
+        if self.types:
+            types, inverse, masks = self.corpus.type_batch(batch_ids)
+            return batch_ids, types, masks, inverse
+
+        sents, masks = self.corpus.batch(batch_ids)
+        return batch_ids, sents, masks, None
+
+    def _produce(self, ready, stop):
+        for batch_ids in self.batches:
+            try:
+                item = self._build(batch_ids)
+            except Exception as e:
+                item = e
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or isinstance(item, Exception):
+                return
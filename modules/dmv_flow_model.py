@@ -2,18 +2,23 @@ from __future__ import print_function
 
 import math
 import pickle
-from collections import Counter
+from collections import Counter, namedtuple
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import Parameter
 
+from .chart import ChartPool, cell_offsets, chart_cost, index_dtype, span_offsets
+from .emission import diag_gaussian_log_density, \
+    gaussian_log_density_c
+from .evaluation import DepAccuracy, flatten_heads, pair_heads, print_by_length
+from .inference import map_batches
 from .projection import NICETrans
+from .semiring import LogSemiring, MaxSemiring
 from .utils import log_sum_exp, \
-    unravel_index, \
-    data_iter, \
-    to_input_tensor, \
+    batch_index_iter, \
     stable_math_log
 
 NEG_INFINITY = -1e20
@@ -35,6 +40,11 @@ def log_softmax(input, dim):
     return input - log_sum_exp(input, dim=dim, keepdim=True).expand_as(input)
 
 
+# the normalized log probabilities read by the charts, see DMVFlow.freeze
+DMVParams = namedtuple('DMVParams', ['log_attach_left', 'log_attach_right', 'log_stop_right',
+                                     'log_stop_left', 'log_root_attach_left'])
+
+
 class DMVFlow(nn.Module):
     def __init__(self, args, ids, num_dims):
         super(DMVFlow, self).__init__()
@@ -72,11 +82,15 @@ class DMVFlow(nn.Module):
 
         self.root_attach_left = Parameter(torch.Tensor(self.num_state))
 
-    def reset_parameters(self, init_seed, train_tagid, train_emb):
+        # chart buffers of p_inside and dep_parse
+        self.chart_pool = ChartPool()
+
+    def reset_parameters(self, init_seed, train_tagid, train_data):
         """
         init_seed:(sents, masks)
         sents: (seq_length, batch_size, features)
         masks: (seq_length, batch_size)
+        train_data: Corpus
 
         """
 
@@ -107,7 +121,7 @@ class DMVFlow(nn.Module):
                              dim=0) / masks.sum()
 
         self.var.copy_(seed_var)
-        self.reset_mean(train_tagid, train_emb)
+        self.reset_mean(train_tagid, train_data)
 
         load_model = pickle.load(open(self.args.load_viterbi_dmv, 'rb'))
         for i in range(self.num_state):
@@ -137,15 +151,14 @@ class DMVFlow(nn.Module):
             self.root_attach_left[i] = load_model.tita \
                 .val(('attach_left', self.ids[i], 'END'))
 
-    def reset_mean(self, train_tagid, train_emb):
-        pad = np.zeros(self.num_dims)
+    def reset_mean(self, train_tagid, train_data):
         emb_dict = {}
         cnt_dict = Counter()
-        for sents, tagid_sents in data_iter(list(zip(train_emb, train_tagid)), \
-                                            batch_size=self.args.batch_size, \
-                                            is_test=True, \
-                                            shuffle=False):
-            sents_var, masks = to_input_tensor(sents, pad, self.device)
+        for batch_ids in batch_index_iter(train_data.lengths,
+                                          batch_size=self.args.batch_size,
+                                          shuffle=False):
+            tagid_sents = [train_tagid[i] for i in batch_ids]
+            sents_var, masks = train_data.batch(batch_ids)
             sents_var, _ = self.flow_transform(sents_var)
             sents_var = sents_var.transpose(0, 1)
             for tagid_sent, emb_sent in zip(tagid_sents, sents_var):
@@ -173,647 +186,787 @@ class DMVFlow(nn.Module):
 
         return x, jacobian_loss
 
-    def tree_to_depset(self, root_max_index, sent_len):
+    def log_density(self, sents, inverse=None):
+        """emission log densities of word vectors before the projection.
+        Given inverse, sents are the word types of the batch, e.g. from
+        Corpus.type_batch, the projection and the densities are computed
+        once per type and gathered back
+
+        Args:
+            sents: (seq_length, batch_size, num_dims), or
+                   (num_types, num_dims) with inverse
+            inverse: long tensor (seq_length, batch_size), the type
+                     index of every position
+
+        Returns: (density, jacobian_loss)
+            density: (batch_size, seq_length, num_state)
+
         """
+        log_density_c = self._calc_log_density_c()
+
+        if inverse is not None:
+            types, jacobian_loss = self.flow_transform(sents)
+            return self._eval_log_density(types, log_density_c)[inverse.t()], jacobian_loss
+
+        sents, jacobian_loss = self.flow_transform(sents)
+        return self._eval_log_density(sents.transpose(0, 1), log_density_c), jacobian_loss
+
+    def density_table(self, types):
+        """emission log densities of a set of word types, computed once
+        for a fixed checkpoint and then gathered by type index
+
         Args:
-            root_max_index: (batch_size, 2)
+            types: (num_types, num_dims), word vectors before the projection
+
+        Returns: (num_types, num_state)
+
         """
-        # add the root symbol (-1)
-        batch_size = root_max_index.size(0)
-        dep_list = []
-        for batch in range(batch_size):
-            res = {(root_max_index[batch, 1], -1)}
-            start = 0
-            end = sent_len[batch]
-            res.update(self._tree_to_depset(start, end, 2, batch, root_max_index[batch, 0],
-                                            root_max_index[batch, 1]))
-            assert len(res) == sent_len[batch]
-            dep_list += [sorted(res)]
-
-        return dep_list
-
-    def _tree_to_depset(self, start, end, mark, batch, symbol, index):
-        left_child = self.left_child[start, end, mark][batch, symbol, index]
-        right_child = self.right_child[start, end, mark][batch, symbol, index]
-
-        if left_child[0] == 1 and right_child[0] == 1:
-            if mark == 0:
-                assert left_child[3] == 0
-                assert right_child[3] == 2
-                arg = right_child[-1]
-            elif mark == 1:
-                assert left_child[3] == 2
-                assert right_child[3] == 1
-                arg = left_child[-1]
-            res = {(arg, index)}
-            res.update(self._tree_to_depset(left_child[1].item(), left_child[2].item(),
-                                            left_child[3].item(), batch, left_child[4].item(),
-                                            left_child[5].item()), \
-                       self._tree_to_depset(right_child[1].item(), right_child[2].item(),
-                                            right_child[3].item(), batch, right_child[4].item(),
-                                            right_child[5].item()))
-
-        elif left_child[0] == 1 and right_child[0] == 0:
-            res = self._tree_to_depset(left_child[1].item(), left_child[2].item(),
-                                       left_child[3].item(), batch, left_child[4].item(),
-                                       left_child[5].item())
-        elif left_child[0] == -1 and right_child[0] == -1:
-            res = set()
+        with torch.no_grad():
+            types, _ = self.flow_transform(types)
+            return self._eval_log_density(types, self._calc_log_density_c())
 
-        else:
-            raise ValueError
+    def chart_cost(self, batch_size, seq_length, chart=None, train=False):
+        """estimated (bytes, flops) of a batch, see chart.chart_cost"""
+        return chart_cost(chart or self.args.chart, batch_size, seq_length, self.num_state, train)
+
+    def plan_batches(self, lengths, memory_budget, chart=None, train=False, shuffle=False):
+        """length-homogeneous batches that fit the chart memory
+        estimate of chart_cost into memory_budget bytes
+
+        Returns: a list of numpy arrays of sentence indices
+
+        """
+        def cost(batch_size, seq_length):
+            return self.chart_cost(batch_size, seq_length, chart, train)[0]
 
-        return res
+        return list(batch_index_iter(lengths, self.args.batch_size, shuffle=shuffle,
+                                     max_cost=memory_budget, cost=cost))
 
-    def test(self, gold, test_emb, eval_all=False):
+    def test(self, gold, test_data, eval_all=False, threshold=0., num_threads=1):
         """
         Args:
             gold: A nested list of heads
-            all_len: True if evaluate on all lengths
+            test_data: Corpus
+            eval_all: True if evaluate on all lengths, sentences are then
+                parsed with the split-head chart in batches planned by
+                plan_batches
+            threshold: pruning threshold of dep_parse, see prune_states
+            num_threads: batches parsed concurrently with the parameters
+                of freeze, on the shared pool of map_batches. The memory
+                budget is divided among them
         """
-        pad = np.zeros(self.num_dims)
-        cnt = 0
-        dir_cnt = 0.0
-        undir_cnt = 0.0
-        memory_sent_cnt = 0
-
-        batch_id_ = 0
+        # long sentences are only affordable with the split-head chart
+        chart = 'split_head' if eval_all else None
+        memory_budget = self.args.memory_budget * 2 ** 20
+        if eval_all and memory_budget <= 0:
+            memory_budget = 2 ** 31
+
+        if memory_budget > 0:
+            batches = self.plan_batches(test_data.lengths, memory_budget // num_threads, chart=chart)
+        else:
+            batches = list(batch_index_iter(test_data.lengths, batch_size=self.args.batch_size,
+                                            shuffle=False))
 
-        if eval_all:
-            batch_size = 10
+        if self.args.type_cache:
+            # emission table of the corpus vocabulary, computed once per call
+            table = self.density_table(test_data.embedding)
         else:
-            batch_size = self.args.batch_size
+            table = None
 
-        for sents, gold_batch in data_iter(list(zip(test_emb, gold)),
-                                           batch_size=batch_size,
-                                           is_test=True,
-                                           shuffle=False):
+        gold_heads, offsets = flatten_heads([pair_heads(gold_s) for gold_s in gold])
+        parse_heads = np.full(len(gold_heads), -1, dtype=np.int64)
 
+        params = self.freeze()
+        num_alloc, num_reuse = self.chart_pool.num_alloc, self.chart_pool.num_reuse
+
+        def parse_batch(batch_ids):
+            return self._parse_batch(test_data, batch_ids, table, chart, threshold, params)
+
+        num_split = 0
+        for batch_id_, (batch_ids, (parse, num_retry)) in enumerate(
+                zip(batches, map_batches(parse_batch, batches, num_threads))):
             if eval_all and batch_id_ % 10 == 0:
-                print(f'batch {batch_id_:d}')
-                print(f'total length: {cnt:d}')
-                print(f'correct directed: {dir_cnt:d}')
-            batch_id_ += 1
-            try:
-                sents_var, masks = to_input_tensor(sents, pad, self.device)
-                sents_var, _ = self.flow_transform(sents_var)
-                sents_var = sents_var.transpose(0, 1)
-                # root_max_index: (batch_size, num_state, seq_length)
-                batch_size, seq_length, _ = sents_var.size()
-                symbol_index_t = self.attach_left.new([[[p, q] for q in range(seq_length)] \
-                                                       for p in range(self.num_state)]) \
-                    .expand(batch_size, self.num_state, seq_length, 2)
-                root_max_index = self.dep_parse(sents_var, masks, symbol_index_t)
-                batch_size = masks.size(1)
-                sent_len = [torch.sum(masks[:, i]).item() for i in range(batch_size)]
-                parse = self.tree_to_depset(root_max_index, sent_len)
-            except RuntimeError:
-                memory_sent_cnt += 1
-                print(f'batch {batch_id_:d} out of memory')
-                continue
-
-            for gold_s, parse_s in zip(gold_batch, parse):
-                assert len(gold_s) == len(parse_s)
-                length = len(gold_s)
-                if len(gold_s) > 1:
-                    (directed, undirected) = self.measures(gold_s, parse_s)
-                    cnt += length
-                    dir_cnt += directed
-                    undir_cnt += undirected
-
-        dir_acu = dir_cnt / cnt
-        undir_acu = undir_cnt / cnt
-
-        self.log_p_parse = {}
-        self.left_child = {}
-        self.right_child = {}
+                print(f'batch {batch_id_:d} of {len(batches):d}')
+
+            num_split += num_retry
+
+            for batch_id, parse_s in zip(batch_ids, parse):
+                parse_s = parse_s[parse_s >= 0]
+                assert len(parse_s) == offsets[batch_id + 1] - offsets[batch_id]
+                parse_heads[offsets[batch_id]:offsets[batch_id + 1]] = parse_s
+
+        # the backpointer buffers are not kept after the evaluation
+        self.chart_pool.clear()
+
+        accuracy = DepAccuracy()
+        accuracy.update(parse_heads, gold_heads, offsets)
 
         if eval_all:
-            print(f'{memory_sent_cnt:d} batches out of memory')
+            print(f'{len(batches):d} batches, {num_split:d} split after running out of memory')
+            print(f'chart buffers: {self.chart_pool.num_alloc - num_alloc:d} allocated, '
+                  f'{self.chart_pool.num_reuse - num_reuse:d} reused')
+            print(f'root acc {100 * accuracy.root():2.1f}')
+            print_by_length(accuracy)
 
-        return dir_acu, undir_acu
+        return accuracy.directed(), accuracy.undirected()
+
+    def _parse_batch(self, test_data, batch_ids, table, chart, threshold, params):
+        """dep_parse of a batch, a batch that runs out of memory is
+        split in halves until it fits, so no sentence is dropped
+
+        Returns: (heads, number of splits), heads is a list of the
+            rows of dep_parse in the order of batch_ids
 
-    @staticmethod
-    def measures(gold_s, parse_s):
-        # Helper for eval().
-        (d, u) = (0, 0)
-        for (a, b) in gold_s:
-            (a, b) = (a - 1, b - 1)
-            b1 = (a, b) in parse_s
-            b2 = (b, a) in parse_s
-            if b1:
-                d += 1.0
-                u += 1.0
-            if b2:
-                u += 1.0
-
-        return d, u
-
-    def _eval_log_density(self, sent):
+        """
+        try:
+            if table is not None:
+                ids, masks = test_data.id_batch(batch_ids)
+                density = table[ids.t()]
+            else:
+                sents_var, masks = test_data.batch(batch_ids)
+                density, _ = self.log_density(sents_var)
+            return list(self.dep_parse(density, masks, chart=chart, threshold=threshold, params=params)), 0
+        except RuntimeError as e:
+            if 'memory' not in str(e) or len(batch_ids) == 1:
+                raise
+
+        print(f'batch of {len(batch_ids):d} sentences out of memory, split in halves')
+        half = len(batch_ids) // 2
+        head_parse, head_split = self._parse_batch(test_data, batch_ids[:half], table, chart, threshold, params)
+        tail_parse, tail_split = self._parse_batch(test_data, batch_ids[half:], table, chart, threshold, params)
+        return head_parse + tail_parse, head_split + tail_split + 1
+
+    def _eval_log_density(self, sent, log_density_c):
         """
         Args:
             sent: A tensor with size (batch_size, seq_length, features)
+            log_density_c: see _calc_log_density_c
 
         Returns:
             density: (batch_size, seq_length, num_state)
 
         """
-        batch_size, seq_length, features = sent.size()
-        ep_size = torch.Size([batch_size, seq_length, self.num_state, features])
-        means = self.means.view(1, 1, self.num_state, features).expand(ep_size)
-        words = sent.unsqueeze(dim=2).expand(ep_size)
-        var = self.var.expand(ep_size)
-        return self.log_density_c - 0.5 * torch.sum((means - words) ** 2 / var, dim=3)
+        return diag_gaussian_log_density(sent, self.means, self.var, log_density_c)
 
     def _calc_log_density_c(self):
-        return -self.num_dims / 2.0 * (math.log(2 * math.pi)) - 0.5 * torch.sum(torch.log(self.var))
+        return gaussian_log_density_c(self.num_dims, self.var)
+
+    def _normalize_params(self):
+        """DMVParams of the current parameters, differentiable"""
+        return DMVParams(log_softmax(self.attach_left, dim=1),
+                         log_softmax(self.attach_right, dim=1),
+                         log_softmax(self.stop_right, dim=0),
+                         log_softmax(self.stop_left, dim=0),
+                         log_softmax(self.root_attach_left, dim=0))
+
+    def freeze(self):
+        """normalized parameters of the model as it is now, computed
+        once and passed to dep_parse for any number of batches. The
+        charts only read them and keep their state in local values,
+        so batches can be parsed concurrently on one model
+        """
+        with torch.no_grad():
+            return self._normalize_params()
+
+    def _chart_index(self, seq_length):
+        """masks of the adjacent head of each span width l, heads are
+        indexed from the start of their span
+
+        adj_split_right, adj_split_left: (l - 1, 1, l), True at the head
+            that is adjacent to the split point k = i + a, a - 1 when
+            attaching to the right and a when attaching to the left
+        adj_end_right, adj_end_left: (1, l), True at the last and the
+            first head of the span
 
-    def p_inside(self, sents, masks):
         """
+        index = [None]
+        for l in range(1, seq_length + 1):
+            head = torch.arange(l, device=self.device)
+            split = torch.arange(1, l, device=self.device).view(-1, 1, 1)
+            index.append({'adj_split_right': head == split - 1,
+                          'adj_split_left': head == split,
+                          'adj_end_right': (head == l - 1).unsqueeze(0),
+                          'adj_end_left': (head == 0).unsqueeze(0)})
+
+        return index
+
+    @staticmethod
+    def _width_views(flat, seq_length, head=True):
+        """split a chart buffer into the blocks of each span width
+
         Args:
-            sents: A tensor with size (batch_size, seq_length, features)
-            masks: (seq_length, batch_size)
+            flat: (..., num_cells * num_state) if head, (..., num_spans * num_state)
+                otherwise, see cell_offsets
 
-        Variable clarification:
-            p_inside[i, j] is the prob of w_i, w_i+1, ..., w_j-1
-            rooted at any possible nonterminals
+        Returns: a list indexed by width l of views with size
+            (..., seq_length - l + 1, num_state, l) if head, or
+            (..., seq_length - l + 1, num_state)
 
-        node marks clarification:
-            0: no marks (right first)
-            1: right stop mark
-            2: both left and right stop marks
+        """
+        offsets = cell_offsets(seq_length) if head else span_offsets(seq_length)
+        num_state = flat.size(-1) // offsets[-1]
+        views = [None]
+        for l in range(1, seq_length + 1):
+            block = flat[..., offsets[l] * num_state:offsets[l + 1] * num_state]
+            size = (seq_length - l + 1, num_state, l) if head else (seq_length - l + 1, num_state)
+            views.append(block.view(*flat.size()[:-1], *size))
+
+        return views
+
+    def _split_operands(self, chart, dependent, l, attach):
+        """the two halves [i, k) and [k, j) of all spans [i, i + l) and
+        split points k = i + a, heads are moved to the index space of
+        the span [i, j)
+
+        Returns: (log_p1, log_p2)
+            the head side with size (batch_size, num_span, l - 1, num_state, l)
+            the dependent side with size (batch_size, num_span, l - 1, num_state)
 
         """
+        num_span = chart[1].size(1) - l + 1
+        if attach == 'right':
+            # the head is in [i, k), padded on the right
+            head = [F.pad(chart[a][:, :num_span], (0, l - a), value=NEG_INFINITY)
+                    for a in range(1, l)]
+            dep = [dependent[l - a][:, a:a + num_span] for a in range(1, l)]
+        else:
+            # the head is in [k, j), padded on the left
+            head = [F.pad(chart[l - a][:, a:a + num_span], (a, 0), value=NEG_INFINITY)
+                    for a in range(1, l)]
+            dep = [dependent[a][:, :num_span] for a in range(1, l)]
+
+        return torch.stack(head, dim=2), torch.stack(dep, dim=2)
+
+    def p_inside(self, density, masks, chart=None):
+        """log likelihood of a batch with the inside chart selected by
+        chart, or args.chart if not given
 
-        self.log_density_c = self._calc_log_density_c()
+        Args:
+            density: emission log densities with size
+                     (batch_size, seq_length, num_state), see log_density
+            masks: (seq_length, batch_size)
+            chart: 'span' or 'split_head'
 
-        # normalizing parameters
-        self.log_attach_left = log_softmax(self.attach_left, dim=1)
-        self.log_attach_right = log_softmax(self.attach_right, dim=1)
-        self.log_stop_right = log_softmax(self.stop_right, dim=0)
-        self.log_stop_left = log_softmax(self.stop_left, dim=0)
-        self.log_root_attach_left = log_softmax(self.root_attach_left, dim=0)
+        """
+        params = self._normalize_params()
+        if (chart or self.args.chart) == 'split_head':
+            return self._split_head_p_inside(density, masks, params)
+        return self._span_p_inside(density, masks, params)
 
-        # (batch_size, seq_length, num_state)
-        density = self._eval_log_density(sents)
-        constant = density.max().item()
+    def dep_parse(self, density, masks, chart=None, threshold=0., params=None):
+        """Viterbi parse with the chart selected as in p_inside
 
-        # indexed by (start, end, mark)
-        # each element is a tensor with size (batch_size, num_state, seq_length)
-        self.log_p_inside = {}
-        # n = len(s)
+        Args:
+            threshold: if > 0, the chart only runs over the symbols kept
+                by prune_states, those of each sentence with split_head
+                and those of the whole batch with span
+            params: DMVParams from freeze, computed here if not given
 
-        batch_size, seq_length, _ = sents.size()
+        Returns: heads with size (batch_size, seq_length), a numpy array
+            of 1-based head positions as in CoNLL files, 0 is the root and
+            -1 pads the positions past the sentence length
 
-        for i in range(seq_length):
-            j = i + 1
-            cat_var = [torch.zeros((batch_size, self.num_state, 1),
-                                   dtype=torch.float32,
-                                   device=self.device).fill_(NEG_INFINITY) for _ in range(seq_length)]
+        """
+        chart = chart or self.args.chart
+        if params is None:
+            params = self.freeze()
+        if threshold > 0:
+            keep, valid = self.prune_states(density, masks, threshold)
+            if chart == 'split_head':
+                # the padding symbols emit nothing, so no parse uses them
+                density = density.gather(2, keep.unsqueeze(1).expand(-1, density.size(1), -1))
+                density = density.masked_fill(~valid.unsqueeze(1), NEG_INFINITY)
+            else:
+                keep = keep[valid].unique()
+                density = density[:, :, keep]
+            params = self._restrict_params(params, keep)
+
+        if chart == 'split_head':
+            return self._split_head_dep_parse(density, masks, params)
+        return self._span_dep_parse(density, masks, params)
+
+    def prune_states(self, density, masks, threshold):
+        """coarse pass of dep_parse, the symbols of each sentence whose
+        posterior under the emission model alone, p(symbol | word) with
+        a uniform prior, reaches threshold at some word. The best symbol
+        of every word is always kept so the sentence stays parsable. The
+        chart costs grow with the number of symbols, O(n^3 K + n^2 K^2)
+        for split_head, so a small kept set speeds up the parse
 
-            cat_var[i] = density[:, i, :].unsqueeze(dim=2)
-            self.log_p_inside[i, j, 0] = torch.cat(cat_var, dim=2)
-            self.unary_p_inside(i, j, batch_size, seq_length)
+        Args:
+            density: (batch_size, seq_length, num_state)
+            masks: (seq_length, batch_size)
 
-        log_stop_right = self.log_stop_right[0]
-        log_stop_left = self.log_stop_left[0]
+        Returns: (keep, valid) with size (batch_size, max_keep), the kept
+            symbols of each sentence padded to the largest kept set, and
+            the mask of the symbols that are not padding
 
-        # TODO(junxian): ideally, only the l loop is needed
-        # but eliminate the rest loops would be a bit hard
-        for l in range(2, seq_length + 1):
-            for i in range(seq_length - l + 1):
-                j = i + l
-                log_p1 = []
-                log_p2 = []
-                index = torch.zeros((seq_length, j - i - 1), dtype=torch.long,
-                                    device=self.device, requires_grad=False)
-                # right attachment
-                for k in range(i + 1, j):
-                    log_p1.append(self.log_p_inside[i, k, 0].unsqueeze(-1))
-                    log_p2.append(self.log_p_inside[k, j, 2].unsqueeze(-1))
-                    index[k - 1, k - i - 1] = 1
-
-                log_p1 = torch.cat(log_p1, dim=-1)
-                log_p2 = torch.cat(log_p2, dim=-1)
-                index = index.unsqueeze(0).expand(self.num_state, *index.size())
-
-                # (num_state, seq_len, k)
-                log_stop_right_gather = torch.gather(
-                    log_stop_right.unsqueeze(-1).expand(*log_stop_right.size(), j - i - 1),
-                    1, index)
-
-                # log_p_tmp[b, i, m, j, n] = log_p1[b, i, m] + log_p2[b, j, n] + stop_right[0, i, m==k-1]
-                # + attach_right[i, j]
-                # log_p_tmp = log_p1_ep + log_p2_ep + log_attach_right + log_stop_right_gather
-
-                # to save memory, first marginalize out j and n
-                # (b, i, j, k) -> (b, i, k)
-                log_p2_tmp = log_sum_exp(log_p2.unsqueeze(1), dim=3) + \
-                             self.log_attach_right.view(1, *(self.log_attach_right.size()), 1)
-                log_p2_tmp = log_sum_exp(log_p2_tmp, dim=2)
-
-                # (b, i, m, k)
-                log_p_tmp = log_p1 + log_p2_tmp.unsqueeze(2) + log_stop_right_gather.unsqueeze(0)
-
-                self.log_p_inside[i, j, 0] = log_sum_exp(log_p_tmp, dim=-1)
-
-                # left attachment
-                log_p1 = []
-                log_p2 = []
-                index = torch.zeros((seq_length, j - i - 1), dtype=torch.long,
-                                    device=self.device, requires_grad=False)
-                for k in range(i + 1, j):
-                    log_p1.append(self.log_p_inside[i, k, 2].unsqueeze(-1))
-                    log_p2.append(self.log_p_inside[k, j, 1].unsqueeze(-1))
-                    index[k, k - i - 1] = 1
-
-                log_p1 = torch.cat(log_p1, dim=-1)
-                log_p2 = torch.cat(log_p2, dim=-1)
-                index = index.unsqueeze(0).expand(self.num_state, *index.size())
-
-                log_stop_left_gather = torch.gather(
-                    log_stop_left.unsqueeze(-1).expand(*log_stop_left.size(), j - i - 1),
-                    1, index)
-
-                # log_p_tmp[b, i, m, j, n] = log_p1[b, i, m] + log_p2[b, j, n] + stop_left[0, j, n==k]
-                # + self.attach_left[j, i]
-
-                # to save memory, first marginalize out j and n
-                # (b, i, j, k) -> (b, j, k)
-                log_p1_tmp = log_sum_exp(log_p1.unsqueeze(2), dim=3) + \
-                             self.log_attach_left.permute(1, 0).view(1, *(self.log_attach_left.size()), 1)
-                log_p1_tmp = log_sum_exp(log_p1_tmp, dim=1)
-
-                # (b, j, n, k)
-                log_p_tmp = log_p1_tmp.unsqueeze(2) + log_p2 + log_stop_left_gather.unsqueeze(0)
-                self.log_p_inside[i, j, 1] = log_sum_exp(log_p_tmp, dim=-1)
-
-                self.unary_p_inside(i, j, batch_size, seq_length)
-
-        # calculate log likelihood
-        sent_len_t = masks.sum(dim=0).detach()
-        log_p_sum = []
-        for i in range(batch_size):
-            sent_len = sent_len_t[i].item()
-            log_p_sum += [self.log_p_inside[0, sent_len, 2][i].unsqueeze(dim=0)]
-        log_p_sum_cat = torch.cat(log_p_sum, dim=0)
-
-        log_root = log_p_sum_cat + self.log_root_attach_left.view(1, self.num_state, 1).expand_as(log_p_sum_cat)
-
-        return torch.sum(log_sum_exp(log_root.view(batch_size, -1), dim=1))
-
-    def dep_parse(self, sents, masks, symbol_index_t):
         """
+        posterior = log_softmax(density, dim=2).exp()
+        words = masks.t().unsqueeze(2) > 0
+        is_best = posterior == torch.max(posterior, dim=2, keepdim=True)[0]
+        # (batch_size, num_state)
+        keep = (((posterior >= threshold) | is_best) & words).any(dim=1)
+
+        # the kept symbols first, in increasing order
+        valid, keep_id = torch.sort(keep.int(), dim=1, descending=True, stable=True)
+        max_keep = valid.sum(dim=1).max().item()
+        return keep_id[:, :max_keep], valid[:, :max_keep] > 0
+
+    @staticmethod
+    def _restrict_params(params, keep):
+        """DMVParams of the symbols in keep, the others are pruned.
+        The attachments are not renormalized, so a parse has the same
+        score as in the full chart
+
         Args:
-            sents: tensor with size (batch_size, seq_length, features)
-        Returns:
-            returned t is a nltk.tree.Tree without root node
+            keep: the kept symbols of the batch with size (max_keep,),
+                or of each sentence with size (batch_size, max_keep),
+                then the parameters get a batch dimension in front of
+                the symbols, which only the split-head chart supports
         """
+        return DMVParams(params.log_attach_left[keep.unsqueeze(-1), keep.unsqueeze(-2)],
+                         params.log_attach_right[keep.unsqueeze(-1), keep.unsqueeze(-2)],
+                         params.log_stop_right[:, keep],
+                         params.log_stop_left[:, keep],
+                         params.log_root_attach_left[keep])
 
-        self.log_density_c = self._calc_log_density_c()
-
-        # normalizing parameters
-        self.log_attach_left = log_softmax(self.attach_left, dim=1)
-        self.log_attach_right = log_softmax(self.attach_right, dim=1)
-        self.log_stop_right = log_softmax(self.stop_right, dim=0)
-        self.log_stop_left = log_softmax(self.stop_left, dim=0)
-        self.log_root_attach_left = log_softmax(self.root_attach_left, dim=0)
-
-        # (batch_size, seq_length, num_state)
-        density = self._eval_log_density(sents)
-
-        # in the parse case, log_p_parse[i, j, mark] is not the log prob
-        # of some symbol as head, instead it is the prob of the most likely
-        # subtree with some symbol as head
-        self.log_p_parse = {}
-
-        # child is indexed by (i, j, mark), and each element is a
-        # LongTensor with size (batch_size, symbol, seq_length, 6)
-        # the last dimension represents the child's
-        # (indicator, i, j, mark, symbol, index), used to index the child,
-        # indicator is 1 represents childs exist, 0 not exist, -1 means
-        # reaching terminal symbols. For unary connection, left child indicator
-        # is 1 and right child indicator is 0 (for non-terminal symbols)
-        self.left_child = {}
-        self.right_child = {}
-
-        batch_size, seq_length, _ = sents.size()
-
-        for i in range(seq_length):
-            j = i + 1
-            cat_var = [torch.zeros((batch_size, self.num_state, 1),
-                                   dtype=torch.float32,
-                                   device=self.device).fill_(NEG_INFINITY) for _ in range(seq_length)]
-            cat_var[i] = density[:, i, :].unsqueeze(dim=2)
-            self.log_p_parse[i, j, 0] = torch.cat(cat_var, dim=2)
-            self.left_child[i, j, 0] = torch.zeros((batch_size, self.num_state, seq_length, 6),
-                                                   dtype=torch.long,
-                                                   device=self.device).fill_(-1)
-            self.right_child[i, j, 0] = torch.zeros((batch_size, self.num_state, seq_length, 6),
-                                                    dtype=torch.long,
-                                                    device=self.device).fill_(-1)
-            self.unary_parses(i, j, batch_size, seq_length, symbol_index_t)
-
-        log_stop_right = self.log_stop_right[0]
-        log_stop_left = self.log_stop_left[0]
-
-        # ideally, only the l loop is needed
-        # but eliminate the rest loops would be a bit hard
-        for l in range(2, seq_length + 1):
-            for i in range(seq_length - l + 1):
-                j = i + l
-
-                # right attachment
-                log_p1 = []
-                log_p2 = []
-                index = torch.zeros((seq_length, j - i - 1), dtype=torch.long,
-                                    device=self.device, requires_grad=False)
-                for k in range(i + 1, j):
-                    # right attachment
-                    log_p1.append(self.log_p_parse[i, k, 0].unsqueeze(-1))
-                    log_p2.append(self.log_p_parse[k, j, 2].unsqueeze(-1))
-                    index[k - 1, k - i - 1] = 1
-
-                log_p1 = torch.cat(log_p1, dim=-1)
-                log_p2 = torch.cat(log_p2, dim=-1)
-                index = index.unsqueeze(0).expand(self.num_state, *index.size())
-
-                # (num_state, seq_len, k)
-                log_stop_right_gather = torch.gather(
-                    log_stop_right.unsqueeze(-1).expand(*log_stop_right.size(), j - i - 1),
-                    1, index)
-
-                # log_p2_tmp: (b, j, k)
-                # max_index_loc: (b, j, k)
-                log_p2_tmp, max_index_loc = torch.max(log_p2, 2)
-
-                # log_p2_tmp: (b, i, k)
-                # max_index_symbol: (b, i, k)
-                log_p2_tmp, max_index_symbol = torch.max(log_p2_tmp.unsqueeze(1) +
-                                                         self.log_attach_right.view(1, *(self.log_attach_right.size()),
-                                                                                    1), 2)
-
-                # (b, i, m, k)
-                log_p_tmp = log_p1 + log_p2_tmp.unsqueeze(2) + log_stop_right_gather.unsqueeze(0)
-
-                # log_p_max: (batch_size, num_state, seq_length)
-                # max_index_k: (batch_size, num_state, seq_length)
-                log_p_max, max_index_k = torch.max(log_p_tmp, dim=-1)
-                self.log_p_parse[i, j, 0] = log_p_max
-
-                # (b, j, k) --> (b, i, k)
-                max_index_loc = torch.gather(max_index_loc, index=max_index_symbol, dim=1)
-
-                # (b, i, k) --> (b, i, m)
-                max_index_symbol = torch.gather(max_index_symbol, index=max_index_k, dim=2)
-                max_index_loc = torch.gather(max_index_loc, index=max_index_k, dim=2)
-
-                # (batch_size, num_state, seq_len, 3)
-                max_index_r = torch.cat((max_index_k.unsqueeze(-1),
-                                         max_index_symbol.unsqueeze(-1),
-                                         max_index_loc.unsqueeze(-1)), dim=-1)
-
-                # left attachment
-                log_p1 = []
-                log_p2 = []
-                index = torch.zeros((seq_length, j - i - 1), dtype=torch.long,
-                                    device=self.device, requires_grad=False)
-                for k in range(i + 1, j):
-                    log_p1.append(self.log_p_parse[i, k, 2].unsqueeze(-1))
-                    log_p2.append(self.log_p_parse[k, j, 1].unsqueeze(-1))
-                    index[k, k - i - 1] = 1
-
-                log_p1 = torch.cat(log_p1, dim=-1)
-                log_p2 = torch.cat(log_p2, dim=-1)
-                index = index.unsqueeze(0).expand(self.num_state, *index.size())
-
-                # (num_state, seq_len, k)
-                log_stop_left_gather = torch.gather(
-                    log_stop_left.unsqueeze(-1).expand(*log_stop_left.size(), j - i - 1),
-                    1, index)
-
-                # log_p1_tmp: (b, i, k)
-                # max_index_loc: (b, i, k)
-                log_p1_tmp, max_index_loc = torch.max(log_p1, 2)
-
-                # log_p1_tmp: (b, j, k)
-                # max_index_symbol: (b, j, k)
-                log_p1_tmp, max_index_symbol = torch.max(log_p1_tmp.unsqueeze(2) +
-                                                         self.log_attach_left.permute(1, 0).view(1, *(
-                                                             self.log_attach_left.size()), 1), 1)
-
-                # (b, j, n, k)
-                log_p_tmp = log_p1_tmp.unsqueeze(2) + log_p2 + log_stop_left_gather.unsqueeze(0)
-
-                # log_p_max: (batch_size, num_state, seq_length)
-                # max_index_k: (batch_size, num_state, seq_length)
-                log_p_max, max_index_k = torch.max(log_p_tmp, dim=-1)
-                self.log_p_parse[i, j, 1] = log_p_max
-
-                # (b, i, k) --> (b, j, k)
-                max_index_loc = torch.gather(max_index_loc, index=max_index_symbol, dim=1)
-
-                # (b, j, k) --> (b, j, m)
-                max_index_symbol = torch.gather(max_index_symbol, index=max_index_k, dim=2)
-                max_index_loc = torch.gather(max_index_loc, index=max_index_k, dim=2)
-
-                # (batch_size, num_state, seq_len, 3)
-                max_index_l = torch.cat((max_index_k.unsqueeze(-1),
-                                         max_index_symbol.unsqueeze(-1),
-                                         max_index_loc.unsqueeze(-1)), dim=-1)
-
-                right_child_index_r = index.new(batch_size, self.num_state, seq_length, 6)
-                left_child_index_r = index.new(batch_size, self.num_state, seq_length, 6)
-                right_child_index_l = index.new(batch_size, self.num_state, seq_length, 6)
-                left_child_index_l = index.new(batch_size, self.num_state, seq_length, 6)
-                # assign symbol and index
-                right_child_index_r[:, :, :, 4:] = max_index_r[:, :, :, 1:]
-
-                # left_child_symbol_index: (num_state, seq_length, 2)
-                left_child_symbol_index_r = symbol_index_t
-
-                left_child_index_r[:, :, :, 4:] = left_child_symbol_index_r
-
-                right_child_symbol_index_l = symbol_index_t
-
-                right_child_index_l[:, :, :, 4:] = right_child_symbol_index_l
-                left_child_index_l[:, :, :, 4:] = max_index_l[:, :, :, 1:]
-
-                # assign indicator
-                right_child_index_r[:, :, :, 0] = 1
-                left_child_index_r[:, :, :, 0] = 1
+    def _span_chart(self, density, params, semiring, backpointer=None, values=None):
+        """inside chart of spans with their head position in a
+        semiring, about O(n^4 K) per sentence. LogSemiring gives the
+        inside probabilities and MaxSemiring the Viterbi scores
 
-                right_child_index_l[:, :, :, 0] = 1
-                left_child_index_l[:, :, :, 0] = 1
-
-                # assign starting point
-                right_child_index_r[:, :, :, 1] = max_index_r[:, :, :, 0] + i + 1
-                left_child_index_r[:, :, :, 1] = i
-
-                right_child_index_l[:, :, :, 1] = max_index_l[:, :, :, 0] + i + 1
-                left_child_index_l[:, :, :, 1] = i
+        Args:
+            density: emission log densities with size
+                     (batch_size, seq_length, num_state), see log_density
+            params: DMVParams
+            semiring: LogSemiring or MaxSemiring, see semiring.py
+            backpointer: with a selective semiring, the width views of the
+                backpointer buffers of _span_dep_parse that are filled
+                with the argmax choices
+            values: without autograd, the width views of pooled buffers
+                that hold chart and dependent, see _span_dep_parse
+
+        Variable clarification:
+            chart[mark][l] is the prob of the spans [i, i + l)
+            rooted at any possible nonterminals and head positions
+
+        node marks clarification:
+            0: no marks (right first)
+            1: right stop mark
+            2: both left and right stop marks
 
-                # assign end point
-                right_child_index_r[:, :, :, 2] = j
-                left_child_index_r[:, :, :, 2] = max_index_r[:, :, :, 0] + i + 1
-
-                right_child_index_l[:, :, :, 2] = j
-                left_child_index_l[:, :, :, 2] = max_index_l[:, :, :, 0] + i + 1
+        Returns: chart
 
-                right_child_index_r[:, :, :, 3] = 2
-                left_child_index_r[:, :, :, 3] = 0
+        """
+        batch_size, seq_length, _ = density.size()
+        index = self.chart_pool.constant((batch_size, seq_length), 'index',
+                                         lambda: self._chart_index(seq_length))
 
-                right_child_index_l[:, :, :, 3] = 1
-                left_child_index_l[:, :, :, 3] = 2
-
-                assert (i, j, 0) not in self.left_child
-                self.left_child[i, j, 0] = left_child_index_r
-                self.right_child[i, j, 0] = right_child_index_r
-
-                self.left_child[i, j, 1] = left_child_index_l
-                self.right_child[i, j, 1] = right_child_index_l
+        # chart[mark][l] holds the spans of width l, a tensor with size
+        # (batch_size, seq_length - l + 1, num_state, l) indexed by
+        # (start, head symbol, head index - start). The widths are kept
+        # as separate tensors rather than slices of one preallocated chart,
+        # the backward of every read from a single chart tensor would
+        # materialize a gradient of the whole chart
+        chart = [[None] * (seq_length + 1) for _ in range(3)]
 
-                self.unary_parses(i, j, batch_size, seq_length, symbol_index_t)
+        # dependent[0][l] and dependent[1][l] are the complete spans of width
+        # l attached as a right or left dependent to each head symbol,
+        # (batch_size, seq_length - l + 1, num_state), see _span_unary
+        dependent = [[None] * (seq_length + 1) for _ in range(2)]
 
-        log_p_sum = []
-        sent_len_t = masks.sum(dim=0)
-        for i in range(batch_size):
-            sent_len = sent_len_t[i].item()
-            log_p_sum += [self.log_p_parse[0, sent_len, 2][i].unsqueeze(dim=0)]
-        log_p_sum_cat = torch.cat(log_p_sum, dim=0)
-        log_root = log_p_sum_cat + self.log_root_attach_left.view(1, self.num_state, 1) \
-            .expand_as(log_p_sum_cat)
-        log_root_max, root_max_index = torch.max(log_root.view(batch_size, -1), dim=1)
+        store = self._chart_store(chart, dependent, values)
 
-        # (batch_size, 2)
-        root_max_index = unravel_index(root_max_index, (self.num_state, seq_length))
+        # terminals, [i, i + 1) is headed by i
+        store('chart', 0, 1, density.unsqueeze(3))
+        self._span_unary(store, chart, index, params, semiring, backpointer, 1)
 
-        return root_max_index
+        for l in range(2, seq_length + 1):
+            # all spans [i, i + l) of this width split at every k, the
+            # right attachment takes the head of [k, j) as a right dependent
+            # of the head of [i, k)
+            # (batch_size, num_span, l - 1, num_state, l)
+            log_p1, log_p2 = self._split_operands(chart[0], dependent[0], l, 'right')
+            log_stop_right = self._adjacent(params.log_stop_right[0], index[l]['adj_split_right'])
+            log_p_tmp = log_p1 + log_p2.unsqueeze(4) + log_stop_right
+            log_p, split = semiring.argsum(log_p_tmp, dim=2)
+            store('chart', 0, l, log_p)
+            if backpointer is not None:
+                backpointer['split'][0][l].copy_(split)
+
+            # left attachment, the head of [k, j) takes the head of [i, k)
+            # as its left dependent
+            log_p2, log_p1 = self._split_operands(chart[1], dependent[1], l, 'left')
+            log_stop_left = self._adjacent(params.log_stop_left[0], index[l]['adj_split_left'])
+            log_p_tmp = log_p1.unsqueeze(4) + log_p2 + log_stop_left
+            log_p, split = semiring.argsum(log_p_tmp, dim=2)
+            store('chart', 1, l, log_p)
+            if backpointer is not None:
+                backpointer['split'][1][l].copy_(split)
+
+            self._span_unary(store, chart, index, params, semiring, backpointer, l)
+
+        return chart
 
-    def unary_p_inside(self, i, j, batch_size, seq_length):
+    @staticmethod
+    def _chart_store(chart, dependent, values):
+        """a function store(name, i, l, value) that sets chart[i][l] or
+        dependent[i][l]. With values, the value is copied into the pooled
+        buffer of that cell and the buffer is kept instead, so a Viterbi
+        chart reuses the same memory for every batch of a shape
+        """
+        tables = {'chart': chart, 'dependent': dependent}
 
-        non_stop_mark = self.log_p_inside[i, j, 0]
-        log_stop_left = self.log_stop_left[1].expand(batch_size, self.num_state, 2)
-        log_stop_right = self.log_stop_right[1].expand(batch_size, self.num_state, 2)
+        def store(name, i, l, value):
+            if values is not None:
+                value = values[name][i][l].copy_(value)
+            tables[name][i][l] = value
 
-        index_ladj = torch.zeros(
-            (batch_size, self.num_state, seq_length),
-            dtype=torch.long, device=self.device, requires_grad=False)
-        index_radj = torch.zeros(
-            (batch_size, self.num_state, seq_length),
-            dtype=torch.long, device=self.device, requires_grad=False)
+        return store
 
-        index_ladj[:, :, i].fill_(1)
-        index_radj[:, :, j - 1].fill_(1)
+    @staticmethod
+    def _adjacent(log_stop, adj):
+        """select the adjacent or nonadjacent stop probability of
+        each head index
 
-        log_stop_right = torch.gather(log_stop_right, 2, index_radj)
-        inter_right_stop_mark = non_stop_mark + log_stop_right
+        Args:
+            log_stop: (num_state, 2), dim1: 0 is nonadjacent, 1 is adjacent
+            adj: (..., 1, l), True at the adjacent head index
 
-        if (i, j, 1) in self.log_p_inside:
-            right_stop_mark = self.log_p_inside[i, j, 1]
-            right_stop_mark = torch.cat([
-                right_stop_mark.unsqueeze(dim=3),
-                inter_right_stop_mark.unsqueeze(dim=3),
-            ], dim=3)
-            right_stop_mark = log_sum_exp(right_stop_mark, dim=3)
+        Returns: (..., num_state, l)
 
+        """
+        return torch.where(adj, log_stop[:, 1:], log_stop[:, :1])
+
+    def _span_unary(self, store, chart, index, params, semiring, backpointer, l):
+        """close the spans of width l with stop decisions, right
+        first and then left. The attachment of a complete span to
+        any head symbol only depends on the span, so the dependent
+        position and symbol are marginalized out here once per span
+        instead of once per split. The cells are set by store,
+        see _chart_store
+        """
+        # (num_state, l)
+        log_stop_right = self._adjacent(params.log_stop_right[1], index[l]['adj_end_right'])
+        log_stop_left = self._adjacent(params.log_stop_left[1], index[l]['adj_end_left'])
+
+        inter_right_stop_mark = chart[0][l] + log_stop_right
+        if chart[1][l] is not None:
+            right_stop_mark = torch.stack([chart[1][l], inter_right_stop_mark], dim=4)
+            right_stop_mark, stop = semiring.argsum(right_stop_mark, dim=4)
         else:
-            right_stop_mark = inter_right_stop_mark
-
-        log_stop_left = torch.gather(log_stop_left, 2, index_ladj)
-        self.log_p_inside[i, j, 2] = right_stop_mark + log_stop_left
-        self.log_p_inside[i, j, 1] = right_stop_mark
+            right_stop_mark, stop = inter_right_stop_mark, None
 
-    def unary_parses(self, i, j, batch_size, seq_length, symbol_index_t):
-        non_stop_mark = self.log_p_parse[i, j, 0]
-        log_stop_left = self.log_stop_left[1].expand(batch_size, self.num_state, 2)
-        log_stop_right = self.log_stop_right[1].expand(batch_size, self.num_state, 2)
+        store('chart', 1, l, right_stop_mark)
+        store('chart', 2, l, right_stop_mark + log_stop_left)
 
-        index_ladj = torch.zeros(
-            (batch_size, self.num_state, seq_length),
-            dtype=torch.long, device=self.device, requires_grad=False)
-        index_radj = torch.zeros(
-            (batch_size, self.num_state, seq_length),
-            dtype=torch.long, device=self.device, requires_grad=False)
+        # (batch_size, num_span, num_state)
+        log_p_span, head = semiring.argsum(chart[2][l], dim=3)
 
-        left_child_index_mark2 = index_ladj.new(batch_size, self.num_state, seq_length, 6)
-        right_child_index_mark2 = index_ladj.new(batch_size, self.num_state, seq_length, 6)
-        left_child_index_mark1 = index_ladj.new(batch_size, self.num_state, seq_length, 6)
-        right_child_index_mark1 = index_ladj.new(batch_size, self.num_state, seq_length, 6)
+        # dim0 of log_attach_* is the head symbol
+        log_p_right, symbol_right = semiring.argsum(log_p_span.unsqueeze(2) + params.log_attach_right, dim=3)
+        log_p_left, symbol_left = semiring.argsum(log_p_span.unsqueeze(2) + params.log_attach_left, dim=3)
+        store('dependent', 0, l, log_p_right)
+        store('dependent', 1, l, log_p_left)
 
-        index_ladj[:, :, i].fill_(1)
-        index_radj[:, :, j - 1].fill_(1)
+        if backpointer is not None:
+            if stop is None:
+                backpointer['stop'][l].fill_(True)
+            else:
+                backpointer['stop'][l].copy_(stop == 1)
 
-        log_stop_right = torch.gather(log_stop_right, 2, index_radj)
-        inter_right_stop_mark = non_stop_mark + log_stop_right
+            # (batch_size, num_span, head symbol)
+            for direction, symbol in enumerate([symbol_right, symbol_left]):
+                backpointer['dependent_index'][direction][l].copy_(symbol * l + torch.gather(head, 2, symbol))
 
-        # assign indicator
-        left_child_index_mark1[:, :, :, 0] = 1
-        right_child_index_mark1[:, :, :, 0] = 0
+    def _span_root_scores(self, chart, masks, params):
+        """(batch_size, num_state * seq_length), the trees over each whole
+        sentence attached to the root, indexed by symbol * seq_length + head
+        """
+        batch_size, seq_length = chart[0][1].size()[:2]
+        sent_len_t = masks.sum(dim=0).long().detach()
 
-        # assign mark
-        left_child_index_mark1[:, :, :, 3] = 0
-        right_child_index_mark1[:, :, :, 3] = 0
+        # (batch_size, num_state, seq_length), the spans [0, length)
+        log_p_sum_cat = torch.stack([F.pad(chart[2][l][:, 0], (0, seq_length - l), value=NEG_INFINITY)
+                                     for l in range(1, seq_length + 1)], dim=1)
+        log_p_sum_cat = log_p_sum_cat[torch.arange(batch_size, device=self.device), sent_len_t - 1]
 
-        # start point
-        left_child_index_mark1[:, :, :, 1] = i
-        right_child_index_mark1[:, :, :, 1] = i
+        log_root = log_p_sum_cat + params.log_root_attach_left.view(1, -1, 1).expand_as(log_p_sum_cat)
+        return log_root.view(batch_size, -1)
 
-        # end point
-        left_child_index_mark1[:, :, :, 2] = j
-        right_child_index_mark1[:, :, :, 2] = j
+    def _span_p_inside(self, density, masks, params):
+        """log likelihood with the span chart, see _span_chart"""
+        chart = self._span_chart(density, params, LogSemiring)
+        return torch.sum(log_sum_exp(self._span_root_scores(chart, masks, params), dim=1))
 
-        # assign symbol and index
-        left_child_symbol_index_mark1 = symbol_index_t
-        left_child_index_mark1[:, :, :, 4:] = left_child_symbol_index_mark1
-        right_child_index_mark1[:, :, :, 4:] = left_child_symbol_index_mark1
+    def _span_dep_parse(self, density, masks, params):
+        """Viterbi parse with the span chart, see _span_chart
 
-        if (i, j, 1) in self.log_p_parse:
-            right_stop_mark = self.log_p_parse[i, j, 1]
+        Returns: heads, see dep_parse
 
-            # max_index (batch_size, num_state, index) (value is 0 or 1)
-            right_stop_mark, max_index = torch.max(torch.cat((right_stop_mark.unsqueeze(dim=3), \
-                                                              inter_right_stop_mark.unsqueeze(dim=3)), \
-                                                             dim=3), dim=3)
+        """
 
-            # mask: (batch_size, num_state, index)
-            mask = (max_index == 1)
-            mask_ep = mask.unsqueeze(dim=-1).expand(batch_size, self.num_state, seq_length, 6)
-            left_child_index_mark1 = self.left_child[i, j, 1].masked_fill_(mask_ep, 0) + \
-                                     left_child_index_mark1.masked_fill_(1 - mask_ep, 0)
-            right_child_index_mark1 = self.right_child[i, j, 1].masked_fill_(mask_ep, 0) + \
-                                      right_child_index_mark1.masked_fill_(1 - mask_ep, 0)
+        batch_size, seq_length, num_state = density.size()
+        shape = (batch_size, seq_length, num_state)
+        num_cells = cell_offsets(seq_length)[-1] * num_state
+        num_spans = span_offsets(seq_length)[-1] * num_state
+
+        # backpointers, only the argmax choices in the smallest integer types,
+        # laid out by cell_offsets or span_offsets
+        # split[mark]: the best split point (k - i - 1) of the binary rules of mark 0 and 1
+        # stop: True if mark 1 comes from the right stop of mark 0, False if it
+        #     comes from a left attachment
+        # dependent_index: the best dependent (symbol * l + head index - start)
+        #     of dependent[0] and dependent[1]
+        flat = {'split': self.chart_pool.buffer(shape, 'split', (2, batch_size, num_cells),
+                                                index_dtype(seq_length), density.device),
+                'stop': self.chart_pool.buffer(shape, 'stop', (batch_size, num_cells),
+                                               torch.bool, density.device),
+                'dependent_index': self.chart_pool.buffer(shape, 'dependent_index', (2, batch_size, num_spans),
+                                                          index_dtype(num_state * seq_length),
+                                                          density.device)}
+        backpointer = {'split': [self._width_views(split, seq_length) for split in flat['split']],
+                       'stop': self._width_views(flat['stop'], seq_length),
+                       'dependent_index': [self._width_views(dependent_index, seq_length, head=False)
+                                           for dependent_index in flat['dependent_index']]}
+
+        # the Viterbi scores of chart[mark] and dependent[direction] of _span_chart
+        parse = self.chart_pool.buffer(shape, 'parse', (3, batch_size, num_cells),
+                                       density.dtype, density.device)
+        parse_dependent = self.chart_pool.buffer(shape, 'parse_dependent', (2, batch_size, num_spans),
+                                                 density.dtype, density.device)
+        values = {'chart': [self._width_views(mark, seq_length) for mark in parse],
+                  'dependent': [self._width_views(direction, seq_length, head=False)
+                                for direction in parse_dependent]}
+
+        chart = self._span_chart(density, params, MaxSemiring, backpointer, values)
+        _, root_max_index = torch.max(self._span_root_scores(chart, masks, params), dim=1)
+
+        return self._backtrace(flat['split'].cpu().numpy(), flat['stop'].cpu().numpy(),
+                               flat['dependent_index'].cpu().numpy(), root_max_index.cpu().numpy(),
+                               masks.sum(dim=0).long().cpu().numpy(), seq_length, num_state)
 
+    @staticmethod
+    def _backtrace(split, stop, dependent_index, root_index, sent_len, seq_length, num_state):
+        """follow the backpointers of _span_dep_parse for the whole
+        batch at once, each step expands all the open items of all
+        sentences with array indexing
 
-        else:
-            right_stop_mark = inter_right_stop_mark
+        Args:
+            split: (2, batch_size, num_cells * num_state), see cell_offsets
+            stop: (batch_size, num_cells * num_state)
+            dependent_index: (2, batch_size, num_spans * num_state), see span_offsets
+            root_index: (batch_size), symbol * seq_length + head of the root
+            sent_len: (batch_size)
 
-        log_stop_left = torch.gather(log_stop_left, 2, index_ladj)
-        self.log_p_parse[i, j, 2] = right_stop_mark + log_stop_left
-        self.log_p_parse[i, j, 1] = right_stop_mark
+        Returns: heads, see dep_parse
 
-        # assign indicator
-        left_child_index_mark2[:, :, :, 0] = 1
-        right_child_index_mark2[:, :, :, 0] = 0
+        """
+        batch_size = len(sent_len)
+        cells = np.array(cell_offsets(seq_length)) * num_state
+        spans = np.array(span_offsets(seq_length)) * num_state
+        heads = np.full((batch_size, seq_length), -1, dtype=np.int64)
+
+        # open items (sentence, width, start, mark, symbol, head index - start)
+        b = np.arange(batch_size)
+        l = sent_len.astype(np.int64)
+        i = np.zeros(batch_size, dtype=np.int64)
+        mark = np.full(batch_size, 2, dtype=np.int64)
+        symbol, head = np.divmod(root_index.astype(np.int64), seq_length)
+        heads[b, head] = 0
+
+        while len(b) > 0:
+            # mark 2 only adds the left stop, mark 1 either comes from the
+            # right stop of mark 0 or from a left attachment
+            cell = cells[l] + (i * num_state + symbol) * l + head
+            mark[mark == 2] = 1
+            mark[(mark == 1) & stop[b, cell]] = 0
+
+            keep = l > 1
+            b, l, i, mark, symbol, head, cell = \
+                [x[keep] for x in (b, l, i, mark, symbol, head, cell)]
+            a = split[mark, b, cell].astype(np.int64) + 1
+            right = mark == 0
+
+            # right dependent [i + a, i + l) and head part [i, i + a), or
+            # left dependent [i, i + a) and head part [i + a, i + l)
+            dep_l = np.where(right, l - a, a)
+            dep_i = np.where(right, i + a, i)
+            dep_code = dependent_index[mark, b, spans[dep_l] + dep_i * num_state + symbol]
+            dep_symbol, dep_head = np.divmod(dep_code.astype(np.int64), dep_l)
+            heads[b, dep_i + dep_head] = i + head + 1
+
+            b = np.concatenate([b, b])
+            l = np.concatenate([l - dep_l, dep_l])
+            i = np.concatenate([np.where(right, i, i + a), dep_i])
+            mark = np.concatenate([mark, np.full(len(dep_l), 2, dtype=np.int64)])
+            symbol = np.concatenate([symbol, dep_symbol])
+            head = np.concatenate([np.where(right, head, head - a), dep_head])
+
+        return heads
+
+    def _split_head_chart(self, density, params, semiring, backpointer=None):
+        """split-head (Eisner) chart, the left and the right dependents
+        of a head are generated independently given its symbol, so a
+        tree over [i, j] is the left half [i, d] and the right half
+        [d, j] of its root d. Each half grows by one complete dependent
+        subtree at a time, whose symbol is marginalized once per span,
+        O(n^3 K + n^2 K^2) per sentence
 
-        # assign starting point
-        left_child_index_mark2[:, :, :, 1] = i
-        right_child_index_mark2[:, :, :, 1] = i
+        Args:
+            density: (batch_size, seq_length, num_state)
+            params: DMVParams
+            semiring: LogSemiring or MaxSemiring, see semiring.py
+            backpointer: with a selective semiring, a dict of the width views
+                of the backpointer buffers of _split_head_dep_parse, width
+                w + 1 holds the spans [i, i + w]
+                right, left: the last dependent of the right half [i, i + w]
+                    covers [i + a + 1, i + w], and of the left half [i + b + 1, i + w]
+                full: the root of [i, i + w] is i + c
+                dep_right, dep_left: the symbol of the dependent span
+                    attached to each head symbol
+
+        Returns: a list indexed by w of the trees over the spans
+            [i, i + w] with size (batch_size, seq_length - w, num_state)
 
-        # assign end point
-        left_child_index_mark2[:, :, :, 2] = j
-        right_child_index_mark2[:, :, :, 2] = j
+        """
+        batch_size, seq_length, num_state = density.size()
+
+        # all indexed by w, (batch_size, seq_length - w, num_state)
+        # right_ext[w]: right half of the head i over [i, i + w] that
+        #     continues with another dependent
+        # left_ext[w]: the same for the left half of the head i + w
+        # right[w], left[w]: the halves closed by a stop decision
+        # dep_right[w], dep_left[w]: the tree over [i, i + w] attached as a
+        #     right or left dependent of each head symbol
+        right_ext, left_ext, right, left, full, dep_right, dep_left = \
+            ([None] * seq_length for _ in range(7))
+
+        def record(name, w, output):
+            if backpointer is not None:
+                backpointer[name][w + 1].copy_(output[1])
+            return output[0]
+
+        for w in range(seq_length):
+            num_span = seq_length - w
+            if w == 0:
+                right_open = left_open = density.new_zeros(batch_size, num_span, num_state)
+            else:
+                # (batch_size, num_span, w, num_state)
+                log_p = torch.stack([right_ext[a][:, :num_span] + dep_right[w - 1 - a][:, a + 1:a + 1 + num_span]
+                                     for a in range(w)], dim=2)
+                right_open = record('right', w, semiring.argsum(log_p, 2))
+                log_p = torch.stack([dep_left[b][:, :num_span] + left_ext[w - 1 - b][:, b + 1:b + 1 + num_span]
+                                     for b in range(w)], dim=2)
+                left_open = record('left', w, semiring.argsum(log_p, 2))
+
+            # dim2 of log_stop_*: 0 is nonadjacent, 1 is adjacent
+            adj = 1 if w == 0 else 0
+            # the stops are (num_state,), or (batch_size, 1, num_state) after
+            # _restrict_params of each sentence
+            right_ext[w] = right_open + params.log_stop_right[0, ..., adj].unsqueeze(-2)
+            left_ext[w] = left_open + params.log_stop_left[0, ..., adj].unsqueeze(-2)
+            right[w] = right_open + params.log_stop_right[1, ..., adj].unsqueeze(-2)
+            left[w] = left_open + params.log_stop_left[1, ..., adj].unsqueeze(-2)
+
+            # (batch_size, num_span, w + 1, num_state)
+            log_p = torch.stack([left[c][:, :num_span] + density[:, c:c + num_span] + right[w - c][:, c:c + num_span]
+                                 for c in range(w + 1)], dim=2)
+            full[w] = record('full', w, semiring.argsum(log_p, 2))
+
+            # dim0 of log_attach_* is the head symbol
+            log_p_span = full[w].unsqueeze(2)
+            dep_right[w] = record('dep_right', w, semiring.argsum(log_p_span + params.log_attach_right.unsqueeze(-3), 3))
+            dep_left[w] = record('dep_left', w, semiring.argsum(log_p_span + params.log_attach_left.unsqueeze(-3), 3))
+
+        return full
+
+    def _split_head_root_scores(self, full, masks, params):
+        """(batch_size, num_state), the trees over each whole sentence
+        attached to the root
+        """
+        batch_size = masks.size(1)
+        sent_len_t = masks.sum(dim=0).long()
+        log_p_sum_cat = torch.stack([full[w][:, 0] for w in range(len(full))], dim=1)
+        log_p_sum_cat = log_p_sum_cat[torch.arange(batch_size, device=self.device), sent_len_t - 1]
+        return log_p_sum_cat + params.log_root_attach_left
+
+    def _split_head_p_inside(self, density, masks, params):
+        """the likelihood of _span_p_inside computed with the
+        split-head chart, see _split_head_chart
+        """
+        full = self._split_head_chart(density, params, LogSemiring)
+        return torch.sum(log_sum_exp(self._split_head_root_scores(full, masks, params), dim=1))
+
+    def _split_head_dep_parse(self, density, masks, params):
+        """Viterbi parse with the split-head chart, see _span_dep_parse"""
+
+        batch_size, seq_length, num_state = density.size()
+        num_spans = span_offsets(seq_length)[-1] * num_state
+        flat = {name: self.chart_pool.buffer((batch_size, seq_length, num_state), 'split_head_' + name,
+                                             (batch_size, num_spans), index_dtype(max_value),
+                                             density.device)
+                for name, max_value in [('right', seq_length), ('left', seq_length),
+                                        ('full', seq_length), ('dep_right', num_state),
+                                        ('dep_left', num_state)]}
+        backpointer = {name: self._width_views(buf, seq_length, head=False)
+                       for name, buf in flat.items()}
+
+        full = self._split_head_chart(density, params, MaxSemiring, backpointer)
+        _, root_symbol = torch.max(self._split_head_root_scores(full, masks, params), dim=1)
+
+        return self._split_head_backtrace({name: buf.cpu().numpy() for name, buf in flat.items()},
+                                          root_symbol.cpu().numpy(), masks.sum(dim=0).long().cpu().numpy(),
+                                          seq_length, num_state)
 
-        # assign mark
-        left_child_index_mark2[:, :, :, 3] = 1
-        right_child_index_mark2[:, :, :, 3] = 1
+    @staticmethod
+    def _split_head_backtrace(backpointer, root_symbol, sent_len, seq_length, num_state):
+        """follow the backpointers of _split_head_chart for the whole
+        batch at once, see _backtrace
 
-        # assign symbol and index
-        left_child_symbol_index_mark2 = symbol_index_t
-        left_child_index_mark2[:, :, :, 4:] = left_child_symbol_index_mark2
-        right_child_index_mark2[:, :, :, 4:] = left_child_symbol_index_mark2
+        Returns: heads, see dep_parse
 
-        self.left_child[i, j, 2] = left_child_index_mark2
-        self.right_child[i, j, 2] = right_child_index_mark2
-        self.left_child[i, j, 1] = left_child_index_mark1
-        self.right_child[i, j, 1] = right_child_index_mark1
+        """
+        batch_size = len(sent_len)
+        spans = np.array(span_offsets(seq_length)) * num_state
+        heads = np.full((batch_size, seq_length), -1, dtype=np.int64)
+
+        def lookup(name, b, i, j, symbol):
+            return backpointer[name][b, spans[j - i + 1] + i * num_state + symbol].astype(np.int64)
+
+        # open items (sentence, kind, start, end, symbol, head of a full tree),
+        # kind 0 is a full tree, 1 a right half of i and 2 a left half of j
+        b = np.arange(batch_size)
+        kind = np.zeros(batch_size, dtype=np.int64)
+        i = np.zeros(batch_size, dtype=np.int64)
+        j = sent_len.astype(np.int64) - 1
+        symbol = root_symbol.astype(np.int64)
+        head = np.full(batch_size, -1, dtype=np.int64)
+
+        while len(b) > 0:
+            # the root d of full trees, its halves [i, d] and [d, j]
+            is_full = kind == 0
+            fb, fi, fj, fsymbol = b[is_full], i[is_full], j[is_full], symbol[is_full]
+            d = fi + lookup('full', fb, fi, fj, fsymbol)
+            heads[fb, d] = head[is_full] + 1
+
+            # the last dependent of right halves [m + 1, j] and left halves [i, m]
+            is_right = (kind == 1) & (i < j)
+            rb, ri, rj, rsymbol = b[is_right], i[is_right], j[is_right], symbol[is_right]
+            rm = ri + lookup('right', rb, ri, rj, rsymbol)
+            is_left = (kind == 2) & (i < j)
+            lb, li, lj, lsymbol = b[is_left], i[is_left], j[is_left], symbol[is_left]
+            lm = li + lookup('left', lb, li, lj, lsymbol)
+
+            b = np.concatenate([fb, fb, rb, rb, lb, lb])
+            kind = np.concatenate([np.full(len(fb), 2), np.ones(len(fb)), np.ones(len(rb)),
+                                   np.zeros(len(rb)), np.full(len(lb), 2), np.zeros(len(lb))]).astype(np.int64)
+            i = np.concatenate([fi, d, ri, rm + 1, lm + 1, li])
+            j = np.concatenate([d, fj, rm, rj, lj, lm])
+            symbol = np.concatenate([fsymbol, fsymbol, rsymbol, lookup('dep_right', rb, rm + 1, rj, rsymbol),
+                                     lsymbol, lookup('dep_left', lb, li, lm, lsymbol)])
+            head = np.concatenate([np.full(2 * len(fb), -1), np.full(len(rb), -1), ri,
+                                   np.full(len(lb), -1), lj]).astype(np.int64)
+
+        return heads
@@ -5,6 +5,7 @@ import random
 
 from nltk import tree
 
+from .evaluation import DepAccuracy, flatten_heads, pair_heads, print_by_length
 from .utils import stable_math_log
 
 harmonic_constant = 2.0
@@ -109,7 +110,8 @@ class DMV(object):
         """
         Args:
             gold: A nested list of heads
-            all_len: True if evaluating on all lengths
+            all_len: True if evaluating on all lengths, the root and
+                per length accuracies are then printed
 
         """
 
@@ -121,38 +123,17 @@ class DMV(object):
                 if k % 10 == 0:
                     print(f'parse {k:d} trees')
 
-        cnt = 0
-        dir_cnt = 0.0
-        undir_cnt = 0.0
+        gold_heads, offsets = flatten_heads([pair_heads(gold_s) for gold_s in gold])
+        parse_heads, _ = flatten_heads([pair_heads(parse_s, len(gold_s), base=0)
+                                        for gold_s, parse_s in zip(gold, parse)])
 
-        for gold_s, parse_s in zip(gold, parse):
-            length = len(gold_s)
-            if length > 1:
-                (directed, undirected) = self.measures(gold_s, parse_s)
-                cnt += length
-                dir_cnt += directed
-                undir_cnt += undirected
+        accuracy = DepAccuracy()
+        accuracy.update(parse_heads, gold_heads, offsets)
+        if all_len:
+            print(f'root acc {100 * accuracy.root():2.1f}')
+            print_by_length(accuracy)
 
-        dir_acu = dir_cnt / cnt
-        undir_acu = undir_cnt / cnt
-
-        return dir_acu, undir_acu
-
-    @staticmethod
-    def measures(gold_s, parse_s):
-        # Helper for eval().
-        (d, u) = (0, 0)
-        for (a, b) in gold_s:
-            (a, b) = (a - 1, b - 1)
-            b1 = (a, b) in parse_s
-            b2 = (b, a) in parse_s
-            if b1:
-                d += 1.0
-                u += 1.0
-            if b2:
-                u += 1.0
-
-        return d, u
+        return accuracy.directed(), accuracy.undirected()
 
     def EStep(self, s):
         pio = self.p_inside_outside(s)
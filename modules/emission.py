@@ -0,0 +1,62 @@
+from __future__ import print_function
+
+import math
+
+import torch
+
+
+def gaussian_log_density_c(num_dims, var):
+    """the normalizing constant of a diagonal Gaussian
+    with variance var, shared by all states
+    """
+    return -num_dims / 2.0 * (math.log(2 * math.pi)) - 0.5 * torch.sum(torch.log(var))
+
+
+def diag_gaussian_log_density(inputs, means, var, log_density_c):
+    """Evaluate the log density of every input vector under
+    every state with a matrix product, the squared distance is expanded as
+
+        sum((x - mu)^2 / var) = x^2 . (1/var) - 2 x . (mu/var) + mu^2 . (1/var)
+
+    so the (..., num_state, num_dims) broadcast is never built
+
+    Args:
+        inputs: (..., num_dims), e.g. (seq_length, batch_size, num_dims)
+        means: (num_state, num_dims)
+        var: (num_dims)
+        log_density_c: the normalizing constant
+
+    Returns:
+        density: (..., num_state)
+
+    """
+    inv_var = 1.0 / var
+
+    # (num_state, num_dims) and (num_state)
+    scaled_means = means * inv_var
+    means_norm = torch.sum(means * scaled_means, dim=1)
+
+    # (...) and (..., num_state)
+    inputs_norm = torch.matmul(inputs * inputs, inv_var)
+    cross = torch.matmul(inputs, scaled_means.t())
+
+    return log_density_c - 0.5 * (inputs_norm.unsqueeze(-1) - 2.0 * cross + means_norm)
+
+
+def unique_types(ids, embedding):
+    """collapse repeated word ids, so projections and
+    emissions are computed once per word type
+
+    Args:
+        ids: long tensor (...), word ids into embedding
+        embedding: (vocab_size, num_dims)
+
+    Returns: (types, inverse)
+        types: (num_types, num_dims)
+        inverse: (...), the type index of every word,
+                 embedding[ids] equals types[inverse]
+
+    """
+    type_ids, inverse = torch.unique(ids, return_inverse=True)
+    return embedding[type_ids], inverse
+
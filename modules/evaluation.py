@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import itertools
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from nlp_commons.dep.evaluation import DepAccuracy, flatten_heads, pair_heads
+
+__all__ = ['DepAccuracy', 'flatten_heads', 'pair_heads',
+           'encode_tags', 'TagConfusion', 'print_by_length']
+
+
+def encode_tags(tags):
+    """map gold tags to integer ids
+
+    Args:
+        tags: nested list of gold tags
+
+    Returns: (ids, tag_list)
+        ids: list of numpy int64 arrays, one per sentence
+        tag_list: the gold tag of each id
+
+    """
+    lengths = [len(sent) for sent in tags]
+    tag_list, flat_ids = np.unique(np.array(list(itertools.chain.from_iterable(tags)),
+                                            dtype=object),
+                                   return_inverse=True)
+    ids = np.split(flat_ids.astype(np.int64), np.cumsum(lengths)[:-1])
+    return ids, list(tag_list)
+
+
+def _entropy(counts):
+    total = counts.sum()
+    if total == 0:
+        return 0.0
+    prob = counts[counts > 0] / total
+    return -np.sum(prob * np.log(prob))
+
+
+class TagConfusion(object):
+    """count matrix between induced states and gold tags, updated
+    with one bincount per batch, all tagging metrics are read off it
+
+    Args:
+        num_state: number of induced states
+        num_gold: number of gold tags
+
+    """
+    def __init__(self, num_state, num_gold):
+        self.num_state = num_state
+        self.num_gold = num_gold
+
+        # (num_state, num_gold)
+        self.counts = np.zeros((num_state, num_gold), dtype=np.int64)
+
+    def update(self, pred, gold):
+        """
+        Args:
+            pred: int array of induced states
+            gold: int array of gold tag ids, same size as pred
+
+        """
+        self.counts += np.bincount(pred * self.num_gold + gold,
+                                   minlength=self.num_state * self.num_gold) \
+            .reshape(self.num_state, self.num_gold)
+
+    def total(self):
+        return self.counts.sum()
+
+    def many_to_one(self):
+        """each state is mapped to its most frequent gold tag"""
+        return self.counts.max(axis=1).sum() / float(max(self.total(), 1))
+
+    def one_to_one(self):
+        """states and gold tags are matched one to one to maximize
+        the number of matched tokens (Hungarian algorithm)
+        """
+        rows, cols = linear_sum_assignment(-self.counts)
+        return self.counts[rows, cols].sum() / float(max(self.total(), 1))
+
+    def v_measure(self):
+        """harmonic mean of homogeneity and completeness, same as
+        sklearn.metrics.v_measure_score on the token level labels
+        """
+        counts = self.counts[self.counts.sum(axis=1) > 0][:, self.counts.sum(axis=0) > 0]
+        if counts.size == 0:
+            return 1.0
+
+        entropy_gold = _entropy(counts.sum(axis=0))
+        entropy_state = _entropy(counts.sum(axis=1))
+
+        # mutual information
+        joint = counts / float(counts.sum())
+        outer = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nonzero = joint > 0
+        mutual = np.sum(joint[nonzero] * np.log(joint[nonzero] / outer[nonzero]))
+
+        homogeneity = mutual / entropy_gold if entropy_gold else 1.0
+        completeness = mutual / entropy_state if entropy_state else 1.0
+        if homogeneity + completeness == 0.0:
+            return 0.0
+
+        return 2.0 * homogeneity * completeness / (homogeneity + completeness)
+
+
+def print_by_length(accuracy):
+    """print the accuracy of each length bucket of a DepAccuracy"""
+    for min_length, max_length, num_words, directed, undirected in accuracy.by_length():
+        lengths = f'{min_length:d}-{max_length:d}' if max_length is not None else f'>={min_length:d}'
+        print(f'length {lengths}: {num_words:d} words, '
+              f'undir {100 * undirected:2.1f}, dir {100 * directed:2.1f}')
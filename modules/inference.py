@@ -0,0 +1,50 @@
+from __future__ import print_function
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(num_threads):
+    """a ThreadPoolExecutor with num_threads workers, created once and
+    shared by every caller in the process that asks for this size
+    """
+    with _pools_lock:
+        if num_threads not in _pools:
+            _pools[num_threads] = ThreadPoolExecutor(max_workers=num_threads,
+                                                     thread_name_prefix='inference')
+        return _pools[num_threads]
+
+
+def map_batches(fn, batches, num_threads=1):
+    """fn applied to each batch, on num_threads threads of the shared
+    pool if num_threads > 1. fn must not write to shared state, e.g.
+    DMVFlow.dep_parse or MarkovFlow.decode with frozen parameters.
+    At most num_threads batches are in flight, so a memory budget
+    divided by num_threads bounds the memory of all of them
+
+    Args:
+        fn: a function of one batch
+        batches: an iterable of batches
+
+    Returns: an iterator of fn(batch) in the order of batches
+
+    """
+    if num_threads <= 1:
+        for batch in batches:
+            yield fn(batch)
+        return
+
+    pool = shared_pool(num_threads)
+    running = deque()
+    for batch in batches:
+        if len(running) >= num_threads:
+            yield running.popleft().result()
+        running.append(pool.submit(fn, batch))
+
+    while running:
+        yield running.popleft().result()
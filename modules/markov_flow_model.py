@@ -1,15 +1,135 @@
 from __future__ import print_function
 
-import math
-from collections import Counter
+from collections import namedtuple
 
 import numpy as np
-from sklearn.metrics.cluster import v_measure_score
 from torch.nn import Parameter
 
+from .chart import index_dtype
+from .emission import diag_gaussian_log_density, \
+    gaussian_log_density_c
+from .evaluation import TagConfusion, encode_tags
+from .inference import map_batches
 from .projection import *
-from .utils import log_sum_exp, data_iter, to_input_tensor, \
-    write_conll
+from .semiring import LogSemiring, \
+    MaxSemiring, \
+    semiring_identity, \
+    semiring_reduce, \
+    semiring_scan, \
+    semiring_vecmat
+from .utils import log_sum_exp, batch_index_iter, write_conll
+
+# the normalized transitions and the Gaussian normalizing constant,
+# see MarkovFlow.freeze
+HMMParams = namedtuple('HMMParams', ['logA', 'log_density_c'])
+
+
+def forward_cell(alpha, density, logA):
+    """
+    alpha: (batch_size, num_state)
+    density: (batch_size, num_state)
+    logA: (num_state, num_state)
+
+    """
+    batch_size = len(alpha)
+    num_state = logA.size(0)
+    ep_size = torch.Size([batch_size, num_state, num_state])
+    return log_sum_exp(alpha.unsqueeze(dim=2).expand(ep_size) +
+                       logA.expand(ep_size) +
+                       density.unsqueeze(dim=1).expand(ep_size), dim=1)
+
+
+def backward_cell(beta, density, logA):
+    """
+    beta: (batch_size, num_state)
+    density: (batch_size, num_state)
+    logA: (num_state, num_state)
+
+    """
+    batch_size = len(beta)
+    num_state = logA.size(0)
+    ep_size = torch.Size([batch_size, num_state, num_state])
+    return log_sum_exp(logA.expand(ep_size) +
+                       density.unsqueeze(dim=1).expand(ep_size) +
+                       beta.unsqueeze(dim=1).expand(ep_size), dim=2)
+
+
+class HMMLikelihood(torch.autograd.Function):
+    """The HMM log likelihood with gradients computed from
+    forward-backward posteriors. Only the alphas are kept for
+    backward instead of the (batch_size, num_state, num_state)
+    intermediates of every timestep, the gradient w.r.t. density
+    is the state posterior and the gradient w.r.t. logA is the
+    expected transition counts. Gradients of tparams, means and the
+    projected inputs follow from these by autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, density, logA, pi, masks):
+        """
+        Args:
+            density: (sent_length, batch_size, num_state)
+            logA: (num_state, num_state)
+            pi: (num_state)
+            masks: (sent_length, batch_size)
+
+        Returns:
+            log_likelihood: (batch_size)
+
+        """
+        max_length = density.size(0)
+
+        alpha_all = density.new_empty(density.size())
+        alpha = pi + density[0]
+        alpha_all[0] = alpha
+        for t in range(1, max_length):
+            mask_ep = masks[t].unsqueeze(dim=1)
+            alpha = mask_ep * forward_cell(alpha, density[t], logA) + \
+                    (1 - mask_ep) * alpha
+            alpha_all[t] = alpha
+
+        log_likelihood = log_sum_exp(alpha, dim=1)
+        ctx.save_for_backward(density, logA, masks, alpha_all, log_likelihood)
+
+        return log_likelihood
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        density, logA, masks, alpha_all, log_likelihood = ctx.saved_tensors
+        max_length = density.size(0)
+        trans = torch.exp(logA)
+        log_likelihood = log_likelihood.unsqueeze(dim=1)
+        grad_output = grad_output.unsqueeze(dim=1)
+
+        grad_density = torch.zeros_like(density)
+        grad_logA = torch.zeros_like(logA)
+
+        beta = torch.zeros_like(density[0])
+        for t in range(max_length - 1, 0, -1):
+            mask_ep = masks[t].unsqueeze(dim=1)
+
+            # state posterior
+            grad_density[t] = mask_ep * grad_output * \
+                              torch.exp(alpha_all[t] + beta - log_likelihood)
+
+            # expected transition counts, xi[b, i, j] is proportional to
+            # exp(alpha[b, i]) * A[i, j] * exp(density[b, j] + beta[b, j]),
+            # summed over the batch with a matmul
+            prev = alpha_all[t - 1]
+            succ = density[t] + beta
+            prev_max, _ = torch.max(prev, dim=1, keepdim=True)
+            succ_max, _ = torch.max(succ, dim=1, keepdim=True)
+            weight = mask_ep * grad_output * \
+                     torch.exp(prev_max + succ_max - log_likelihood)
+            grad_logA += trans * torch.mm((torch.exp(prev - prev_max) * weight).t(),
+                                          torch.exp(succ - succ_max))
+
+            beta = mask_ep * backward_cell(beta, density[t], logA) + \
+                   (1 - mask_ep) * beta
+
+        grad_density[0] = grad_output * torch.exp(alpha_all[0] + beta - log_likelihood)
+
+        return grad_density, grad_logA, None, None
 
 
 class MarkovFlow(nn.Module):
@@ -19,9 +139,9 @@ class MarkovFlow(nn.Module):
         self.args = args
         self.device = args.device
 
-        # Gaussian Variance
-        self.var = torch.zeros(num_dims, dtype=torch.float32,
-                               device=self.device, requires_grad=False)
+        # Gaussian Variance, a buffer so that the EM-updated value is saved
+        self.register_buffer('var', torch.zeros(num_dims, dtype=torch.float32,
+                                                device=self.device))
 
         self.num_state = args.num_state
         self.num_dims = num_dims
@@ -62,13 +182,21 @@ class MarkovFlow(nn.Module):
         # self.tparams.data.uniform_().add_(1)
         self.tparams.data.uniform_()
 
+        # the variance of a loaded model of the same kind is kept,
+        # older checkpoints without it fall back to the empirical value
+        var_loaded = False
+
         # load pretrained model
         if self.args.load_nice != '':
-            self.load_state_dict(torch.load(self.args.load_nice), strict=False)
+            state_dict = torch.load(self.args.load_nice)
+            self.load_state_dict(state_dict, strict=False)
+            var_loaded = 'var' in state_dict
 
         # load pretrained Gaussian baseline
         if self.args.load_gaussian != '':
-            self.load_state_dict(torch.load(self.args.load_gaussian), strict=False)
+            state_dict = torch.load(self.args.load_gaussian)
+            self.load_state_dict(state_dict, strict=False)
+            var_loaded = 'var' in state_dict and self.args.model == 'gaussian'
 
         # initialize mean and variance with empirical values
         with torch.no_grad():
@@ -81,7 +209,8 @@ class MarkovFlow(nn.Module):
             seed_var = torch.sum(masks.view(-1, 1).expand_as(flat_sents) *
                                  ((flat_sents - seed_mean.expand_as(flat_sents)) ** 2),
                                  dim=0) / masks.sum()
-            self.var.copy_(seed_var)
+            if not var_loaded:
+                self.var.copy_(seed_var)
 
             # add noise to the pretrained Gaussian mean
             if self.args.load_gaussian != '' and self.args.model == 'nice':
@@ -91,11 +220,7 @@ class MarkovFlow(nn.Module):
                 self.means.data.add_(seed_mean.data.expand_as(self.means.data))
 
     def _calc_log_density_c(self):
-        # return -self.num_dims/2.0 * (math.log(2) + \
-        #         math.log(np.pi)) - 0.5 * self.num_dims * (torch.log(self.var))
-
-        return -self.num_dims / 2.0 * (math.log(2) + \
-                                       math.log(np.pi)) - 0.5 * torch.sum(torch.log(self.var))
+        return gaussian_log_density_c(self.num_dims, self.var)
 
     def transform(self, x):
         """
@@ -110,39 +235,193 @@ class MarkovFlow(nn.Module):
 
         return x, jacobian_loss
 
-    def forward(self, sents, masks):
+    def forward(self, sents, masks, inverse=None):
         """
-        sents: (sent_length, batch_size, self.num_dims)
+        sents: (sent_length, batch_size, self.num_dims), or the word
+               types (num_types, self.num_dims) of the batch
         masks: (sent_length, batch_size)
+        inverse: (sent_length, batch_size), see _density
 
         """
-        max_length = sents.size()[0]
+        assert self.var.data.min() > 0
+
+        params = self._calc_params()
+
+        # (sent_length, batch_size, num_state)
+        density, jacobian_loss = self._density(sents, params, inverse)
+
+        objective = torch.sum(self._log_likelihood(density, masks, params))
+
+        return objective, jacobian_loss
+
+    def _density(self, sents, params, inverse=None):
+        """emission log densities of word vectors before the projection.
+        Given inverse, sents are the word types of the batch, e.g. from
+        Corpus.type_batch, the projection and the densities are computed
+        once per type and gathered back. NICE is volume preserving, so
+        the jacobian term is the same either way
+
+        Args:
+            sents: (sent_length, batch_size, num_dims), or
+                   (num_types, num_dims) with inverse
+            params: HMMParams
+            inverse: long tensor (sent_length, batch_size), the type
+                     index of every position
+
+        Returns: (density, jacobian_loss)
+            density: (sent_length, batch_size, num_state)
+
+        """
+        if inverse is not None:
+            types, jacobian_loss = self.transform(sents)
+            return self._eval_density(types, params)[inverse], jacobian_loss
+
         sents, jacobian_loss = self.transform(sents)
+        return self._eval_density(sents, params), jacobian_loss
 
-        assert self.var.data.min() > 0
+    def density_table(self, types):
+        """emission log densities of a set of word types, computed once
+        for a fixed checkpoint and then gathered by type index
+
+        Args:
+            types: (num_types, num_dims), word vectors before the projection
+
+        Returns: (num_types, num_state)
+
+        """
+        with torch.no_grad():
+            types, _ = self.transform(types)
+            return self._eval_density(types, self.freeze())
+
+    def _log_likelihood(self, density, masks, params):
+        """log likelihood of each sentence with the forward
+        algorithm selected by args.forward
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            params: HMMParams
+
+        Returns: (batch_size)
 
-        batch_size = len(sents[0])
-        self.logA = self._calc_logA()
-        self.log_density_c = self._calc_log_density_c()
+        """
+        if self.args.forward == 'scaled':
+            return self._forward_scaled(density, masks, params.logA)
+        elif self.args.forward == 'lean':
+            return HMMLikelihood.apply(density, params.logA, self.pi, masks)
+        elif self.args.forward == 'scan':
+            return self._forward_scan(density, masks, params.logA)
+        else:
+            return self._forward_log(density, masks, params.logA)
+
+    def _forward_log(self, density, masks, logA):
+        """forward algorithm in log space
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            logA: (num_state, num_state)
+
+        Returns:
+            log_likelihood: (batch_size)
+
+        """
+        max_length, batch_size, _ = density.size()
 
-        alpha = self.pi + self._eval_density(sents[0])
+        alpha = self.pi + density[0]
         for t in range(1, max_length):
-            density = self._eval_density(sents[t])
             mask_ep = masks[t].expand(self.num_state, batch_size) \
                 .transpose(0, 1)
             alpha = torch.mul(mask_ep,
-                              self._forward_cell(alpha, density)) + \
+                              forward_cell(alpha, density[t], logA)) + \
                     torch.mul(1 - mask_ep, alpha)
 
         # calculate objective from log space
-        objective = torch.sum(log_sum_exp(alpha, dim=1))
+        return log_sum_exp(alpha, dim=1)
 
-        return objective, jacobian_loss
+    def _forward_scaled(self, density, masks, logA):
+        """forward algorithm in probability space, alpha is
+        rescaled to sum to one at every step and the log likelihood
+        is recovered from the scaling factors. Each step is a single
+        (batch_size, num_state) x (num_state, num_state) matmul
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            logA: (num_state, num_state)
+
+        Returns:
+            log_likelihood: (batch_size)
+
+        """
+        max_length = density.size(0)
+        trans = torch.exp(logA)
+
+        # shift the emissions so that the max of every step is one,
+        # the shift goes back into the log likelihood
+        # density_max: (sent_length, batch_size, 1)
+        density_max, _ = torch.max(density, dim=2, keepdim=True)
+        emission = torch.exp(density - density_max)
+        density_max = density_max.squeeze(dim=2)
+
+        alpha = torch.exp(self.pi) * emission[0]
+        scale = torch.sum(alpha, dim=1, keepdim=True)
+        alpha = alpha / scale
+        log_likelihood = density_max[0] + torch.log(scale.squeeze(dim=1))
+        for t in range(1, max_length):
+            alpha_new = torch.mm(alpha, trans) * emission[t]
+            scale = torch.sum(alpha_new, dim=1, keepdim=True)
+            mask_ep = masks[t].unsqueeze(dim=1)
+            alpha = mask_ep * (alpha_new / scale) + (1 - mask_ep) * alpha
+            log_likelihood = log_likelihood + \
+                             masks[t] * (density_max[t] + torch.log(scale.squeeze(dim=1)))
+
+        return log_likelihood
+
+    def _transition_mats(self, density, masks, semiring, logA):
+        """the per-step matrices of the forward recursion,
+        mats[t - 1, b, i, j] = logA[i, j] + density[t, b, j],
+        padded steps are the semiring identity
 
-    def _calc_alpha(self, sents, masks):
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+
+        Returns:
+            mats: (sent_length - 1, batch_size, num_state, num_state)
+
+        """
+        mats = logA + density[1:].unsqueeze(dim=2)
+        identity = semiring_identity(semiring, mats.size(), self.device)
+        mask_ep = masks[1:].view(*masks[1:].size(), 1, 1)
+
+        return mask_ep * mats + (1 - mask_ep) * identity
+
+    def _forward_scan(self, density, masks, logA):
+        """forward algorithm as a product of the per-step matrices
+        in the log semiring, multiplied in a tree of depth O(log T)
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+
+        Returns:
+            log_likelihood: (batch_size)
+
+        """
+        alpha = self.pi + density[0]
+        if density.size(0) > 1:
+            prod = semiring_reduce(LogSemiring,
+                                   self._transition_mats(density, masks, LogSemiring, logA))
+            alpha = semiring_vecmat(LogSemiring, alpha, prod)
+
+        return log_sum_exp(alpha, dim=1)
+
+    def _calc_alpha(self, sents, masks, params):
         """
         sents: (sent_length, batch_size, self.num_dims)
         masks: (sent_length, batch_size)
+        params: HMMParams
 
         Returns:
             output: (batch_size, sent_length, num_state)
@@ -150,62 +429,160 @@ class MarkovFlow(nn.Module):
         """
         max_length, batch_size, _ = sents.size()
 
+        density = self._eval_density(sents, params)
+
+        if self.args.forward == 'scan' and max_length > 1:
+            # all the prefix products at once
+            alpha = self.pi + density[0]
+            prefix = semiring_scan(LogSemiring,
+                                   self._transition_mats(density, masks, LogSemiring, params.logA))
+            alpha_all = torch.cat((alpha.unsqueeze(0),
+                                   semiring_vecmat(LogSemiring, alpha, prefix)), dim=0)
+            return alpha_all.transpose(0, 1)
+
         alpha_all = []
-        alpha = self.pi + self._eval_density(sents[0])
+        alpha = self.pi + density[0]
         alpha_all.append(alpha.unsqueeze(1))
         for t in range(1, max_length):
-            density = self._eval_density(sents[t])
             mask_ep = masks[t].expand(self.num_state, batch_size) \
                 .transpose(0, 1)
-            alpha = torch.mul(mask_ep, self._forward_cell(alpha, density)) + \
+            alpha = torch.mul(mask_ep, forward_cell(alpha, density[t], params.logA)) + \
                     torch.mul(1 - mask_ep, alpha)
             alpha_all.append(alpha.unsqueeze(1))
 
         return torch.cat(alpha_all, dim=1)
 
-    def _forward_cell(self, alpha, density):
-        batch_size = len(alpha)
-        ep_size = torch.Size([batch_size, self.num_state, self.num_state])
-        alpha = log_sum_exp(alpha.unsqueeze(dim=2).expand(ep_size) +
-                            self.logA.expand(ep_size) +
-                            density.unsqueeze(dim=1).expand(ep_size), dim=1)
+    def _calc_beta(self, sents, masks, params):
+        """
+        sents: (sent_length, batch_size, self.num_dims)
+        masks: (sent_length, batch_size)
+        params: HMMParams
 
-        return alpha
+        Returns:
+            output: (batch_size, sent_length, num_state)
 
-    def _backward_cell(self, beta, density):
         """
-        density: (batch_size, num_state)
-        beta: (batch_size, num_state)
+        max_length, batch_size, _ = sents.size()
 
-        """
-        batch_size = len(beta)
-        ep_size = torch.Size([batch_size, self.num_state, self.num_state])
-        beta = log_sum_exp(self.logA.expand(ep_size) +
-                           density.unsqueeze(dim=1).expand(ep_size) +
-                           beta.unsqueeze(dim=1).expand(ep_size), dim=2)
+        density = self._eval_density(sents, params)
+
+        beta_all = []
+        beta = torch.zeros((batch_size, self.num_state), device=self.device)
+        beta_all.append(beta.unsqueeze(1))
+        for t in range(max_length - 1, 0, -1):
+            mask_ep = masks[t].unsqueeze(dim=1)
+            beta = mask_ep * backward_cell(beta, density[t], params.logA) + \
+                   (1 - mask_ep) * beta
+            beta_all.append(beta.unsqueeze(1))
+
+        return torch.cat(beta_all[::-1], dim=1)
 
-        return beta
+    def em_step(self, train_data, batch_size):
+        """One iteration of Baum-Welch EM for the Gaussian HMM.
+        The E-step streams over the corpus in batches and accumulates
+        expected transition counts and the per-state weighted
+        sufficient statistics, the M-step updates tparams, means and
+        the shared variance in closed form
+
+        Args:
+            train_data: Corpus
+            batch_size: number of sentences per E-step batch
+
+        Returns:
+            log likelihood of train_data under the parameters
+            before the update
 
-    def _eval_density(self, words):
         """
-        words: (batch_size, self.num_dims)
+        assert self.args.model == 'gaussian'
+
+        trans_cnt = torch.zeros((self.num_state, self.num_state), device=self.device)
+        state_cnt = torch.zeros(self.num_state, device=self.device)
+        state_sum = torch.zeros((self.num_state, self.num_dims), device=self.device)
+        sq_sum = torch.zeros(self.num_dims, device=self.device)
+        log_likelihood = 0.0
 
+        with torch.no_grad():
+            params = self.freeze()
+            trans = torch.exp(params.logA)
+
+            for batch_ids in batch_index_iter(train_data.lengths, batch_size, shuffle=False):
+                sents, masks = train_data.batch(batch_ids)
+
+                # (batch_size, sent_length, num_state)
+                alpha = self._calc_alpha(sents, masks, params)
+                beta = self._calc_beta(sents, masks, params)
+                density = self._eval_density(sents, params).transpose(0, 1)
+                masks_t = masks.t()
+                sents_t = sents.transpose(0, 1)
+
+                # (batch_size, 1, 1)
+                batch_ll = log_sum_exp(alpha[:, -1], dim=1).view(-1, 1, 1)
+                log_likelihood += batch_ll.sum().item()
+
+                # state posteriors, (batch_size, sent_length, num_state)
+                gamma = torch.exp(alpha + beta - batch_ll) * masks_t.unsqueeze(dim=2)
+                state_cnt += gamma.sum(dim=(0, 1))
+                state_sum += torch.einsum('btk,btd->kd', gamma, sents_t)
+                sq_sum += torch.sum(masks_t.unsqueeze(dim=2) * sents_t ** 2, dim=(0, 1))
+
+                # expected transitions, xi[b, t, i, j] is proportional to
+                # exp(alpha[b, t - 1, i]) * A[i, j] * exp(density[b, t, j] + beta[b, t, j])
+                prev = alpha[:, :-1]
+                succ = density[:, 1:] + beta[:, 1:]
+                prev_max, _ = torch.max(prev, dim=2, keepdim=True)
+                succ_max, _ = torch.max(succ, dim=2, keepdim=True)
+                weight = masks_t[:, 1:].unsqueeze(dim=2) * \
+                         torch.exp(prev_max + succ_max - batch_ll)
+                trans_cnt += trans * torch.einsum('bti,btj->ij',
+                                                  torch.exp(prev - prev_max) * weight,
+                                                  torch.exp(succ - succ_max))
+
+            # M-step
+            trans_cnt = trans_cnt + 1e-10
+            self.tparams.copy_(torch.log(trans_cnt / trans_cnt.sum(dim=1, keepdim=True)))
+
+            # states with no mass keep their means
+            has_cnt = state_cnt > 0
+            means = state_sum[has_cnt] / state_cnt[has_cnt].unsqueeze(dim=1)
+            self.means[has_cnt] = means
+
+            # shared diagonal variance, sum_t,k gamma[t, k] * (x_t - mu_k)^2 / N
+            var = (sq_sum - torch.sum(state_sum[has_cnt] * means, dim=0)) / state_cnt.sum()
+            self.var.copy_(torch.clamp(var, min=1e-6))
+
+        return log_likelihood
+
+    def _eval_density(self, words, params):
         """
+        words: (..., self.num_dims), e.g. (sent_length, batch_size, self.num_dims)
+        params: HMMParams
+
+        Returns:
+            density: (..., num_state)
 
-        batch_size = words.size(0)
-        ep_size = torch.Size([batch_size, self.num_state, self.num_dims])
-        words = words.unsqueeze(dim=1).expand(ep_size)
-        means = self.means.expand(ep_size)
-        var = self.var.expand(ep_size)
+        """
 
-        return self.log_density_c - \
-               0.5 * torch.sum((means - words) ** 2 / var, dim=2)
+        return diag_gaussian_log_density(words, self.means, self.var,
+                                         params.log_density_c)
 
     def _calc_logA(self):
         return (self.tparams - \
                 log_sum_exp(self.tparams, dim=1, keepdim=True) \
                 .expand(self.num_state, self.num_state))
 
+    def _calc_params(self):
+        """HMMParams of the current parameters, differentiable"""
+        return HMMParams(self._calc_logA(), self._calc_log_density_c())
+
+    def freeze(self):
+        """HMMParams of the model as it is now, computed once and
+        passed to decode, tag and their _density variants for any
+        number of batches. Nothing is written to the model during
+        inference, so batches can be tagged concurrently on one model
+        """
+        with torch.no_grad():
+            return self._calc_params()
+
     def _calc_log_mul_emit(self):
         return self.emission - \
                log_sum_exp(self.emission, dim=1, keepdim=True) \
@@ -216,55 +593,179 @@ class MarkovFlow(nn.Module):
         Args:
             sents_var: (sent_length, batch_size, num_dims)
             masks: (sent_length, batch_size)
+
+        Returns:
+            path: (batch_size, sent_length), padded positions repeat
+                  the last state of the sentence
+
         """
 
-        self.log_density_c = self._calc_log_density_c()
-        self.logA = self._calc_logA()
+        params = self.freeze()
 
+        return self._viterbi_density(self._eval_density(sents_var, params), masks, params.logA)
+
+    def _viterbi_density(self, density_all, masks, logA):
+        """
+        Args:
+            density_all: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            logA: (num_state, num_state)
+
+        Returns:
+            path: (batch_size, sent_length)
+
+        """
         length, batch_size = masks.size()
 
+        if self.args.forward == 'scan' and length > 1:
+            return self._viterbi_scan(density_all, masks, logA)
+
         # (batch_size, num_state)
-        delta = self.pi + self._eval_density(sents_var[0])
+        delta = self.pi + density_all[0]
 
-        ep_size = torch.Size([batch_size, self.num_state, self.num_state])
-        index_all = []
+        # backpointers[t - 1, b, j]: the best previous state of j at step t,
+        # padded steps point back to the same state
+        backpointers = torch.empty((length - 1, batch_size, self.num_state),
+                                   dtype=index_dtype(self.num_state - 1), device=self.device)
+        keep = torch.arange(self.num_state, device=self.device).expand(batch_size, self.num_state)
 
         # forward calculate delta
         for t in range(1, length):
-            density = self._eval_density(sents_var[t])
-            delta_new = self.logA.expand(ep_size) + \
-                        density.unsqueeze(dim=1).expand(ep_size) + \
-                        delta.unsqueeze(dim=2).expand(ep_size)
-            mask_ep = masks[t].view(-1, 1, 1).expand(ep_size)
-            delta = mask_ep * delta_new + \
-                    (1 - mask_ep) * delta.unsqueeze(dim=1).expand(ep_size)
+            # (batch_size, num_state, num_state)
+            delta_new = delta.unsqueeze(dim=2) + logA + density_all[t].unsqueeze(dim=1)
 
             # index: (batch_size, num_state)
-            delta, index = torch.max(delta, dim=1)
-            index_all.append(index)
+            delta_new, index = torch.max(delta_new, dim=1)
+            mask = masks[t].unsqueeze(dim=1) > 0
+            delta = torch.where(mask, delta_new, delta)
+            backpointers[t - 1] = torch.where(mask, index, keep)
+
+        return self._backtrace(backpointers, delta)
+
+    def _viterbi_scan(self, density, masks, logA):
+        """Viterbi with the deltas of all steps computed as prefix
+        products in the max-plus semiring, padded steps are identity
+        matrices so their backpointers keep the state
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+
+        """
+        mats = self._transition_mats(density, masks, MaxSemiring, logA)
+
+        # delta_all: (sent_length, batch_size, num_state)
+        delta = self.pi + density[0]
+        delta_all = torch.cat((delta.unsqueeze(0),
+                               semiring_vecmat(MaxSemiring, delta,
+                                               semiring_scan(MaxSemiring, mats))), dim=0)
+
+        # backpointers of all steps, index_all: (sent_length - 1, batch_size, num_state)
+        _, index_all = torch.max(delta_all[:-1].unsqueeze(dim=3) + mats, dim=2)
+
+        return self._backtrace(index_all.to(index_dtype(self.num_state - 1)), delta_all[-1])
+
+    def _backtrace(self, backpointers, delta):
+        """retrieve the best path with integer gathers only
+
+        Args:
+            backpointers: (sent_length - 1, batch_size, num_state)
+            delta: (batch_size, num_state), delta of the last step
+
+        Returns:
+            path: (batch_size, sent_length)
+
+        """
+        length = backpointers.size(0) + 1
+        path = torch.empty((length, delta.size(0)), dtype=torch.long, device=self.device)
 
-        assign_all = []
         # assign: (batch_size)
         _, assign = torch.max(delta, dim=1)
-        assign_all.append(assign.unsqueeze(dim=1))
-
-        # backward retrieve path
-        # len(index_all) = length-1
+        path[length - 1] = assign
         for t in range(length - 2, -1, -1):
-            assign_new = torch.gather(index_all[t],
-                                      dim=1,
-                                      index=assign.view(-1, 1)).squeeze(dim=1)
+            assign = torch.gather(backpointers[t], dim=1,
+                                  index=assign.unsqueeze(dim=1)).squeeze(dim=1).long()
+            path[t] = assign
+
+        return path.t()
+
+    def decode(self, sents, masks, params=None):
+        """Viterbi tagging of a batch
+
+        Args:
+            sents: (sent_length, batch_size, num_dims), word vectors
+                   before the projection
+            masks: (sent_length, batch_size)
+            params: HMMParams from freeze, computed here if not given
+
+        Returns:
+            tags: list of numpy int64 arrays, the predicted states of
+                  each sentence with the padding removed
+
+        """
+        if params is None:
+            params = self.freeze()
+        with torch.no_grad():
+            density, _ = self._density(sents, params)
+
+        return self.decode_density(density, masks, params)
+
+    def decode_density(self, density, masks, params=None):
+        """decode with precomputed emission densities, e.g. gathered
+        from density_table
+
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            params: HMMParams from freeze, computed here if not given
+
+        """
+        if params is None:
+            params = self.freeze()
+        with torch.no_grad():
+            path = self._viterbi_density(density, masks, params.logA).cpu().numpy()
+
+        lengths = masks.sum(dim=0).long().tolist()
+
+        return [path[b, :lengths[b]] for b in range(len(lengths))]
+
+    def tag(self, sents, masks, params=None):
+        """Viterbi tags and log likelihood of a batch, the
+        emission densities are shared by both
+
+        Args:
+            sents: (sent_length, batch_size, num_dims), word vectors
+                   before the projection
+            masks: (sent_length, batch_size)
+            params: HMMParams from freeze, computed here if not given
+
+        Returns: (tags, log_likelihood)
+            tags: list of numpy int64 arrays as in decode
+            log_likelihood: numpy array (batch_size)
+
+        """
+        if params is None:
+            params = self.freeze()
+        with torch.no_grad():
+            density, _ = self._density(sents, params)
 
-            assign_new = assign_new.float()
-            assign = assign.float()
-            assign = masks[t + 1] * assign_new + (1 - masks[t + 1]) * assign
-            assign = assign.long()
+        return self.tag_density(density, masks, params)
 
-            assign_all.append(assign.unsqueeze(dim=1))
+    def tag_density(self, density, masks, params=None):
+        """tag with precomputed emission densities
 
-        assign_all = assign_all[-1::-1]
+        Args:
+            density: (sent_length, batch_size, num_state)
+            masks: (sent_length, batch_size)
+            params: HMMParams from freeze, computed here if not given
+
+        """
+        if params is None:
+            params = self.freeze()
+        with torch.no_grad():
+            log_likelihood = self._log_likelihood(density, masks, params).cpu().numpy()
 
-        return torch.cat(assign_all, dim=1)
+        return self.decode_density(density, masks, params), log_likelihood
 
     def test(self,
              test_data,
@@ -272,74 +773,60 @@ class MarkovFlow(nn.Module):
              sentences=None,
              tagging=False,
              path=None,
-             null_index=None):
-        """Evaluate tagging performance with
-        many-to-1 metric and VM score
+             null_index=None,
+             num_threads=1):
+        """Evaluate tagging performance with many-to-1,
+        1-to-1 and VM score
 
         Args:
-            test_data: nested list of sentences
+            test_data: Corpus
             test_tags: nested list of gold tags
             tagging: output the predicted tags if True
             path: The output tag file path
             null_index: the null element location in Penn
                         Treebank, only used for writing unsupervised
                         tags for downstream parsing task
+            num_threads: batches decoded concurrently with the
+                         parameters of freeze, see map_batches
 
         Returns:
-            Tuple1: (M1, VM score)
+            Tuple1: (M1, 1-to-1, VM score)
 
         """
 
-        pad = np.zeros(self.num_dims)
-
-        total = 0.0
-        correct = 0.0
-        cnt_stats = {}
-        match_dict = {}
-
-        index_all = []
-        eval_tags = []
-
-        gold_vm = []
-        model_vm = []
-
-        for sents, tags in data_iter(list(zip(test_data, test_tags)),
-                                     batch_size=self.args.batch_size,
-                                     is_test=True,
-                                     shuffle=False):
-            total += sum(len(sent) for sent in sents)
-            sents_var, masks = to_input_tensor(sents,
-                                               pad,
-                                               device=self.device)
-            sents_var, _ = self.transform(sents_var)
-
-            # index: (batch_size, seq_length)
-            index = self._viterbi(sents_var, masks)
-
-            index_all += list(index)
-            eval_tags += tags
+        gold_ids, gold_list = encode_tags(test_tags)
+        confusion = TagConfusion(self.num_state, len(gold_list))
+
+        # predictions are put back to the original sentence order
+        index_all = [None] * len(test_data)
+
+        params = self.freeze()
+        if self.args.type_cache:
+            # emission table of the corpus vocabulary, computed once per call
+            table = self.density_table(test_data.embedding)
+
+        def decode_batch(batch_ids):
+            # index: list of (seq_length,) arrays
+            if self.args.type_cache:
+                ids, masks = test_data.id_batch(batch_ids)
+                return self.decode_density(table[ids], masks, params)
+            sents_var, masks = test_data.batch(batch_ids)
+            return self.decode(sents_var, masks, params)
+
+        batches = list(batch_index_iter(test_data.lengths,
+                                        batch_size=self.args.batch_size,
+                                        shuffle=False,
+                                        bucket=self.args.bucket,
+                                        max_tokens=self.args.max_tokens))
+        for batch_ids, index in zip(batches, map_batches(decode_batch, batches, num_threads)):
+            for i, seq_model_tags in zip(batch_ids, index):
+                index_all[i] = seq_model_tags
 
             # count
-            for (seq_gold_tags, seq_model_tags) in zip(tags, index):
-                for (gold_tag, model_tag) in zip(seq_gold_tags, seq_model_tags):
-                    model_tag = model_tag.item()
-                    gold_vm += [gold_tag]
-                    model_vm += [model_tag]
-                    if model_tag not in cnt_stats:
-                        cnt_stats[model_tag] = Counter()
-                    cnt_stats[model_tag][gold_tag] += 1
-        # match
-        for tag in cnt_stats:
-            match_dict[tag] = cnt_stats[tag].most_common(1)[0][0]
-
-        # eval many2one
-        for (seq_gold_tags, seq_model_tags) in zip(eval_tags, index_all):
-            for (gold_tag, model_tag) in zip(seq_gold_tags, seq_model_tags):
-                model_tag = model_tag.item()
-                if match_dict[model_tag] == gold_tag:
-                    correct += 1
+            confusion.update(np.concatenate(index),
+                             np.concatenate([gold_ids[i] for i in batch_ids]))
 
         if tagging:
             write_conll(path, sentences, index_all, null_index)
 
-        return correct / total, v_measure_score(gold_vm, model_vm)
+        return confusion.many_to_one(), confusion.one_to_one(), confusion.v_measure()
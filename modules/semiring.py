@@ -0,0 +1,170 @@
+from __future__ import print_function
+
+import torch
+
+from .utils import log_sum_exp
+
+NEG_INFINITY = -1e20
+
+
+class LogSemiring(object):
+    """(logsumexp, +) semiring, used to marginalize"""
+
+    zero = NEG_INFINITY
+    one = 0.0
+
+    @staticmethod
+    def sum(input, dim):
+        return log_sum_exp(input, dim=dim)
+
+    @staticmethod
+    def argsum(input, dim):
+        """sum over dim, with the index of the selected element for
+        selective semirings, there is none here
+
+        Returns: (output, None)
+
+        """
+        return log_sum_exp(input, dim=dim), None
+
+    @staticmethod
+    def matmul(a, b):
+        """log-space matrix product computed as a GEMM in
+        probability space, rows of a and columns of b are shifted by
+        their max so the exponentials stay in range. Products that
+        are zero (e.g. off-diagonals of identities) map to
+        NEG_INFINITY with a zero gradient, the other entries are
+        not floored. In float32 an entry more than about 87 nats below
+        the row max of a plus the column max of b underflows to
+        such a zero
+
+        Args:
+            a: (..., m, k)
+            b: (..., k, n)
+
+        Returns: (..., m, n)
+
+        """
+        a_max, _ = torch.max(a, dim=-1, keepdim=True)
+        b_max, _ = torch.max(b, dim=-2, keepdim=True)
+        prod = torch.matmul(torch.exp(a - a_max), torch.exp(b - b_max))
+
+        # log of ones at the zeros, so their gradient is not nan
+        nonzero = prod > 0
+        log_prod = torch.log(torch.where(nonzero, prod, torch.ones_like(prod)))
+        log_prod = log_prod.masked_fill(~nonzero, NEG_INFINITY)
+        return log_prod + a_max + b_max
+
+
+class MaxSemiring(object):
+    """(max, +) semiring, used for Viterbi"""
+
+    zero = NEG_INFINITY
+    one = 0.0
+
+    # max number of elements of the (k, k, k) intermediates built at once
+    chunk_elements = 2 ** 24
+
+    @staticmethod
+    def sum(input, dim):
+        return torch.max(input, dim=dim)[0]
+
+    @staticmethod
+    def argsum(input, dim):
+        """max over dim, with the argmax as backpointer
+
+        Returns: (output, index)
+
+        """
+        return torch.max(input, dim=dim)
+
+    @classmethod
+    def matmul(cls, a, b):
+        """
+        Args:
+            a: (..., k, k)
+            b: (..., k, k), same size as a
+
+        Returns: (..., k, k)
+
+        """
+        size = a.size()
+        num_state = size[-1]
+        a = a.reshape(-1, num_state, num_state)
+        b = b.reshape(-1, num_state, num_state)
+        step = max(1, cls.chunk_elements // num_state ** 3)
+        output = [torch.max(a[s:s + step].unsqueeze(-1) + b[s:s + step].unsqueeze(-3), dim=-2)[0]
+                  for s in range(0, a.size(0), step)]
+        return torch.cat(output, dim=0).view(size)
+
+
+def semiring_vecmat(semiring, vec, mat):
+    """
+    Args:
+        vec: (..., k)
+        mat: (..., k, n)
+
+    Returns: (..., n)
+
+    """
+    return semiring.sum(vec.unsqueeze(-1) + mat, dim=-2)
+
+
+def semiring_identity(semiring, size, device):
+    """identity matrices with size (..., k, k)"""
+    num_state = size[-1]
+    eye = torch.eye(num_state, device=device) > 0
+    identity = torch.full((num_state, num_state), semiring.zero, dtype=torch.float32, device=device)
+    identity.masked_fill_(eye, semiring.one)
+    return identity.expand(size)
+
+
+def semiring_reduce(semiring, mats):
+    """product of a sequence of matrices, pairs are multiplied
+    in a tree so the depth is O(log T)
+
+    Args:
+        mats: (T, ..., k, k)
+
+    Returns: (..., k, k)
+
+    """
+    while mats.size(0) > 1:
+        length = mats.size(0)
+        prod = semiring.matmul(mats[0:length - 1:2], mats[1:length:2])
+        if length % 2 == 1:
+            prod = torch.cat((prod, mats[-1:]), dim=0)
+        mats = prod
+
+    return mats[0]
+
+
+def semiring_scan(semiring, mats):
+    """inclusive prefix products of a sequence of matrices,
+    out[t] = mats[0] * mats[1] * ... * mats[t], with the odd-even
+    (Blelloch style) recursion: O(T) products in O(log T) depth
+
+    Args:
+        mats: (T, ..., k, k)
+
+    Returns: (T, ..., k, k)
+
+    """
+    length = mats.size(0)
+    if length == 1:
+        return mats
+
+    # prefix products ending at the odd positions
+    odd = semiring_scan(semiring, semiring.matmul(mats[0:length - 1:2], mats[1:length:2]))
+
+    # prefix products ending at the even positions
+    even = mats[0:1]
+    if length > 2:
+        even = torch.cat((even, semiring.matmul(odd[:(length - 1) // 2], mats[2::2])), dim=0)
+
+    # interleave
+    output = torch.stack((even[:length // 2], odd), dim=1).view(-1, *mats.size()[1:])
+    if length % 2 == 1:
+        output = torch.cat((output, even[-1:]), dim=0)
+
+    return output
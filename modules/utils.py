@@ -1,4 +1,5 @@
 import math
+import re
 from collections import defaultdict
 
 import numpy as np
@@ -25,12 +26,14 @@ class ConllSent(object):
         return len(self.sent_dict["word"])
 
 
+# the strings accepted by float()
+_DIGITS = r'\d(?:_?\d)*'
+_NUMBER = re.compile(r'\s*[+-]?(?:(?:{0}(?:\.(?:{0})?)?|\.{0})(?:[eE][+-]?{0})?'
+                     r'|nan|inf|infinity)\s*\Z'.format(_DIGITS), re.IGNORECASE)
+
+
 def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+    return _NUMBER.match(s) is not None
 
 
 def cast_to_int(s):
@@ -98,16 +101,25 @@ def sents_to_tagid(sentences):
     return id_sents, ids
 
 
-def read_conll(fname, max_len=1e3, rm_null=True, prc_num=True):
-    sentences = []
-    sent = ConllSent()
+def iter_conll(fname, max_len=1e3, rm_null=True, prc_num=True):
+    """read a CoNLL file lazily, sentences longer than max_len
+    words are skipped without being parsed
 
-    null_total = []
+    Yields: (sent, null_sent)
+        sent: a ConllSent object
+        null_sent: positions of the removed null elements
+
+    """
+    sent = ConllSent()
     null_sent = []
     loc = 0
+    skip = False
     with open(fname) as fin:
         for line in fin:
             if line != '\n':
+                if skip:
+                    continue
+
                 line = line.strip().split('\t')
                 sent["head"].append((int(line[0]),
                                      cast_to_int(line[3])))
@@ -120,16 +132,28 @@ def read_conll(fname, max_len=1e3, rm_null=True, prc_num=True):
                     else:
                         sent["word"].append(line[1])
 
+                    # too long already, skip to the end of the sentence
+                    skip = len(sent) > max_len
+
                 loc += 1
             else:
-                loc = 0
-                if len(sent) > 0 and len(sent) <= max_len:
-                    sentences.append(sent)
-                    null_total.append(null_sent)
+                if len(sent) > 0 and not skip:
+                    yield sent, null_sent
 
+                loc = 0
+                skip = False
                 null_sent = []
                 sent = ConllSent()
 
+
+def read_conll(fname, max_len=1e3, rm_null=True, prc_num=True):
+    sentences = []
+    null_total = []
+    for sent, null_sent in iter_conll(fname, max_len=max_len, rm_null=rm_null,
+                                      prc_num=prc_num):
+        sentences.append(sent)
+        null_total.append(null_sent)
+
     return sentences, null_total
 
 
@@ -178,28 +202,115 @@ def to_input_tensor(sents, pad, device):
     return sents_t, masks_t
 
 
-def data_iter(data, batch_size, is_test=False, shuffle=True):
-    index_arr = np.arange(len(data))
+def to_id_tensor(id_sents, device):
+    """pad sentences of ids
+
+    Args:
+        id_sents: list of int sequences
+
+    Returns: (ids, masks)
+        ids: long tensor (max_len, batch_size), padded with 0
+        masks: (max_len, batch_size)
+
+    """
+    lengths = [len(sent) for sent in id_sents]
+    max_len = max(lengths)
+    ids = np.zeros((max_len, len(id_sents)), dtype=np.int64)
+    for b, sent in enumerate(id_sents):
+        ids[:lengths[b], b] = sent
+    masks = np.arange(max_len)[:, None] < np.array(lengths)[None, :]
+
+    return torch.tensor(ids, device=device), \
+        torch.tensor(masks, dtype=torch.float32, device=device)
+
+
+def batch_index_iter(lengths, batch_size, shuffle=True, bucket=False,
+                     max_tokens=0, pool_size=None, max_cost=0, cost=None):
+    """split sentence indices into batches
+
+    Args:
+        lengths: a list of sentence lengths
+        batch_size: number of sentences per batch, ignored if max_tokens or max_cost > 0
+        shuffle: shuffle the sentences (and the batch order when bucketing)
+        bucket: group sentences of similar length into the same batch,
+            sentences are shuffled, sorted by length within pools of
+            pool_size sentences and the resulting batches are shuffled
+        max_tokens: if > 0, batches are filled up to max_tokens padded
+            tokens (batch size x max length) instead of batch_size
+            sentences, implies bucket
+        pool_size: number of sentences sorted together when shuffling,
+            50 * batch_size by default
+        max_cost: if > 0, batches are filled while cost(batch size, max length)
+            stays within max_cost, like max_tokens. A sentence over the
+            budget on its own gets a batch of its own
+        cost: function of (batch size, max length), used with max_cost
+
+    Yields: numpy arrays of sentence indices
+
+    """
+    lengths = np.asarray(lengths)
+    index_arr = np.arange(len(lengths))
     # in_place operation
 
     if shuffle:
         np.random.shuffle(index_arr)
 
-    batch_num = int(np.ceil(len(data) / float(batch_size)))
-    for i in range(batch_num):
-        batch_ids = index_arr[i * batch_size: (i + 1) * batch_size]
-        batch_data = [data[index] for index in batch_ids]
+    if max_tokens > 0:
+        max_cost = max_tokens
+
+        def cost(size, length):
+            return size * length
+
+    if not bucket and max_cost <= 0:
+        batch_num = int(np.ceil(len(lengths) / float(batch_size)))
+        for i in range(batch_num):
+            yield index_arr[i * batch_size: (i + 1) * batch_size]
+        return
+
+    if pool_size is None:
+        pool_size = 50 * batch_size
+    if not shuffle:
+        pool_size = len(lengths)
+
+    batches = []
+    for i in range(0, len(index_arr), pool_size):
+        pool = index_arr[i: i + pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='mergesort')]
+        if max_cost > 0:
+            start = 0
+            for end in range(1, len(pool) + 1):
+                # pool is sorted, the last sentence is the longest
+                if end > start + 1 and cost(end - start, lengths[pool[end - 1]]) > max_cost:
+                    batches.append(pool[start: end - 1])
+                    start = end - 1
+            batches.append(pool[start:])
+        else:
+            batches += [pool[j: j + batch_size] for j in range(0, len(pool), batch_size)]
 
-        if is_test:
-            # batch_data.sort(key=lambda e: -len(e[0]))
-            test_data = [data_tuple[0] for data_tuple in batch_data]
-            tags = [data_tuple[1] for data_tuple in batch_data]
+    if shuffle:
+        np.random.shuffle(batches)
 
-            yield test_data, tags
+    for batch_ids in batches:
+        yield batch_ids
 
-        else:
-            # batch_data.sort(key=lambda e: -len(e))
-            yield batch_data
+
+def padding_stats(lengths, batches):
+    """
+    Args:
+        lengths: a list of sentence lengths
+        batches: a list of arrays of sentence indices
+
+    Returns: (number of words, number of padded tokens)
+
+    """
+    lengths = np.asarray(lengths)
+    num_words = num_tokens = 0
+    for batch_ids in batches:
+        batch_len = lengths[batch_ids]
+        num_words += batch_len.sum()
+        num_tokens += len(batch_ids) * batch_len.max()
+
+    return int(num_words), int(num_tokens)
 
 
 def generate_seed(data, size, shuffle=True):
@@ -246,6 +357,6 @@ def unravel_index(input, size):
     idx = []
     for adim in size[::-1]:
         idx.append((input % adim).unsqueeze(dim=-1))
-        input = input / adim
+        input = input // adim
     idx = idx[::-1]
     return torch.cat(idx, -1)
@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+import mmap
+import os
+import pickle
+
+import numpy as np
+
+
+class VectorStore(object):
+    """word vectors memory-mapped from a directory written by
+    build_vector_store, behaves like the read-only dict of the
+    pickled word vector file. The vocabulary is a blob of sorted
+    utf-8 words plus offsets and is searched in place, so opening
+    a store reads nothing and only the looked up rows are paged in
+
+    Args:
+        path: the store directory
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.vectors = _open_rows(os.path.join(path, 'vectors.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.blob = np.memmap(os.path.join(path, 'words.bin'), dtype=np.uint8, mode='r') \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        self.num_dims = self.vectors.shape[1]
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def _word(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def index(self, word):
+        """row of word, -1 if word is not in the store"""
+        key = word.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._word(lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def __getitem__(self, word):
+        index = self.index(word)
+        if index < 0:
+            raise KeyError(word)
+        return np.array(self.vectors[index])
+
+    def keys(self):
+        """the words in row order, decoded from one read of the blob"""
+        blob = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))]
+
+    def extract(self, words):
+        """vectors of a list of words, rows are read in
+        file order
+
+        Returns: float32 numpy array (len(words), num_dims)
+
+        """
+        index = np.array([self.index(word) for word in words], dtype=np.int64)
+        if (index < 0).any():
+            raise KeyError(words[int(np.argmax(index < 0))])
+
+        order = np.argsort(index)
+        output = np.empty((len(words), self.num_dims), dtype=np.float32)
+        output[order] = self.vectors[index[order]]
+        return output
+
+
+def _open_rows(fname):
+    """memory map a .npy matrix for random row access, the kernel
+    readahead would otherwise page in most of the file for a
+    scattered set of rows
+    """
+    with open(fname, 'rb') as fin:
+        version = np.lib.format.read_magic(fin)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fin)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fin)
+        assert not fortran_order
+        header_size = fin.tell()
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(buf, 'madvise'):
+        buf.madvise(mmap.MADV_RANDOM)
+
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)),
+                         offset=header_size).reshape(shape)
+
+
+def build_vector_store(word_vec, path):
+    """write a dict of word vectors as a VectorStore directory
+
+    Args:
+        word_vec: a dict mapping words to vectors
+        path: the output directory
+
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    keys = sorted((word.encode('utf-8'), word) for word in word_vec)
+    blob = b''.join(key for key, _ in keys)
+    offsets = np.concatenate(([0], np.cumsum([len(key) for key, _ in keys]))).astype(np.int64)
+    vectors = np.array([word_vec[word] for _, word in keys], dtype=np.float32)
+
+    with open(os.path.join(path, 'words.bin'), 'wb') as fout:
+        fout.write(blob)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'vectors.npy'), vectors)
+
+
+def load_word_vec(path):
+    """open a VectorStore directory, or load a pickled dict
+    of word vectors
+    """
+    if os.path.isdir(path):
+        return VectorStore(path)
+
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
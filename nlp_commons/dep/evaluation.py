@@ -0,0 +1,124 @@
+# dep/evaluation.py: Directed and undirected attachment accuracy of
+# dependency parses, counted with numpy over flat arrays of heads. Shared
+# by DepModel and the models of the parent project.
+
+from __future__ import absolute_import
+
+import numpy as np
+
+
+def pair_heads(pairs, length=None, base=1):
+    """heads in position order of (position, head) pairs
+
+    Args:
+        pairs: (position, head) pairs of a sentence, positions and heads
+            count from base and base - 1 is the root, e.g. 1 for
+            CoNLL files and 0 for the dependency sets of DepModel
+        length: sentence length, the largest position if not given
+
+    Returns: int64 array of 1-based heads as in CoNLL files, 0 is the
+        root and -1 marks the positions missing from pairs
+
+    """
+    pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+    if length is None:
+        length = pairs[:, 0].max() - base + 1 if len(pairs) else 0
+    heads = np.full(length, -1, dtype=np.int64)
+    heads[pairs[:, 0] - base] = pairs[:, 1] - base + 1
+    return heads
+
+
+def flatten_heads(sents):
+    """
+    Args:
+        sents: a list of head arrays, one per sentence
+
+    Returns: (heads, offsets), sentence i owns heads[offsets[i]:offsets[i+1]]
+
+    """
+    lengths = [len(sent) for sent in sents]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    heads = np.concatenate([np.asarray(sent, dtype=np.int64) for sent in sents]) \
+        if sents else np.zeros(0, dtype=np.int64)
+    return heads, offsets
+
+
+class DepAccuracy(object):
+    """counts of correct heads by sentence length bucket, updated with
+    numpy over flat head arrays, directed, undirected, root and per
+    length accuracies are read off it
+
+    A word has a correct directed head if it is the gold head, and a
+    correct undirected head if the gold head also has the word as its
+    predicted head
+
+    Args:
+        min_length: shorter sentences are not counted
+        bucket_edges: upper lengths of the buckets, longer sentences
+            fall in a last bucket
+
+    """
+    def __init__(self, min_length=2, bucket_edges=(10, 20, 40)):
+        self.min_length = min_length
+        self.bucket_edges = np.asarray(bucket_edges, dtype=np.int64)
+
+        # (num_bucket, 5), number of words, directed and undirected
+        # correct heads, gold roots and correct roots
+        self.counts = np.zeros((len(bucket_edges) + 1, 5), dtype=np.int64)
+
+    def update(self, pred, gold, offsets):
+        """
+        Args:
+            pred: flat predicted heads, 1-based within each sentence and
+                0 is the root, as in CoNLL files
+            gold: flat gold heads, same size as pred
+            offsets: sentence i owns pred[offsets[i]:offsets[i+1]]
+
+        """
+        pred = np.asarray(pred, dtype=np.int64)
+        gold = np.asarray(gold, dtype=np.int64)
+        lengths = np.diff(offsets)
+
+        sent = np.repeat(np.arange(len(lengths)), lengths)
+        start = np.asarray(offsets[:-1], dtype=np.int64)[sent]
+        position = np.arange(len(gold)) - start + 1
+
+        directed = pred == gold
+        back = np.zeros_like(directed)
+        has_head = gold > 0
+        back[has_head] = pred[start[has_head] + gold[has_head] - 1] == position[has_head]
+        undirected = directed | back
+        is_root = gold == 0
+
+        counted = lengths[sent] >= self.min_length
+        bucket = np.searchsorted(self.bucket_edges, lengths)[sent]
+        num_bucket = len(self.counts)
+        for column, correct in enumerate([counted, directed, undirected, is_root, is_root & directed]):
+            self.counts[:, column] += np.bincount(bucket[counted & correct], minlength=num_bucket)
+
+    def total(self):
+        return self.counts[:, 0].sum()
+
+    def directed(self):
+        return self.counts[:, 1].sum() / float(max(self.total(), 1))
+
+    def undirected(self):
+        return self.counts[:, 2].sum() / float(max(self.total(), 1))
+
+    def root(self):
+        """the fraction of gold roots that are predicted as roots"""
+        return self.counts[:, 4].sum() / float(max(self.counts[:, 3].sum(), 1))
+
+    def by_length(self):
+        """
+        Returns: a list of (min length, max length, number of words,
+            directed, undirected) of the non-empty buckets, max length
+            is None for the last bucket
+
+        """
+        lower = np.concatenate([[self.min_length], np.maximum(self.bucket_edges + 1, self.min_length)])
+        upper = [int(edge) for edge in self.bucket_edges] + [None]
+        return [(int(lower[k]), upper[k], int(num_words),
+                 float(directed) / num_words, float(undirected) / num_words)
+                for k, (num_words, directed, undirected) in enumerate(self.counts[:, :3])
+                if num_words > 0]
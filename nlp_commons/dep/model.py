@@ -9,6 +9,7 @@ from . import depset
 from . import dwsj
 # from .. import model
 from .. import sentence, bracketing, model
+from .evaluation import DepAccuracy, flatten_heads, pair_heads
 
 
 # dep/model.py: A general model for dependency parsing (class DepModel), and a
@@ -43,21 +44,11 @@ class DepModel(model.Model):
     def eval(self, output=True, short=False, long=False, max_length=None):
         Gold = self.Gold
 
-        Count = 0
-        Directed = 0.0
-        Undirected = 0.0
-
-        for i in range(len(Gold)):
-            l = Gold[i].length
-            if (max_length is None or l <= max_length) \
-                    and (self.count_length_2_1 or (self.count_length_2 and l == 2) or l >= 3):
-                (count, directed, undirected) = self.measures(i)
-                Count += count
-                Directed += directed
-                Undirected += undirected
-
-        Directed = Directed / Count
-        Undirected = Undirected / Count
+        index = [i for i in range(len(Gold)) if max_length is None or Gold[i].length <= max_length]
+        accuracy = self.accuracy(index, self.min_length())
+        Count = accuracy.total()
+        Directed = accuracy.directed()
+        Undirected = accuracy.undirected()
 
         self.evaluation = (Count, Directed, Undirected)
         self.evaluated = True
@@ -75,21 +66,34 @@ class DepModel(model.Model):
 
         return self.evaluation
 
+    def min_length(self):
+        # Shortest sentence length counted by eval(), from the
+        # count_length_2 and count_length_2_1 flags.
+        if self.count_length_2_1:
+            return 1
+        elif self.count_length_2:
+            return 2
+        return 3
+
+    def accuracy(self, index, min_length=1):
+        # DepAccuracy of the parses of the sentences in index.
+        Gold, Parse = self.Gold, self.Parse
+        gold, offsets = flatten_heads([pair_heads(Gold[i].deps, Gold[i].length, base=0)
+                                       for i in index])
+        parse, _ = flatten_heads([pair_heads(Parse[i].deps, Gold[i].length, base=0)
+                                  for i in index])
+
+        accuracy = DepAccuracy(min_length)
+        accuracy.update(parse, gold, offsets)
+        return accuracy
+
     def measures(self, i):
         # Helper for eval().
         # Measures for the i-th parse.
 
-        g, p = self.Gold[i].deps, self.Parse[i].deps
-        (n, d, u) = (self.Gold[i].length, 0, 0)
-        for (a, b) in g:
-            b1 = (a, b) in p
-            b2 = (b, a) in p
-            if b1:
-                d += 1
-            if b1 or b2:
-                u += 1
-
-        return (n, d, u)
+        # number of words, directed and undirected correct heads
+        (n, d, u) = self.accuracy([i]).counts[:, :3].sum(axis=0)
+        return (int(n), int(d), int(u))
 
     # def eval_stats(self, output=True, short=False, long=False, max_length=None):
     def eval_stats(self, output=True, max_length=None):
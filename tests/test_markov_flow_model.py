@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from modules import Corpus, MarkovFlow
+
+
+def make_args(**kwargs):
+    args = argparse.Namespace(model='gaussian', num_state=3, couple_layers=2,
+                              cell_layers=1, load_nice='', load_gaussian='',
+                              forward='log', type_cache=False, batch_size=4,
+                              bucket=False, max_tokens=0,
+                              device=torch.device('cpu'))
+    vars(args).update(kwargs)
+    return args
+
+
+def make_corpus():
+    rng = np.random.RandomState(0)
+    words = ['w%d' % i for i in range(6)]
+    word_vec = {word: rng.randn(4).astype(np.float32) for word in words}
+    sentences = [{'word': [words[i] for i in rng.randint(len(words), size=length)]}
+                 for length in (3, 5, 2, 4, 6, 3)]
+    return Corpus(word_vec, sentences, torch.device('cpu'))
+
+
+def test_em_var_survives_save_and_load(tmp_path):
+    torch.manual_seed(0)
+    corpus = make_corpus()
+    init_seed = corpus.batch(np.arange(len(corpus)))
+
+    model = MarkovFlow(make_args(), corpus.num_dims)
+    model.init_params(init_seed)
+    seed_var = model.var.clone()
+    model.em_step(corpus, batch_size=4)
+    assert not torch.allclose(model.var, seed_var)
+
+    path = str(tmp_path / 'gaussian.pt')
+    torch.save(model.state_dict(), path)
+
+    loaded = MarkovFlow(make_args(load_gaussian=path), corpus.num_dims)
+    loaded.init_params(init_seed)
+    assert torch.equal(loaded.var, model.var)
+    assert torch.equal(loaded.means, model.means)
+    assert torch.equal(loaded.tparams, model.tparams)
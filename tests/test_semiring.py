@@ -0,0 +1,39 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from modules import LogSemiring, log_sum_exp, semiring_identity
+
+
+def reference_matmul(a, b):
+    return log_sum_exp(a[..., :, :, None] + b[..., None, :, :], dim=-2)
+
+
+def test_log_matmul_peaked():
+    # out[0, 1] is about 79 nats below the row max of a plus the
+    # column max of b, below a 1e-30 floor
+    a = torch.tensor([[0.0, -80.0], [-3.0, 0.0]])
+    b = torch.tensor([[0.0, -80.0], [-2.0, 0.0]])
+
+    out = LogSemiring.matmul(a, b)
+    assert out[0, 1].item() < -79.0
+    assert torch.allclose(out, reference_matmul(a, b), atol=1e-4)
+
+    torch.manual_seed(0)
+    a = torch.randn(3, 5, 5) * 20.0
+    b = torch.randn(3, 5, 5) * 20.0
+    assert torch.allclose(LogSemiring.matmul(a, b), reference_matmul(a, b), atol=1e-3)
+
+
+def test_log_matmul_identity_gradient():
+    a = torch.randn(2, 4, 4, requires_grad=True)
+    identity = semiring_identity(LogSemiring, (2, 4, 4), a.device)
+
+    out = LogSemiring.matmul(identity, a)
+    assert torch.allclose(out, a, atol=1e-5)
+
+    out.sum().backward()
+    assert torch.isfinite(a.grad).all()